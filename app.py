@@ -1,11 +1,27 @@
+import bisect
+import gzip
+import hashlib
+import json
 import os
+import queue
+import re
 import sqlite3
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from datetime import datetime
+import unicodedata
+import uuid
+from collections import namedtuple
+from flask import Flask, render_template, request, jsonify, send_from_directory, g
+from datetime import datetime, timezone
 import socket
+import sys
 import threading
 import time
-import sync_members
+from contextlib import contextmanager
+import metrics
+import migrations
+import profiling
+import rollups
+from member_names import normalize_name
+from sync_scheduler import ExportScheduler, nudge_sync, pending_export
 
 app = Flask(__name__)
 
@@ -14,6 +30,9 @@ DB_PATH = os.environ.get('APP_DB_PATH') or os.path.join(app.root_path, 'checkins
 # Separate DB for Lärtimmar registrations.
 LARTIMMAR_DB_PATH = os.environ.get('LARTIMMAR_DB_PATH') or os.path.join(app.root_path, 'lartimmar.db')
 
+# Per-worker metrics snapshots, merged by /metrics.
+metrics.configure(os.environ.get('KIOSK_METRICS_DIR') or DB_PATH + '.metrics')
+
 # Predefined activities for the Lärtimmar form. The UI also allows free text
 # via the "Annat" option.
 LARTIMMAR_ACTIVITIES = [
@@ -23,6 +42,480 @@ LARTIMMAR_ACTIVITIES = [
     "Utbildning",
 ]
 
+# Busy timeout for the long-lived connections below. With WAL, readers never
+# block writers, so this only covers writer-vs-writer contention; it is kept
+# short because the write routes retry within WRITE_DEADLINE and then spool.
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('KIOSK_BUSY_TIMEOUT_MS', '250')) / 1000.0
+# NORMAL is safe with WAL (no corruption) but may lose the last commits on
+# power loss; set KIOSK_SQLITE_SYNCHRONOUS=FULL to fsync every commit.
+SQLITE_SYNCHRONOUS = os.environ.get('KIOSK_SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+
+# Long-lived connections, one per (thread, database). Gunicorn forks workers
+# after importing this module, so the pid is checked to make sure a worker
+# never reuses a connection opened in its parent.
+_db_local = threading.local()
+
+
+def _configure_connection(conn):
+    # journal_mode=WAL is persistent in the database file; the others are
+    # per-connection and applied once when the connection is opened.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+
+
+def get_db(path):
+    """Return this thread's warm connection to `path`, opening it on first use."""
+    pid = os.getpid()
+    if getattr(_db_local, 'pid', None) != pid:
+        _db_local.pid = pid
+        _db_local.conns = {}
+    conn = _db_local.conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT)
+        _configure_connection(conn)
+        _db_local.conns[path] = conn
+    return conn
+
+
+def discard_db(path):
+    """Close and forget this thread's connection to `path` (e.g. after an error)."""
+    conns = getattr(_db_local, 'conns', None)
+    if getattr(_db_local, 'pid', None) != os.getpid() or not conns:
+        return
+    conn = conns.pop(path, None)
+    if conn is not None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+# Optional group commit: inserts from the write routes are queued to one
+# writer thread per database, which commits them together every few
+# milliseconds (or every N rows). Batches only form when a worker serves
+# several requests at once, e.g. gunicorn with `--threads`.
+GROUP_COMMIT_ENABLED = os.environ.get('KIOSK_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+GROUP_COMMIT_INTERVAL = float(os.environ.get('KIOSK_GROUP_COMMIT_MS', '5')) / 1000.0
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('KIOSK_GROUP_COMMIT_MAX_ROWS', '64'))
+
+
+class _PendingWrite:
+    __slots__ = ('sql', 'params', 'done', 'error', 'lock', 'taken', 'cancelled')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.done = threading.Event()
+        self.error = None
+        # A submitter that runs out of time may cancel the row, but only
+        # until the writer has taken it into a transaction.
+        self.lock = threading.Lock()
+        self.taken = False
+        self.cancelled = False
+
+
+class GroupCommitWriter:
+    """Single writer thread that commits queued inserts for one database in batches.
+
+    `submit()` blocks until the transaction holding the row has committed.
+    The writer's connection runs with synchronous=FULL, so that commit is
+    one fsync shared by the whole batch rather than one per request.
+    """
+
+    def __init__(self, path, interval=GROUP_COMMIT_INTERVAL, max_rows=GROUP_COMMIT_MAX_ROWS):
+        self.path = path
+        self.interval = interval
+        self.max_rows = max_rows
+        self.batches = 0
+        self.rows = 0
+        self._queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Fresh queue after a fork; the parent's thread does not exist here.
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, sql, params, timeout=None):
+        """Queue an insert and wait for its batch to commit.
+
+        Returns False if `timeout` ran out before the writer picked the row
+        up; the row is then dropped from the queue and never written.
+        """
+        self._ensure_started()
+        item = _PendingWrite(sql, params)
+        self._queue.put(item)
+        if not item.done.wait(timeout):
+            with item.lock:
+                if not item.taken:
+                    item.cancelled = True
+                    return False
+            # Already part of a transaction; its commit is bounded by the
+            # writer's busy timeout, so waiting it out is cheap.
+            item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return True
+
+    def _take(self, batch):
+        taken = []
+        for item in batch:
+            with item.lock:
+                if item.cancelled:
+                    continue
+                item.taken = True
+            taken.append(item)
+        return taken
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch):
+        conn = get_db(self.path)
+        if conn is not self._conn:
+            conn.execute("PRAGMA synchronous=FULL")
+            self._conn = conn
+        try:
+            with conn:
+                for item in batch:
+                    conn.execute(item.sql, item.params)
+        except sqlite3.OperationalError as e:
+            # Lock/IO trouble affects the whole batch; let the routes retry.
+            for item in batch:
+                item.error = e
+        except sqlite3.Error:
+            # A bad row must not fail its neighbours: redo them one by one.
+            for item in batch:
+                try:
+                    with conn:
+                        conn.execute(item.sql, item.params)
+                except sqlite3.Error as e:
+                    item.error = e
+
+    def _run(self):
+        while True:
+            batch = self._take(self._collect())
+            if not batch:
+                continue
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Never leave a request waiting on a writer that gave up.
+                discard_db(self.path)
+                for item in batch:
+                    item.error = item.error or e
+            self.batches += 1
+            self.rows += len(batch)
+            for item in batch:
+                item.done.set()
+
+
+_group_writers = {}
+_group_writers_lock = threading.Lock()
+
+
+def get_group_writer(path):
+    with _group_writers_lock:
+        writer = _group_writers.get(path)
+        if writer is None:
+            writer = _group_writers[path] = GroupCommitWriter(path)
+        return writer
+
+
+def insert_row(path, sql, params, timeout=None):
+    """Insert one row into `path`, through the group-commit writer when enabled.
+
+    Returns False only if the group-commit writer did not reach the row
+    within `timeout`; direct inserts either succeed or raise.
+    """
+    if GROUP_COMMIT_ENABLED:
+        return get_group_writer(path).submit(sql, params, timeout=timeout)
+    conn = get_db(path)
+    with conn:
+        conn.execute(sql, params)
+    return True
+
+
+# Latency budget for one write request. Busy errors are retried with a short
+# backoff until the deadline; after that the row is appended to a durable
+# spool file next to the database and drained into SQLite in the background.
+WRITE_DEADLINE = float(os.environ.get('KIOSK_WRITE_DEADLINE_MS', '750')) / 1000.0
+SPOOL_DRAIN_INTERVAL = 2.0
+# Tables the spool may write to; spool lines naming anything else are rejected.
+SPOOL_TABLES = ('checkins', 'lartimmar')
+
+# Per-worker write counters, reported by /healthz.
+write_stats = {'lock_retries': 0, 'lock_wait_seconds': 0.0, 'deadline_misses': 0, 'spooled': 0, 'drained': 0,
+               'rejected': 0}
+_write_stats_lock = threading.Lock()
+
+_WRITE_METRICS = {
+    'lock_retries': 'kiosk_sqlite_lock_retries_total',
+    'lock_wait_seconds': 'kiosk_sqlite_lock_wait_seconds_total',
+    'deadline_misses': 'kiosk_write_deadline_misses_total',
+    'spooled': 'kiosk_write_spooled_rows_total',
+    'drained': 'kiosk_spool_drained_rows_total',
+    'rejected': 'kiosk_spool_rejected_rows_total',
+}
+
+
+def _write_metrics():
+    with _write_stats_lock:
+        return {(name, ()): write_stats[key] for key, name in _WRITE_METRICS.items()}
+
+
+metrics.register_collector(_write_metrics)
+
+
+def _count_write(key, n=1):
+    with _write_stats_lock:
+        write_stats[key] += n
+
+
+def _is_busy_error(e):
+    msg = str(e).lower()
+    return 'locked' in msg or 'busy' in msg
+
+
+def _insert_sql(table, columns):
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+def save_row(path, table, row):
+    """Insert `row` (column -> value) into `table` within WRITE_DEADLINE.
+
+    Returns True if the row is in SQLite, False if it was spooled because
+    the database stayed busy. Other database errors are raised.
+    """
+    columns = list(row)
+    sql = _insert_sql(table, columns)
+    params = [row[c] for c in columns]
+    started = time.monotonic()
+    deadline = started + WRITE_DEADLINE
+    backoff = 0.02
+    retried = False
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            if insert_row(path, sql, params, timeout=remaining):
+                if retried:
+                    _count_write('lock_wait_seconds', time.monotonic() - started)
+                # Wake the export scheduler; spooled rows nudge once drained.
+                nudge_sync()
+                return True
+            break
+        except sqlite3.OperationalError as e:
+            if not _is_busy_error(e):
+                discard_db(path)
+                raise
+            retried = True
+            _count_write('lock_retries')
+            time.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+            backoff *= 2
+
+    _count_write('lock_wait_seconds', time.monotonic() - started)
+    _count_write('deadline_misses')
+    spool_row(path, table, row)
+    return False
+
+
+def _spool_path(path):
+    return path + '.spool'
+
+
+@contextmanager
+def _file_lock(lock_path, blocking=True):
+    """Exclusive advisory lock on `lock_path`; yields False if non-blocking and taken."""
+    with open(lock_path, 'a') as lock_file:
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            if blocking:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if sys.platform == "win32":
+                import msvcrt
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def spool_row(path, table, row):
+    """Append a row to the spool for `path` and fsync it before returning."""
+    # The id makes draining idempotent; see drain_spool.
+    line = json.dumps({'table': table, 'id': uuid.uuid4().hex, 'row': row}, ensure_ascii=False)
+    spool = _spool_path(path)
+    with _file_lock(spool + '.lock'):
+        with open(spool, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    _count_write('spooled')
+    _ensure_spool_drainer()
+
+
+def _read_spool(spool_file):
+    """([(line, table, spool id, row)], [(line, reason)]) from a spool file."""
+    rows = []
+    invalid = []
+    with open(spool_file, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                table, row = entry['table'], entry['row']
+                columns_ok = all(re.fullmatch(r'\w+', c) for c in row)
+            except (ValueError, KeyError, TypeError) as e:
+                # Usually a torn last line from a crash mid-append
+                invalid.append((line, f"unreadable: {e}"))
+                continue
+            if table not in SPOOL_TABLES or not columns_ok:
+                invalid.append((line, "unknown table or column name"))
+                continue
+            # Lines spooled before spool ids existed have none
+            rows.append((line, table, entry.get('id'), row))
+    return rows, invalid
+
+
+def _reject_spool_lines(spool, rejected):
+    """Append lines that cannot be inserted to `<spool>.rejected` for inspection."""
+    with open(spool + '.rejected', 'a', encoding='utf-8') as f:
+        for line, reason in rejected:
+            print(f"Rejected spool entry ({reason}): {line}")
+            f.write(line + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    _count_write('rejected', len(rejected))
+
+
+def drain_spool(path):
+    """Move spooled rows for `path` into SQLite. Returns the number of rows drained.
+
+    The spool is renamed aside under the append lock (so writers are only
+    blocked for a rename) and then inserted in one transaction. A leftover
+    `.draining` file from an interrupted drain is finished first; rows are
+    inserted with their spool id, so the ones that already made it are
+    skipped. Lines that cannot be inserted (unknown column, constraint
+    failure) go to `.spool.rejected` instead of blocking the rest; a busy
+    database raises and the whole file is retried later.
+    """
+    spool = _spool_path(path)
+    draining = spool + '.draining'
+    with _file_lock(spool + '.drain.lock', blocking=False) as locked:
+        if not locked:
+            return 0
+        if not os.path.exists(draining):
+            with _file_lock(spool + '.lock'):
+                if not os.path.exists(spool):
+                    return 0
+                os.replace(spool, draining)
+
+        rows, rejected = _read_spool(draining)
+        drained = 0
+        if rows:
+            conn = get_db(path)
+            with conn:
+                for line, table, spool_id, row in rows:
+                    columns = list(row) + ['spool_id']
+                    try:
+                        # A failed statement only undoes itself, not the transaction
+                        cursor = conn.execute(
+                            _insert_sql(table, columns) + " ON CONFLICT (spool_id) WHERE spool_id IS NOT NULL DO NOTHING",
+                            list(row.values()) + [spool_id],
+                        )
+                    except sqlite3.Error as e:
+                        if _is_busy_error(e):
+                            raise
+                        rejected.append((line, str(e)))
+                        continue
+                    drained += cursor.rowcount
+        if rejected:
+            _reject_spool_lines(spool, rejected)
+        os.remove(draining)
+
+    if drained:
+        _count_write('drained', drained)
+        print(f"[Worker {os.getpid()}] Drained {drained} spooled rows into {os.path.basename(path)}")
+    return drained
+
+
+def spool_depth(path):
+    """Number of rows waiting in the spool for `path`."""
+    spool = _spool_path(path)
+    depth = 0
+    for fn in (spool, spool + '.draining'):
+        try:
+            with open(fn, 'rb') as f:
+                depth += sum(1 for _ in f)
+        except FileNotFoundError:
+            pass
+    return depth
+
+
+_spool_drainer_lock = threading.Lock()
+_spool_drainer_pid = None
+
+
+def _spool_drain_loop():
+    global _spool_drainer_pid
+    while True:
+        time.sleep(SPOOL_DRAIN_INTERVAL)
+        for path in (DB_PATH, LARTIMMAR_DB_PATH):
+            try:
+                if drain_spool(path):
+                    nudge_sync()
+            except Exception as e:
+                print(f"[Worker {os.getpid()}] Spool drain for {os.path.basename(path)} failed: {e}")
+        with _spool_drainer_lock:
+            if not spool_depth(DB_PATH) and not spool_depth(LARTIMMAR_DB_PATH):
+                _spool_drainer_pid = None
+                return
+
+
+def _ensure_spool_drainer():
+    # One drainer thread per worker, started on demand and exiting once
+    # the spool is empty again.
+    global _spool_drainer_pid
+    with _spool_drainer_lock:
+        if _spool_drainer_pid == os.getpid():
+            return
+        _spool_drainer_pid = os.getpid()
+    threading.Thread(target=_spool_drain_loop, daemon=True).start()
+
+
 def get_ip_address():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -35,103 +528,423 @@ def get_ip_address():
         s.close()
     return IP
 
+
+# The LAN address rarely changes; re-probing it (a UDP socket per call) on
+# every page load is wasted work, so cache it briefly.
+IP_ADDRESS_TTL = 60.0
+_ip_address_cache = (0.0, None)
+
+
+def get_ip_address_cached():
+    global _ip_address_cache
+    fetched_at, ip = _ip_address_cache
+    now = time.monotonic()
+    if ip is None or now - fetched_at > IP_ADDRESS_TTL:
+        ip = get_ip_address()
+        _ip_address_cache = (now, ip)
+    return ip
+
 # Serve theme assets (fonts/images) from the `theme/` folder
 @app.route('/theme/<path:filename>')
 def theme_static(filename):
     return send_from_directory(os.path.join(app.root_path, 'theme'), filename)
 
 
-def ensure_checkins_schema():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS checkins
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, timestamp TEXT, exported INTEGER DEFAULT 0, person_id TEXT, checkin_type TEXT)''')
-    c.execute("PRAGMA table_info(checkins)")
-    cols = {row[1] for row in c.fetchall()}
-    if 'exported' not in cols:
-        c.execute("ALTER TABLE checkins ADD COLUMN exported INTEGER DEFAULT 0")
-    if 'person_id' not in cols:
-        c.execute("ALTER TABLE checkins ADD COLUMN person_id TEXT")
-    if 'checkin_type' not in cols:
-        c.execute("ALTER TABLE checkins ADD COLUMN checkin_type TEXT")
-    conn.commit()
-    conn.close()
-
 def init_db():
-    ensure_checkins_schema()
-    ensure_members_table()
-    ensure_lartimmar_schema()
-
-
-def ensure_lartimmar_schema():
-    conn = sqlite3.connect(LARTIMMAR_DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS lartimmar (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 timestamp TEXT,
-                 aktivitet TEXT,
-                 namn TEXT,
-                 personnummer TEXT,
-                 antal_timmar REAL,
-                 ledare INTEGER DEFAULT 0,
-                 exported INTEGER DEFAULT 0)''')
-    c.execute("PRAGMA table_info(lartimmar)")
-    cols = {row[1] for row in c.fetchall()}
-    if 'exported' not in cols:
-        c.execute("ALTER TABLE lartimmar ADD COLUMN exported INTEGER DEFAULT 0")
-    conn.commit()
-    conn.close()
-
-
-def ensure_members_table():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS members (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 name TEXT NOT NULL,
-                 year_of_birth TEXT,
-                 avgiftstyp TEXT,
-                 sheet_id TEXT,
-                 last_updated TEXT)''')
-
-    c.execute("PRAGMA table_info(members)")
-    cols = {row[1] for row in c.fetchall()}
-    if 'year_of_birth' not in cols:
-        c.execute("ALTER TABLE members ADD COLUMN year_of_birth TEXT")
-    if 'avgiftstyp' not in cols:
-        c.execute("ALTER TABLE members ADD COLUMN avgiftstyp TEXT")
-    if 'sheet_id' not in cols:
-        c.execute("ALTER TABLE members ADD COLUMN sheet_id TEXT")
-    if 'last_updated' not in cols:
-        c.execute("ALTER TABLE members ADD COLUMN last_updated TEXT")
-
-    conn.commit()
-    conn.close()
-
-
-def get_members_from_db():
-    ensure_members_table()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT name, year_of_birth, avgiftstyp FROM members')
-    rows = c.fetchall()
-    conn.close()
-    members = []
-    for r in rows:
-        members.append({'name': r[0], 'year': r[1], 'avgiftstyp': r[2] if r[2] else ""})
-    return members
+    migrations.ensure_checkins_db(DB_PATH)
+    migrations.ensure_lartimmar_db(LARTIMMAR_DB_PATH)
+    # Switch both files to WAL up front so sync_members and the tools also
+    # run against WAL databases. Uses a throwaway connection: init_db runs
+    # before gunicorn forks and connections must not cross a fork.
+    for path in (DB_PATH, LARTIMMAR_DB_PATH):
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+        # Recover rows spooled before a restart.
+        try:
+            drain_spool(path)
+        except Exception as e:
+            print(f"Could not drain spool for {os.path.basename(path)}: {e}")
+        finally:
+            discard_db(path)
+
+
+def fold_search_text(text):
+    """Fold text for member search: casefold and drop diacritics.
+
+    "Östlund" folds to "ostlund" so kiosk users can type with or without
+    the Swedish letters.
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def _name_tokens(name):
+    """Word-start search tokens for a member name (raw and folded forms)."""
+    tokens = set()
+    for word in re.split(r'[\s\-]+', name.strip()):
+        if word:
+            tokens.add(word.casefold())
+            tokens.add(fold_search_text(word))
+    return tokens
+
+
+def _member_dict(row):
+    member_id, name, year, avgiftstyp = row
+    return {'id': member_id, 'name': name, 'year': year, 'avgiftstyp': avgiftstyp or ""}
+
+
+MemberSnapshot = namedtuple('MemberSnapshot', 'epoch generation members keys tokens owners')
+
+
+class MemberIndex:
+    """Per-worker in-memory view of the members table.
+
+    The index is rebuilt only when `kiosk_meta.members_generation` (or the
+    database's `db_epoch`) changes,
+    so validating a check-in is a set lookup instead of a full table scan,
+    and searching is a bisect into a sorted token list.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Swapped in as one object so readers never see a half-built index.
+        self._snapshot = MemberSnapshot(None, None, [], frozenset(), [], [])
+
+    def _read_version(self, conn):
+        """(db_epoch, members_generation) of the database."""
+        meta = dict(conn.execute(
+            "SELECT key, value FROM kiosk_meta WHERE key IN ('db_epoch', 'members_generation')"
+        ).fetchall())
+        return meta.get('db_epoch', 0), meta.get('members_generation', 0)
+
+    def _build(self, version, rows):
+        members = [_member_dict(r) for r in rows if r[1]]
+        # Alphabetical order doubles as the ranking for search results.
+        members.sort(key=lambda m: fold_search_text(m['name']))
+        keys = frozenset(normalize_name(m['name']) for m in members)
+        pairs = sorted(
+            (token, pos)
+            for pos, m in enumerate(members)
+            for token in _name_tokens(m['name'])
+        )
+        return MemberSnapshot(
+            *version,
+            members,
+            keys,
+            [p[0] for p in pairs],
+            [p[1] for p in pairs],
+        )
+
+    def _current(self):
+        conn = get_db(DB_PATH)
+        try:
+            version = self._read_version(conn)
+        except sqlite3.OperationalError:
+            # Older DB without the meta table; migrate and try again.
+            migrations.ensure_checkins_db(DB_PATH)
+            version = self._read_version(conn)
+
+        snapshot = self._snapshot
+        if snapshot[:2] == version:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot[:2] == version:
+                return snapshot
+            # Read generation and rows in one transaction so a concurrent
+            # import cannot slip in between them.
+            conn.execute("BEGIN")
+            try:
+                version = self._read_version(conn)
+                rows = conn.execute(
+                    'SELECT id, name, year_of_birth, avgiftstyp FROM members'
+                ).fetchall()
+            finally:
+                conn.rollback()
+            self._snapshot = self._build(version, rows)
+            return self._snapshot
+
+    def snapshot(self):
+        return self._current()
+
+    def changes_since(self, since, epoch=None):
+        """Members added, changed or removed after generation `since`.
+
+        Returns {epoch, generation, members, removed ids}, or None when
+        `epoch` is not this database's, `since` is older than the change
+        log (see migrations._add_member_changes) or ahead of this database,
+        or more than MEMBER_FEED_MAX_CHANGES members changed; the caller
+        then sends the full list.
+        """
+        conn = get_db(DB_PATH)
+        conn.execute("BEGIN")
+        try:
+            meta = dict(conn.execute(
+                "SELECT key, value FROM kiosk_meta "
+                "WHERE key IN ('db_epoch', 'members_generation', 'member_changes_floor')"
+            ).fetchall())
+            generation = meta.get('members_generation', 0)
+            if epoch is not None and epoch != meta.get('db_epoch', 0):
+                return None
+            if not meta.get('member_changes_floor', generation) <= since <= generation:
+                return None
+            rows = conn.execute(
+                "SELECT c.member_id, m.name, m.year_of_birth, m.avgiftstyp "
+                "FROM (SELECT DISTINCT member_id FROM member_changes WHERE generation > ?) c "
+                "LEFT JOIN members m ON m.id = c.member_id LIMIT ?",
+                (since, MEMBER_FEED_MAX_CHANGES + 1),
+            ).fetchall()
+        finally:
+            conn.rollback()
+        if len(rows) > MEMBER_FEED_MAX_CHANGES:
+            return None
+        return {
+            'epoch': meta.get('db_epoch', 0),
+            'generation': generation,
+            'members': [_member_dict(r) for r in rows if r[1]],
+            # Deleted rows (and nameless ones, which the index skips too)
+            'removed': [r[0] for r in rows if not r[1]],
+        }
+
+    def contains(self, name):
+        return normalize_name(name) in self._current().keys
+
+    def _prefix_matches(self, snapshot, prefix):
+        lo = bisect.bisect_left(snapshot.tokens, prefix)
+        hi = bisect.bisect_left(snapshot.tokens, prefix + '\U0010ffff')
+        return set(snapshot.owners[lo:hi])
+
+    def search(self, query, limit=8):
+        """Return up to `limit` members where every query word starts a name word."""
+        snapshot = self._current()
+        words = [w.casefold() for w in re.split(r'[\s\-]+', query.strip()) if w]
+        if not words:
+            return snapshot.members[:limit]
+
+        candidates = None
+        for word in words:
+            matches = self._prefix_matches(snapshot, word)
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                return []
+        return [snapshot.members[pos] for pos in sorted(candidates)[:limit]]
+
+
+member_index = MemberIndex()
+
+
+RenderedPage = namedtuple('RenderedPage', 'key body gzip_body etag last_modified')
+
+
+def _render_page(key, body):
+    return RenderedPage(
+        key,
+        body,
+        gzip.compress(body),
+        hashlib.sha1(body).hexdigest(),
+        datetime.now(timezone.utc).replace(microsecond=0),
+    )
+
+
+def _page_response(page, mimetype):
+    """Conditional, gzip-aware response for a RenderedPage."""
+    use_gzip = request.accept_encodings['gzip'] > 0
+    resp = app.response_class(page.gzip_body if use_gzip else page.body, mimetype=mimetype)
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.set_etag(page.etag + ('-gz' if use_gzip else ''))
+    resp.last_modified = page.last_modified
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+# Last rendered kiosk page, keyed on the IP address it shows.
+_index_page = None
+_index_page_lock = threading.Lock()
+
+
+def _get_index_page():
+    global _index_page
+    key = get_ip_address_cached()
+    page = _index_page
+    if page is not None and page.key == key:
+        return page
+    with _index_page_lock:
+        if _index_page is not None and _index_page.key == key:
+            return _index_page
+        # Members are not embedded in the page (the browser loads them from
+        # /members), so member changes never invalidate it.
+        body = render_template(
+            'index.html',
+            ip_address=key,
+            lartimmar_activities=LARTIMMAR_ACTIVITIES,
+        ).encode('utf-8')
+        _index_page = _render_page(key, body)
+        return _index_page
+
 
 @app.route('/')
 def index():
+    # Rendered once per IP address and revalidated by the
+    # browser, so reloads on the kiosk and phones are mostly 304s.
+    return _page_response(_get_index_page(), 'text/html')
+
+
+# Member changes sent as a delta by /members; more are sent as the full list.
+MEMBER_FEED_MAX_CHANGES = 500
+
+# Full member list for /members, rendered once per database and members generation.
+_member_list = None
+_member_list_lock = threading.Lock()
+
+
+def _get_member_list():
+    global _member_list
+    snapshot = member_index.snapshot()
+    page = _member_list
+    if page is not None and page.key == snapshot[:2]:
+        return page
+    with _member_list_lock:
+        if _member_list is None or _member_list.key != snapshot[:2]:
+            body = json.dumps({
+                'epoch': snapshot.epoch,
+                'generation': snapshot.generation,
+                'full': True,
+                'members': snapshot.members,
+                'removed': [],
+            }, ensure_ascii=False).encode('utf-8')
+            _member_list = _render_page(snapshot[:2], body)
+        return _member_list
+
+
+@app.route('/members')
+def members_feed():
+    # The kiosk page keeps the member list in localStorage and polls
+    # /members?since=<its generation>&epoch=<its db_epoch> every few
+    # seconds; usually nothing changed and the answer is a few bytes. A
+    # page without a usable generation, or whose list came from another
+    # database, gets the full list.
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch', type=int)
+    feed = member_index.changes_since(since, epoch) if since is not None else None
+    if feed is None:
+        return _page_response(_get_member_list(), 'application/json')
+    resp = jsonify({'full': False, **feed})
+    resp.cache_control.no_store = True
+    return resp
+
+
+# Upper bound for the `limit` parameter of /members/search.
+MEMBER_SEARCH_MAX_LIMIT = 50
+
+
+@app.route('/members/search')
+def search_members():
     # Local DB is the source of truth; sync_members keeps it up to date.
-    members = get_members_from_db()
-    ip_address = get_ip_address()
-    return render_template(
-        'index.html',
-        members=members,
-        ip_address=ip_address,
-        lartimmar_activities=LARTIMMAR_ACTIVITIES,
-    )
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', 8))
+    except ValueError:
+        limit = 8
+    limit = max(1, min(limit, MEMBER_SEARCH_MAX_LIMIT))
+    return jsonify({"members": member_index.search(query, limit=limit)})
+
+
+@app.route('/healthz')
+def healthz():
+    # Cheap readiness probe; also reports this worker's write-path counters.
+    with _write_stats_lock:
+        stats = dict(write_stats)
+    return jsonify({
+        "status": "ok",
+        "pid": os.getpid(),
+        "writes": stats,
+        "spool_depth": {
+            "checkins": spool_depth(DB_PATH),
+            "lartimmar": spool_depth(LARTIMMAR_DB_PATH),
+        },
+    })
+
+
+def _db_gauges():
+    """Gauges read from the databases at scrape time (same for every worker)."""
+    gauges = {}
+    for table, path in (('checkins', DB_PATH), ('lartimmar', LARTIMMAR_DB_PATH)):
+        labels = (('table', table),)
+        count, age = pending_export(path, table)
+        gauges[('kiosk_export_pending_rows', labels)] = count
+        gauges[('kiosk_export_oldest_pending_age_seconds', labels)] = age
+        gauges[('kiosk_spool_depth', labels)] = spool_depth(path)
+    conn = get_db(DB_PATH)
+    gauges[('kiosk_members', ())] = conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+    row = conn.execute("SELECT value FROM kiosk_meta WHERE key = 'members_last_import'").fetchone()
+    if row:
+        gauges[('kiosk_members_last_import_timestamp_seconds', ())] = row[0]
+    return gauges
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    body = metrics.render(*metrics.aggregate(extra_gauges=_db_gauges()))
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
+# Upper bound for the `top` parameter of /stats.
+STATS_MAX_TOP = 200
+
+
+@app.route('/stats')
+def stats():
+    # Read from the rollup tables (rollups.py); cost is per day/hour bucket,
+    # not per check-in.
+    period = request.args.get('period') or rollups.current_period()
+    try:
+        first, last = rollups.period_range(period)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Ogiltig period, ange ÅÅÅÅ eller ÅÅÅÅ-MM."}), 400
+    try:
+        top = int(request.args.get('top', 20))
+    except ValueError:
+        top = 20
+    top = max(0, min(top, STATS_MAX_TOP))
+    return jsonify({
+        "period": period,
+        "from": first,
+        "to": last,
+        "checkins": rollups.checkin_stats(get_db(DB_PATH), period, top=top),
+        "lartimmar": rollups.lartimmar_stats(get_db(LARTIMMAR_DB_PATH), period),
+    })
+
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    g.profile = profiling.start()
+
+
+@app.after_request
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.inc('kiosk_http_requests_total',
+                    {'route': route, 'method': request.method, 'status': str(response.status_code)})
+        metrics.observe('kiosk_http_request_duration_seconds', {'route': route},
+                        time.perf_counter() - started)
+        metrics.flush()
+    return response
+
+
+@app.teardown_request
+def _finish_profile(exc):
+    token = g.pop('profile', None)
+    if token is not None:
+        profiling.finish(token, 'request', f"{request.method} {request.path}")
 
 
 @app.route('/lartimmar', methods=['POST'])
@@ -159,28 +972,21 @@ def register_lartimmar():
 
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            conn = sqlite3.connect(LARTIMMAR_DB_PATH, timeout=30.0)
-            c = conn.cursor()
-            c.execute(
-                "INSERT INTO lartimmar (timestamp, aktivitet, namn, personnummer, antal_timmar, ledare) "
-                "VALUES (?, ?, ?, ?, ?, ?)",
-                (timestamp, aktivitet.strip(), namn.strip(), personnummer.strip(), timmar, 1 if ledare else 0),
-            )
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "message": f"Lärtimmar registrerade: {namn.strip()}"})
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e):
-                time.sleep(0.5)
-                continue
-            return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
-        except Exception as e:
-            return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
+    try:
+        save_row(LARTIMMAR_DB_PATH, 'lartimmar', {
+            'timestamp': timestamp,
+            'aktivitet': aktivitet.strip(),
+            'namn': namn.strip(),
+            'personnummer': personnummer.strip(),
+            'antal_timmar': timmar,
+            'ledare': 1 if ledare else 0,
+        })
+    except sqlite3.Error as e:
+        return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
 
-    return jsonify({"status": "error", "message": "Kunde inte spara till databasen (låst)."}), 500
+    return jsonify({"status": "success", "message": f"Lärtimmar registrerade: {namn.strip()}"})
 
 @app.route('/checkin', methods=['POST'])
 def checkin():
@@ -193,37 +999,27 @@ def checkin():
     name_clean = name.strip()
     if not name_clean:
         return jsonify({"status": "error", "message": "Inget namn skickades."}), 400
-    name_key = name_clean.casefold()
-
-    # Validate against the local DB only. sync_members keeps it fresh.
-    db_members = get_members_from_db()
-    member_keys = {m['name'].strip().casefold() for m in db_members if m.get('name')}
 
-    if name_key not in member_keys:
+    # Validate against the local DB only. sync_members keeps it fresh and the
+    # member index picks up its changes through the generation counter.
+    if not member_index.contains(name_clean):
         return jsonify({"status": "error", "message": "Namnet finns inte i listan."}), 400
 
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Retry loop for database lock
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            conn = sqlite3.connect(DB_PATH, timeout=30.0) # 30s timeout for slow systems
-            c = conn.cursor()
-            c.execute("INSERT INTO checkins (name, timestamp) VALUES (?, ?)", (name_clean, timestamp))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "message": f"Incheckad: {name_clean}"})
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e):
-                time.sleep(0.5) # Wait a bit before retrying
-                continue
-            else:
-                return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
-        except Exception as e:
-             return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
-             
-    return jsonify({"status": "error", "message": "Kunde inte spara till databasen (låst)."}), 500
+    # Bounded write: retries busy errors until WRITE_DEADLINE, then spools.
+    try:
+        save_row(DB_PATH, 'checkins', {
+            'name': name_clean,
+            'name_key': normalize_name(name_clean),
+            'timestamp': timestamp,
+        })
+    except sqlite3.Error as e:
+        return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
+
+    return jsonify({"status": "success", "message": f"Incheckad: {name_clean}"})
 
 @app.route('/checkin_guest', methods=['POST'])
 def checkin_guest():
@@ -241,50 +1037,47 @@ def checkin_guest():
     
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Retry loop for database lock
-    max_retries = 5
-    for attempt in range(max_retries):
+    try:
+        save_row(DB_PATH, 'checkins', {
+            'name': name.strip(),
+            'name_key': normalize_name(name),
+            'timestamp': timestamp,
+            'person_id': person_id.strip(),
+            'checkin_type': "engångsavgift",
+        })
+    except sqlite3.Error as e:
+        return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
+
+    return jsonify({"status": "success", "message": f"Gäst incheckad: {name}"})
+
+def _drain_all_spools():
+    # Spooled rows must reach SQLite before they can be exported.
+    for path in (DB_PATH, LARTIMMAR_DB_PATH):
         try:
-            conn = sqlite3.connect(DB_PATH, timeout=30.0) # 30s timeout for slow systems
-            c = conn.cursor()
-            c.execute("INSERT INTO checkins (name, timestamp, person_id, checkin_type) VALUES (?, ?, ?, ?)", 
-                      (name.strip(), timestamp, person_id.strip(), "engångsavgift"))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "message": f"Gäst incheckad: {name}"})
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e):
-                time.sleep(0.5)
-                continue
-            else:
-               return jsonify({"status": "error", "message": f"Databasfel: {e}"}), 500
+            drain_spool(path)
         except Exception as e:
-            return jsonify({"status": "error", "message": f"Okänt fel: {e}"}), 500
+            print(f"[Background] Spool drain for {os.path.basename(path)} failed: {e}")
 
-    return jsonify({"status": "error", "message": "Kunde inte spara till databasen (låst)."}), 500
 
 def background_sync_loop():
-    # Initial sleep to allow server startup and avoid immediate collision if multiple workers start
-    time.sleep(10) 
-    while True:
-        try:
-            # Run sync every 30 minutes (1800 seconds)
-            print("[Background] Starting sync...")
-            sync_members.import_members_from_sheet()
-            sync_members.export_new_rows()
-            sync_members.export_new_lartimmar()
-            print("[Background] Sync completed.")
-        except Exception as e:
-            print(f"[Background] Sync error: {e}")
-        
-        time.sleep(1800)
+    # Exports run when rows are waiting (woken by nudge_sync from the write
+    # routes), member import on its own interval; see sync_scheduler.py.
+    scheduler = ExportScheduler(
+        tables={'checkins': DB_PATH, 'lartimmar': LARTIMMAR_DB_PATH},
+        before_export=_drain_all_spools,
+    )
+    scheduler.run()
 
 # Start background sync thread
 # Only start in ONE worker to prevent duplicate exports
 # Use a marker file to claim the background sync role
 def try_claim_background_sync():
     import sys
-    marker_file_path = os.path.join(app.root_path, "background_sync.lock")
+    # Next to the databases, so a kiosk and a load test on throwaway
+    # databases (tools/loadtest.py) each get their own sync role.
+    marker_file_path = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "background_sync.lock")
     try:
         marker_file = open(marker_file_path, "w")
         # Try to acquire exclusive lock (non-blocking)
@@ -303,9 +1096,19 @@ def try_claim_background_sync():
         return False, None
 
 claimed, marker_file = (False, None)
-# Only start the background sync when explicitly enabled (e.g. by the
-# kiosk startup script). This keeps `import app` cheap for tests and CLIs.
-if os.environ.get("KIOSK_BG_SYNC", "").lower() in ("1", "true", "yes"):
+
+
+def start_background_sync():
+    """Start the sync thread in this process if enabled and not claimed elsewhere.
+
+    Only when explicitly enabled (KIOSK_BG_SYNC=1, e.g. by the kiosk
+    startup script). Under gunicorn this is called from the post_fork hook
+    in gunicorn.conf.py, so it runs in a worker and never in the preloading
+    master.
+    """
+    global claimed, marker_file
+    if os.environ.get("KIOSK_BG_SYNC", "").lower() not in ("1", "true", "yes"):
+        return
     claimed, marker_file = try_claim_background_sync()
     if claimed:
         print(f"[Worker {os.getpid()}] Starting background sync thread")
@@ -314,8 +1117,11 @@ if os.environ.get("KIOSK_BG_SYNC", "").lower() in ("1", "true", "yes"):
     else:
         print(f"[Worker {os.getpid()}] Background sync already claimed by another worker")
 
-# Run schema migrations at import time so gunicorn workers also stay in sync.
+
+# Schema setup runs once at import. gunicorn preloads the app
+# (gunicorn.conf.py), so that is once in the master before forking.
 init_db()
 
 if __name__ == '__main__':
+    start_background_sync()
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""Move old exported rows out of the hot tables into per-month archives.
+
+checkins and lartimmar only need the rows that are not yet in Google
+Sheets plus recent history. archive_table() moves rows that are exported
+(exported = 1) and older than KIOSK_ARCHIVE_AFTER_DAYS (default 90; 0
+disables archiving) into `<KIOSK_ARCHIVE_DIR>/<table>-YYYY-MM.db`, one
+SQLite file per table and month, with the same columns and ids. The
+export queries then only ever see a few months of rows.
+
+Rows are copied first and deleted from the hot table only once the copy
+has committed, in batches, so an interrupted run loses nothing and the
+next run simply continues. Ids are AUTOINCREMENT and never reused, so
+export keys stay unique. The attendance rollups (rollups.py) are not
+touched: they keep counting archived visits.
+
+Archive files are plain SQLite databases; open them with
+connect_readonly(), or ATTACH them read-only with attach_readonly().
+tools/view_checkins.py --archive reads them too.
+
+    python archive.py --dry-run
+    python archive.py --days 30
+"""
+import argparse
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.environ.get("KIOSK_ARCHIVE_DIR") or os.path.join(BASE_DIR, "archive")
+ARCHIVE_AFTER_DAYS = float(os.environ.get("KIOSK_ARCHIVE_AFTER_DAYS", "90"))
+# Rows moved per transaction; keeps the hot database's write lock short.
+ARCHIVE_BATCH_SIZE = 2000
+
+_ARCHIVE_NAME = re.compile(r"^(?P<table>[a-z_]+)-(?P<month>\d{4}-\d{2})\.db$")
+
+
+def archive_path(table, month, archive_dir=None):
+    return os.path.join(archive_dir or ARCHIVE_DIR, f"{table}-{month}.db")
+
+
+def archive_files(table, archive_dir=None, newest_first=True):
+    """[(month "YYYY-MM", path)] of the archive files of `table`."""
+    archive_dir = archive_dir or ARCHIVE_DIR
+    try:
+        names = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+    files = []
+    for name in names:
+        m = _ARCHIVE_NAME.match(name)
+        if m and m.group("table") == table:
+            files.append((m.group("month"), os.path.join(archive_dir, name)))
+    return sorted(files, reverse=newest_first)
+
+
+def _readonly_uri(path):
+    return f"file:{quote(os.path.abspath(path))}?mode=ro"
+
+
+def connect_readonly(path):
+    return sqlite3.connect(_readonly_uri(path), uri=True)
+
+
+def attach_readonly(conn, path, alias):
+    """ATTACH an archive file read-only as `alias`.
+
+    `conn` must have been opened with uri=True (e.g. by connect_readonly())
+    for SQLite to honour the read-only URI. SQLite attaches at most 10
+    databases by default, so attach months one at a time.
+    """
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (_readonly_uri(path),))
+
+
+def _month_after(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+
+def _prepare_archive(conn, table):
+    """Create (or widen) `archive.<table>` with the hot table's columns."""
+    columns = [(row[1], row[2]) for row in conn.execute(f"PRAGMA main.table_info({table})")]
+    existing = {row[1] for row in conn.execute(f"PRAGMA archive.table_info({table})")}
+    if not existing:
+        defs = ", ".join("id INTEGER PRIMARY KEY" if name == "id" else f"{name} {decl}"
+                         for name, decl in columns)
+        conn.execute(f"CREATE TABLE archive.{table} ({defs})")
+        conn.execute(f"CREATE INDEX archive.idx_{table}_timestamp ON {table}(timestamp)")
+    else:
+        # Columns added to the hot table by later migrations
+        for name, decl in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {decl}")
+    return [name for name, _ in columns]
+
+
+def archive_table(db_path, table, older_than_days=None, archive_dir=None, now=None,
+                  batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    """Move exported rows of `table` older than the cutoff into monthly archives.
+
+    Returns {month: rows moved} (rows that would move, with `dry_run`).
+    """
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    if days <= 0:
+        return {}
+    archive_dir = archive_dir or ARCHIVE_DIR
+    cutoff = ((now or datetime.now()) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    eligible = "exported = 1 AND timestamp IS NOT NULL AND timestamp < ?"
+
+    conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+    moved = {}
+    try:
+        months = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT substr(timestamp, 1, 7) FROM {table} WHERE {eligible}", (cutoff,)
+        )]
+        if dry_run:
+            for month in months:
+                moved[month] = conn.execute(
+                    f"SELECT COUNT(*) FROM {table} WHERE {eligible} AND timestamp >= ? AND timestamp < ?",
+                    (cutoff, month, _month_after(month)),
+                ).fetchone()[0]
+            return moved
+        if months:
+            os.makedirs(archive_dir, exist_ok=True)
+
+        for month in sorted(months):
+            in_month = f"{eligible} AND timestamp >= ? AND timestamp < ?"
+            params = (cutoff, month, _month_after(month))
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path(table, month, archive_dir),))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    columns = _prepare_archive(conn, table)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                column_sql = ", ".join(columns)
+                while True:
+                    ids = [row[0] for row in conn.execute(
+                        f"SELECT id FROM {table} WHERE {in_month} ORDER BY id LIMIT ?",
+                        params + (batch_size,),
+                    )]
+                    if not ids:
+                        break
+                    batch = f"{in_month} AND id BETWEEN ? AND ?"
+                    batch_params = params + (ids[0], ids[-1])
+                    # Copy and delete commit separately (a transaction over
+                    # two WAL databases is not atomic as a whole); the delete
+                    # only removes rows the archive is known to have.
+                    conn.execute(
+                        f"INSERT OR IGNORE INTO archive.{table} ({column_sql}) "
+                        f"SELECT {column_sql} FROM main.{table} WHERE {batch}",
+                        batch_params,
+                    )
+                    cursor = conn.execute(
+                        f"DELETE FROM main.{table} WHERE {batch} "
+                        f"AND id IN (SELECT id FROM archive.{table} WHERE id BETWEEN ? AND ?)",
+                        batch_params + (ids[0], ids[-1]),
+                    )
+                    moved[month] = moved.get(month, 0) + cursor.rowcount
+            finally:
+                conn.execute("DETACH DATABASE archive")
+    finally:
+        conn.close()
+    return moved
+
+
+def archive_tables(tables, **kwargs):
+    """archive_table() for each {table: db_path}; returns {table: {month: rows}}."""
+    return {table: archive_table(path, table, **kwargs) for table, path in tables.items()}
+
+
+if __name__ == "__main__":
+    DB_PATH = os.environ.get("APP_DB_PATH") or os.path.join(BASE_DIR, "checkins.db")
+    LARTIMMAR_DB_PATH = os.environ.get("LARTIMMAR_DB_PATH") or os.path.join(BASE_DIR, "lartimmar.db")
+
+    parser = argparse.ArgumentParser(description="Move old exported rows into monthly archive databases")
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS,
+                        help=f"Archive exported rows older than this many days (default {ARCHIVE_AFTER_DAYS:g})")
+    parser.add_argument("--dir", default=ARCHIVE_DIR, help=f"Archive directory (default {ARCHIVE_DIR})")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows that would move")
+    args = parser.parse_args()
+
+    result = archive_tables({"checkins": DB_PATH, "lartimmar": LARTIMMAR_DB_PATH},
+                            older_than_days=args.days, archive_dir=args.dir, dry_run=args.dry_run)
+    verb = "Would move" if args.dry_run else "Moved"
+    for table, months in result.items():
+        if not months:
+            print(f"{table}: nothing to archive")
+        for month, rows in sorted(months.items()):
+            print(f"{table}: {verb} {rows} rows to {archive_path(table, month, args.dir)}")
@@ -130,7 +130,7 @@ echo "Gunicorn PID: $GUNICORN_PID" >> "$LOGFILE"
 # 5. Vänta på att servern är REDO (inte bara 20 sek)
 echo "Waiting for server..." >> "$LOGFILE"
 for i in {1..60}; do
-    if curl -s http://127.0.0.1:5000 > /dev/null 2>&1; then
+    if curl -sf http://127.0.0.1:5000/healthz > /dev/null 2>&1; then
         echo "Server ready after $i seconds" >> "$LOGFILE"
         break
     fi
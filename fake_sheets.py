@@ -0,0 +1,239 @@
+"""In-memory stand-in for the parts of gspread that sync_members.py uses.
+
+Lets the sync code run without a spreadsheet or credentials.json, for
+tools/bench_sync.py, tests and local development. Every call can be
+slowed down (simulated network latency), counted, rejected with a quota
+error or failed at random; appends to a worksheet can also be refused
+once it is full or applied with their response lost. With `path` the sheets are loaded from and
+saved to a JSON file, so the data survives between runs.
+
+Select it for sync_members with KIOSK_SHEETS_BACKEND=fake (see
+backend_from_env() for the other settings).
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+
+
+class FakeQuotaError(Exception):
+    """Raised like Google's HTTP 429 when the per-minute quota is used up."""
+
+
+class FakeAPIError(Exception):
+    """Raised for a simulated transient failure (HTTP 5xx / dropped connection)."""
+
+
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSheetsBackend:
+    """Shared state and fault injection for every fake client it hands out.
+
+    `latency` and `jitter` are seconds added to every API call,
+    `quota_per_minute` caps calls in any 60 s window and `failure_rate`
+    is the probability that a call fails with FakeAPIError.
+
+    Per worksheet title, `max_rows[title]` makes appends fail with
+    FakeAPIError once the sheet holds that many rows, and
+    `lose_responses[title]` is the number of upcoming appends that are
+    applied but still raise, like a request whose response never arrived.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, quota_per_minute=None,
+                 failure_rate=0.0, seed=None, path=None, clock=time.monotonic):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_per_minute = quota_per_minute
+        self.failure_rate = failure_rate
+        self.path = path
+        self.clock = clock
+        self.calls = Counter()
+        self.errors = Counter()
+        self.max_rows = {}
+        self.lose_responses = Counter()
+        self.sheets = {}
+        self._random = random.Random(seed)
+        self._recent = deque()
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.sheets = json.load(f)
+
+    def client(self):
+        return FakeClient(self)
+
+    def set_rows(self, title, rows):
+        """Replace the contents of worksheet `title` (creating it) without counting a call."""
+        with self._lock:
+            self.sheets[title] = [[str(c) for c in r] for r in rows]
+            self._save()
+
+    def rows(self, title):
+        with self._lock:
+            return [list(r) for r in self.sheets.get(title, [])]
+
+    def api_call(self, name):
+        """Account for one API request: latency, quota and random failures."""
+        with self._lock:
+            self.calls[name] += 1
+            now = self.clock()
+            if self.quota_per_minute is not None:
+                while self._recent and now - self._recent[0] >= 60:
+                    self._recent.popleft()
+                if len(self._recent) >= self.quota_per_minute:
+                    self.errors["quota"] += 1
+                    raise FakeQuotaError(f"429 Quota exceeded ({self.quota_per_minute} requests per minute)")
+                self._recent.append(now)
+            fail = self.failure_rate and self._random.random() < self.failure_rate
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        # Sleep outside the lock so concurrent callers overlap like real requests
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors["failure"] += 1
+            raise FakeAPIError(f"503 Simulated backend error in {name}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.sheets, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+class FakeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open(self, name):
+        self.backend.api_call("open")
+        return FakeSpreadsheet(self.backend, name)
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.title = name
+
+    @property
+    def sheet1(self):
+        with self.backend._lock:
+            titles = list(self.backend.sheets)
+        if not titles:
+            raise gspread.WorksheetNotFound("sheet1")
+        return FakeWorksheet(self.backend, titles[0])
+
+    def worksheet(self, title):
+        self.backend.api_call("worksheet")
+        with self.backend._lock:
+            if title not in self.backend.sheets:
+                raise gspread.WorksheetNotFound(title)
+        return FakeWorksheet(self.backend, title)
+
+    def add_worksheet(self, title, rows=1000, cols=10):
+        self.backend.api_call("add_worksheet")
+        with self.backend._lock:
+            self.backend.sheets.setdefault(title, [])
+            self.backend._save()
+        return FakeWorksheet(self.backend, title)
+
+
+class FakeWorksheet:
+    def __init__(self, backend, title):
+        self.backend = backend
+        self.title = title
+
+    def _rows(self):
+        return self.backend.sheets[self.title]
+
+    def _write(self, change):
+        with self.backend._lock:
+            change(self._rows())
+            self.backend._save()
+
+    def get_all_values(self):
+        self.backend.api_call("get_all_values")
+        return self.backend.rows(self.title)
+
+    def row_values(self, row):
+        self.backend.api_call("row_values")
+        rows = self.backend.rows(self.title)
+        return rows[row - 1] if len(rows) >= row else []
+
+    def col_values(self, col):
+        self.backend.api_call("col_values")
+        return [r[col - 1] if len(r) >= col else "" for r in self.backend.rows(self.title)]
+
+    def acell(self, label):
+        self.backend.api_call("acell")
+        rows = self.backend.rows(self.title)
+        # Only column letters A-Z are needed by the callers.
+        col = ord(label[0].upper()) - ord("A")
+        row = int(label[1:]) - 1
+        value = rows[row][col] if row < len(rows) and col < len(rows[row]) else None
+        return FakeCell(value or None)
+
+    def update_cell(self, row, col, value):
+        self.backend.api_call("update_cell")
+
+        def change(rows):
+            while len(rows) < row:
+                rows.append([])
+            cells = rows[row - 1]
+            cells.extend([""] * (col - len(cells)))
+            cells[col - 1] = str(value)
+        self._write(change)
+
+    def insert_row(self, values, index=1):
+        self.backend.api_call("insert_row")
+        self._write(lambda rows: rows.insert(index - 1, [str(v) for v in values]))
+
+    def _append(self, name, values):
+        self.backend.api_call(name)
+        backend = self.backend
+        with backend._lock:
+            limit = backend.max_rows.get(self.title)
+            if limit is not None and len(self._rows()) >= limit:
+                backend.errors["full"] += 1
+                raise FakeAPIError(f"503 Simulated error appending to full sheet {self.title}")
+            self._write(lambda rows: rows.extend([str(v) for v in r] for r in values))
+            if backend.lose_responses[self.title]:
+                backend.lose_responses[self.title] -= 1
+                backend.errors["lost_response"] += 1
+                raise FakeAPIError(f"504 Simulated timeout in {name}; the rows were appended")
+
+    def append_row(self, values):
+        self._append("append_row", [values])
+
+    def append_rows(self, values):
+        self._append("append_rows", values)
+
+
+_env_backend = None
+
+
+def backend_from_env():
+    """The process-wide backend configured by environment variables.
+
+    KIOSK_FAKE_SHEETS_PATH (JSON file to persist to), KIOSK_FAKE_SHEETS_LATENCY_MS,
+    KIOSK_FAKE_SHEETS_QUOTA (requests per minute) and KIOSK_FAKE_SHEETS_FAILURE_RATE.
+    """
+    global _env_backend
+    if _env_backend is None:
+        quota = os.environ.get("KIOSK_FAKE_SHEETS_QUOTA")
+        _env_backend = FakeSheetsBackend(
+            latency=float(os.environ.get("KIOSK_FAKE_SHEETS_LATENCY_MS", "0")) / 1000.0,
+            quota_per_minute=int(quota) if quota else None,
+            failure_rate=float(os.environ.get("KIOSK_FAKE_SHEETS_FAILURE_RATE", "0")),
+            path=os.environ.get("KIOSK_FAKE_SHEETS_PATH") or None,
+        )
+    return _env_backend
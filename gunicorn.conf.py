@@ -0,0 +1,20 @@
+"""gunicorn settings for the kiosk (picked up from the working directory).
+
+The app is imported once in the master and the workers are forked from
+it: schema setup (app.init_db) runs once instead of in every worker, and
+the workers share the master's imported code copy-on-write. The Google
+Sheets code is not imported by app.py at all; only the worker that
+claims the background sync loads it, lazily, in sync_scheduler.
+
+Bind address and worker count stay on the command line in
+start_kiosk.sh / autostart_openbox.sh.
+"""
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Threads do not survive fork, so the sync thread is started per
+    # worker; the file lock in try_claim_background_sync picks one.
+    import app
+
+    app.start_background_sync()
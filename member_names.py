@@ -0,0 +1,28 @@
+"""Member name normalization shared by app.py and sync_members.py.
+
+Check-in validation and the export join must agree on when two names are
+"the same", so both compare the stored `name_key` column produced here.
+"""
+import unicodedata
+
+
+def normalize_name(name):
+    """Canonical comparison key for a member name.
+
+    NFC-normalizes (so a decomposed "ö" equals a precomposed one), trims,
+    collapses internal whitespace and casefolds.
+    """
+    if name is None:
+        return None
+    collapsed = " ".join(unicodedata.normalize("NFC", name).split())
+    return unicodedata.normalize("NFC", collapsed.casefold())
+
+
+def member_identity(name, year_of_birth):
+    """Fallback member id for sheets without an id column: name + year of birth."""
+    return f"{normalize_name(name)}|{(year_of_birth or '').strip()}"
+
+
+def register_sql_functions(conn):
+    """Expose normalize_name() to SQL on `conn` (used to backfill name_key)."""
+    conn.create_function("normalize_name", 1, normalize_name, deterministic=True)
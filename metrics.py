@@ -0,0 +1,329 @@
+"""Prometheus-style metrics shared across the gunicorn workers.
+
+Each worker keeps its counters, gauges and histograms in memory and
+writes them as a JSON snapshot (`<pid>.json`) to a shared directory at
+most once a second. `/metrics` merges the snapshots of all live workers
+(counters and histograms are summed, gauges take the highest value) and
+renders them in the Prometheus text format. When a worker has exited,
+its counters and histograms are folded into `_retired.json` before its
+snapshot is removed, so totals never go down when gunicorn replaces a
+worker; its gauges are dropped.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; request latencies on the kiosk are normally a few ms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 1.0
+
+HELP = {
+    "kiosk_http_requests_total": "HTTP requests by route, method and status.",
+    "kiosk_http_request_duration_seconds": "HTTP request latency by route.",
+    "kiosk_sqlite_lock_retries_total": "Writes retried because SQLite was locked.",
+    "kiosk_sqlite_lock_wait_seconds_total": "Time writes spent waiting on SQLite locks.",
+    "kiosk_write_deadline_misses_total": "Writes that missed the deadline and were spooled.",
+    "kiosk_write_spooled_rows_total": "Rows appended to the write spool.",
+    "kiosk_spool_drained_rows_total": "Spooled rows later written to SQLite.",
+    "kiosk_spool_rejected_rows_total": "Spooled rows that could not be inserted and were set aside.",
+    "kiosk_spool_depth": "Rows waiting in the write spool.",
+    "kiosk_export_pending_rows": "Rows not yet exported to Google Sheets.",
+    "kiosk_export_oldest_pending_age_seconds": "Age of the oldest row not yet exported.",
+    "kiosk_members": "Members in the local database.",
+    "kiosk_members_last_import_timestamp_seconds": "Unix time of the last successful member import.",
+    "kiosk_sync_phase_duration_seconds": "Duration of each job in the last sync cycle.",
+    "kiosk_sync_last_cycle_timestamp_seconds": "Unix time the last sync cycle finished.",
+    "kiosk_metrics_workers": "Workers whose metrics are included.",
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_collectors = []
+_snapshot_dir = None
+_last_flush = 0.0
+_timer_pid = None
+# Start time per pid, so a snapshot names its worker even if the pid is reused
+_started = {}
+RETIRED_FILE = "_retired.json"
+# Worker ids remembered in the retired file, to skip a snapshot folded just
+# before a crash kept it from being removed
+RETIRED_KEEP_IDS = 200
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def configure(snapshot_dir):
+    """Enable snapshots in `snapshot_dir` (shared by all workers)."""
+    global _snapshot_dir
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _snapshot_dir = snapshot_dir
+
+
+def register_collector(fn):
+    """`fn()` returns {(name, labels-tuple): value} counters added at snapshot time."""
+    _collectors.append(fn)
+
+
+def inc(name, labels=None, value=1):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, labels=None, value=0):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, labels, seconds, buckets=LATENCY_BUCKETS):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+def snapshot():
+    counters = {}
+    for fn in _collectors:
+        for key, value in fn().items():
+            counters[key] = counters.get(key, 0) + value
+    with _lock:
+        for key, value in _counters.items():
+            counters[key] = counters.get(key, 0) + value
+        return {
+            "pid": os.getpid(),
+            "worker": f"{os.getpid()}-{_started.setdefault(os.getpid(), time.time())}",
+            "counters": [[n, dict(l), v] for (n, l), v in counters.items()],
+            "gauges": [[n, dict(l), v] for (n, l), v in _gauges.items()],
+            "histograms": [[n, dict(l), dict(h, buckets=list(h["buckets"]))]
+                           for (n, l), h in _histograms.items()],
+        }
+
+
+def _delayed_flush():
+    global _timer_pid
+    with _lock:
+        _timer_pid = None
+    flush(force=True)
+
+
+def flush(force=False):
+    """Write this worker's snapshot, at most once per FLUSH_INTERVAL unless forced.
+
+    A throttled call schedules a flush for later, so the last requests
+    before a worker goes idle are not left out.
+    """
+    global _last_flush, _timer_pid
+    if _snapshot_dir is None:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        with _lock:
+            if _timer_pid == os.getpid():
+                return
+            _timer_pid = os.getpid()
+        timer = threading.Timer(FLUSH_INTERVAL, _delayed_flush)
+        timer.daemon = True
+        timer.start()
+        return
+    _last_flush = now
+    path = os.path.join(_snapshot_dir, f"{os.getpid()}.json")
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[Worker {os.getpid()}] Could not write metrics snapshot: {e}")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshots():
+    snapshots = []
+    if _snapshot_dir is None:
+        return [snapshot()]
+    dead = []
+    for fn in os.listdir(_snapshot_dir):
+        if not fn.endswith(".json"):
+            continue
+        path = os.path.join(_snapshot_dir, fn)
+        try:
+            pid = int(fn[:-5])
+        except ValueError:
+            continue
+        if pid == os.getpid():
+            continue
+        if not _pid_alive(pid):
+            dead.append(path)
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    if dead:
+        _retire(dead)
+    # Our own numbers live, not from the last flush
+    snapshots.append(snapshot())
+    return snapshots
+
+
+@contextmanager
+def _file_lock(lock_path):
+    with open(lock_path, "a") as lock_file:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if sys.platform == "win32":
+                import msvcrt
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _read_retired():
+    try:
+        with open(os.path.join(_snapshot_dir, RETIRED_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"workers": [], "counters": [], "gauges": [], "histograms": []}
+
+
+def _retire(paths):
+    """Fold exited workers' snapshots into the retired totals, then remove them."""
+    retired_path = os.path.join(_snapshot_dir, RETIRED_FILE)
+    # Every worker serving /metrics may find the same dead snapshot
+    with _file_lock(retired_path + ".lock"):
+        retired = _read_retired()
+        folded = []
+        for path in paths:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snap = json.load(f)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                snap = None
+            if snap is not None and snap.get("worker") not in retired["workers"]:
+                counters, _, histograms = _merge([retired, snap])
+                retired = {
+                    "workers": (retired["workers"] + [snap.get("worker")])[-RETIRED_KEEP_IDS:],
+                    "counters": [[n, dict(l), v] for (n, l), v in counters.items()],
+                    "gauges": [],
+                    "histograms": [[n, dict(l), h] for (n, l), h in histograms.items()],
+                }
+            folded.append(path)
+        tmp = retired_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(retired, f)
+            os.replace(tmp, retired_path)
+        except OSError as e:
+            print(f"[Worker {os.getpid()}] Could not write retired metrics: {e}")
+            return
+        for path in folded:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _merge(snapshots):
+    counters, gauges, histograms = {}, {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap["counters"]:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snap["gauges"]:
+            key = _key(name, labels)
+            gauges[key] = max(gauges.get(key, value), value)
+        for name, labels, hist in snap["histograms"]:
+            key = _key(name, labels)
+            merged = histograms.setdefault(key, {"buckets": [0] * len(hist["buckets"]), "sum": 0.0, "count": 0})
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], hist["buckets"])]
+            merged["sum"] += hist["sum"]
+            merged["count"] += hist["count"]
+    return counters, gauges, histograms
+
+
+def aggregate(extra_gauges=None):
+    """Merge the live workers' snapshots and the retired totals into ({counters}, {gauges}, {histograms})."""
+    snapshots = _read_snapshots()
+    sources = snapshots if _snapshot_dir is None else snapshots + [_read_retired()]
+    counters, gauges, histograms = _merge(sources)
+    for key, value in (extra_gauges or {}).items():
+        gauges[key] = value
+    gauges[_key("kiosk_metrics_workers", None)] = len(snapshots)
+    return counters, gauges, histograms
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(counters, gauges, histograms, buckets=LATENCY_BUCKETS):
+    """Prometheus text exposition format (version 0.0.4)."""
+    by_name = {}
+    for kind, series in (("counter", counters), ("gauge", gauges), ("histogram", histograms)):
+        for (name, labels), value in series.items():
+            by_name.setdefault(name, (kind, []))[1].append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, series = by_name[name]
+        help_text = HELP.get(name, name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(series):
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            # Already cumulative: observe() counts a value in every bucket it fits
+            for bound, count in zip(buckets, value["buckets"]):
+                lines.append(f"{name}_bucket{_labels(labels, [('le', _number(bound))])} {count}")
+            lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,411 @@
+"""Versioned schema migrations for checkins.db and lartimmar.db.
+
+Each database stores how many migrations it has had in `PRAGMA
+user_version`. migrate() applies the missing ones in order, each in one
+transaction together with its version bump, so an interrupted upgrade
+leaves the database at a consistent version and is resumed next start.
+Once a database is current, ensure_*_db() costs a stat() of the file.
+
+Databases from before the versioning (user_version 0, created by the old
+ensure_* functions in app.py and sync_members.py) may already have any
+part of the schema, so the early migrations only add what is missing.
+New schema changes go at the end of the lists below as new functions;
+never edit a migration that has shipped.
+"""
+import os
+import sqlite3
+
+from member_names import register_sql_functions
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _create_checkins_and_members(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS checkins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            timestamp TEXT,
+            exported INTEGER DEFAULT 0,
+            person_id TEXT,
+            checkin_type TEXT
+        )
+        """
+    )
+    _add_missing_columns(conn, "checkins", [
+        ("exported", "INTEGER DEFAULT 0"),
+        ("person_id", "TEXT"),
+        ("checkin_type", "TEXT"),
+    ])
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            year_of_birth TEXT,
+            avgiftstyp TEXT,
+            sheet_id TEXT,
+            last_updated TEXT
+        )
+        """
+    )
+    _add_missing_columns(conn, "members", [
+        ("year_of_birth", "TEXT"),
+        ("avgiftstyp", "TEXT"),
+        ("sheet_id", "TEXT"),
+        ("last_updated", "TEXT"),
+    ])
+
+
+def _add_name_keys(conn):
+    # Normalized name keys (member_names.normalize_name) join check-ins to
+    # members through an index. Writers fill them in from here on; rows
+    # written before the column existed are backfilled once.
+    _add_missing_columns(conn, "checkins", [("name_key", "TEXT")])
+    _add_missing_columns(conn, "members", [("name_key", "TEXT")])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_name_key ON checkins(name_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_members_name_key ON members(name_key)")
+    register_sql_functions(conn)
+    conn.execute("UPDATE checkins SET name_key = normalize_name(name) WHERE name_key IS NULL AND name IS NOT NULL")
+    conn.execute("UPDATE members SET name_key = normalize_name(name) WHERE name_key IS NULL")
+
+
+def _add_members_generation(conn):
+    # Bumped by triggers on every change to `members`, so the kiosk workers
+    # can cheaply tell whether their cached member index is stale
+    # (app.MemberIndex).
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS kiosk_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute("INSERT OR IGNORE INTO kiosk_meta (key, value) VALUES ('members_generation', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS members_generation_{event.lower()}
+            AFTER {event} ON members BEGIN
+                UPDATE kiosk_meta SET value = value + 1 WHERE key = 'members_generation';
+            END
+            """
+        )
+
+
+def _add_sync_log(conn):
+    # Sync events buffered until sync_members.flush_sync_log() sends them.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            action TEXT,
+            target TEXT,
+            rows INTEGER,
+            status TEXT,
+            note TEXT
+        )
+        """
+    )
+
+
+def _add_checkin_rollups(conn):
+    # Attendance rollups (see rollups.py), kept current by insert triggers so
+    # every write path (direct, group commit, spool drain) updates them.
+    # Deleting check-ins does not change them: they count every visit ever
+    # recorded. Member check-ins have no checkin_type and count as "medlem".
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            checkin_type TEXT NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour, checkin_type)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_member_monthly (
+            month TEXT NOT NULL,
+            name_key TEXT NOT NULL,
+            name TEXT,
+            visits INTEGER NOT NULL DEFAULT 0,
+            last_visit TEXT,
+            PRIMARY KEY (month, name_key)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS checkins_rollup_insert
+        AFTER INSERT ON checkins WHEN NEW.timestamp IS NOT NULL BEGIN
+            INSERT INTO stats_hourly (day, hour, checkin_type, visits)
+            VALUES (substr(NEW.timestamp, 1, 10), CAST(substr(NEW.timestamp, 12, 2) AS INTEGER),
+                    COALESCE(NEW.checkin_type, 'medlem'), 1)
+            ON CONFLICT (day, hour, checkin_type) DO UPDATE SET visits = visits + 1;
+            INSERT INTO stats_member_monthly (month, name_key, name, visits, last_visit)
+            SELECT substr(NEW.timestamp, 1, 7), NEW.name_key, NEW.name, 1, NEW.timestamp
+            WHERE NEW.checkin_type IS NULL AND NEW.name_key IS NOT NULL
+            ON CONFLICT (month, name_key) DO UPDATE SET
+                visits = visits + 1, name = excluded.name,
+                last_visit = MAX(last_visit, excluded.last_visit);
+        END
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO stats_hourly (day, hour, checkin_type, visits)
+        SELECT substr(timestamp, 1, 10), CAST(substr(timestamp, 12, 2) AS INTEGER),
+               COALESCE(checkin_type, 'medlem'), COUNT(*)
+        FROM checkins WHERE timestamp IS NOT NULL
+        GROUP BY 1, 2, 3
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO stats_member_monthly (month, name_key, name, visits, last_visit)
+        SELECT substr(timestamp, 1, 7), name_key, MAX(name), COUNT(*), MAX(timestamp)
+        FROM checkins
+        WHERE timestamp IS NOT NULL AND checkin_type IS NULL AND name_key IS NOT NULL
+        GROUP BY 1, 2
+        """
+    )
+
+
+def _add_checkin_browse_indexes(conn):
+    # Date-range filters and the per-status summary in tools/view_checkins.py
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_timestamp ON checkins(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_exported ON checkins(exported)")
+
+
+def _add_export_leases(conn, table):
+    # exported = 2 rows belong to export batch `export_batch` until
+    # `lease_until` (unix time); see sync_members.claim_export_chunk().
+    _add_missing_columns(conn, table, [("export_batch", "TEXT"), ("lease_until", "REAL")])
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_export_batch ON {table}(export_batch) "
+                 "WHERE export_batch IS NOT NULL")
+
+
+def _add_checkin_export_leases(conn):
+    _add_export_leases(conn, "checkins")
+
+
+def _add_spool_ids(conn, table):
+    # Rows drained from the write spool carry the id their spool line was
+    # written with, so replaying a spool file after a crash inserts nothing
+    # twice (app.drain_spool).
+    _add_missing_columns(conn, table, [("spool_id", "TEXT")])
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_spool_id ON {table}(spool_id) "
+                 "WHERE spool_id IS NOT NULL")
+
+
+def _add_checkin_spool_ids(conn):
+    _add_spool_ids(conn, "checkins")
+
+
+def _add_member_changes(conn):
+    # One row per change to `members`, keyed on the generation it produced,
+    # so /members?since=<generation> can send the kiosk page only what
+    # changed (app.member_feed). Rows that are gone from `members` were
+    # removed. Older entries are pruned by sync_members.prune_member_changes;
+    # clients behind `member_changes_floor` get the full list instead.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS member_changes (
+            generation INTEGER PRIMARY KEY,
+            member_id INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO kiosk_meta (key, value) "
+        "SELECT 'member_changes_floor', value FROM kiosk_meta WHERE key = 'members_generation'"
+    )
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        conn.execute(f"DROP TRIGGER IF EXISTS members_generation_{event.lower()}")
+        conn.execute(
+            f"""
+            CREATE TRIGGER members_generation_{event.lower()}
+            AFTER {event} ON members BEGIN
+                UPDATE kiosk_meta SET value = value + 1 WHERE key = 'members_generation';
+                INSERT OR REPLACE INTO member_changes (generation, member_id)
+                SELECT value, {row}.id FROM kiosk_meta WHERE key = 'members_generation';
+            END
+            """
+        )
+
+
+def _add_db_epoch(conn):
+    # Random per database, so a kiosk page holding a member list from another
+    # (or a recreated) checkins.db resyncs instead of applying deltas to it.
+    # Kept below 2**53 so JavaScript compares it exactly.
+    conn.execute(
+        "INSERT OR IGNORE INTO kiosk_meta (key, value) VALUES ('db_epoch', random() & 9007199254740991)"
+    )
+
+
+def _create_lartimmar(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS lartimmar (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            aktivitet TEXT,
+            namn TEXT,
+            personnummer TEXT,
+            antal_timmar REAL,
+            ledare INTEGER DEFAULT 0,
+            exported INTEGER DEFAULT 0
+        )
+        """
+    )
+    _add_missing_columns(conn, "lartimmar", [("exported", "INTEGER DEFAULT 0")])
+
+
+def _add_lartimmar_rollups(conn):
+    # Hours per day and activity, maintained like _add_checkin_rollups().
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_lartimmar_daily (
+            day TEXT NOT NULL,
+            aktivitet TEXT NOT NULL,
+            entries INTEGER NOT NULL DEFAULT 0,
+            hours REAL NOT NULL DEFAULT 0,
+            leader_entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, aktivitet)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS lartimmar_rollup_insert
+        AFTER INSERT ON lartimmar WHEN NEW.timestamp IS NOT NULL BEGIN
+            INSERT INTO stats_lartimmar_daily (day, aktivitet, entries, hours, leader_entries)
+            VALUES (substr(NEW.timestamp, 1, 10), COALESCE(NEW.aktivitet, ''), 1,
+                    COALESCE(NEW.antal_timmar, 0), CASE WHEN NEW.ledare THEN 1 ELSE 0 END)
+            ON CONFLICT (day, aktivitet) DO UPDATE SET
+                entries = entries + 1,
+                hours = hours + excluded.hours,
+                leader_entries = leader_entries + excluded.leader_entries;
+        END
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO stats_lartimmar_daily (day, aktivitet, entries, hours, leader_entries)
+        SELECT substr(timestamp, 1, 10), COALESCE(aktivitet, ''), COUNT(*),
+               COALESCE(SUM(antal_timmar), 0), SUM(CASE WHEN ledare THEN 1 ELSE 0 END)
+        FROM lartimmar WHERE timestamp IS NOT NULL
+        GROUP BY 1, 2
+        """
+    )
+
+
+def _add_lartimmar_browse_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lartimmar_timestamp ON lartimmar(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lartimmar_exported ON lartimmar(exported)")
+
+
+def _add_lartimmar_export_leases(conn):
+    _add_export_leases(conn, "lartimmar")
+
+
+def _add_lartimmar_spool_ids(conn):
+    _add_spool_ids(conn, "lartimmar")
+
+
+CHECKINS_MIGRATIONS = [
+    _create_checkins_and_members,
+    _add_name_keys,
+    _add_members_generation,
+    _add_sync_log,
+    _add_checkin_rollups,
+    _add_checkin_browse_indexes,
+    _add_checkin_export_leases,
+    _add_member_changes,
+    _add_checkin_spool_ids,
+    _add_db_epoch,
+]
+
+LARTIMMAR_MIGRATIONS = [
+    _create_lartimmar,
+    _add_lartimmar_rollups,
+    _add_lartimmar_browse_indexes,
+    _add_lartimmar_export_leases,
+    _add_lartimmar_spool_ids,
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path, migrations, timeout=30.0):
+    """Apply the migrations `path` has not had yet and return its version.
+
+    Safe to run from several processes at once: each step takes the write
+    lock and re-reads the version before applying anything. A database
+    with a newer version than `migrations` knows (the code was rolled
+    back) is left alone; migrations only ever add to the schema.
+    """
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    try:
+        version = schema_version(conn)
+        while version < len(migrations):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = schema_version(conn)
+                if version < len(migrations):
+                    migrations[version](conn)
+                    version += 1
+                    conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return version
+    finally:
+        conn.close()
+
+
+# abspath -> (st_dev, st_ino) of database files this process has migrated.
+# Keyed on the file identity so a database that is deleted and recreated
+# (tests, a reset kiosk) is migrated again.
+_migrated = {}
+
+
+def _file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def _ensure(path, migrations):
+    key = os.path.abspath(path)
+    file_id = _file_id(path)
+    if file_id is not None and _migrated.get(key) == file_id:
+        return
+    migrate(path, migrations)
+    _migrated[key] = _file_id(path)
+
+
+def ensure_checkins_db(path):
+    """Bring checkins.db (check-ins, members, kiosk_meta, sync_log) up to date."""
+    _ensure(path, CHECKINS_MIGRATIONS)
+
+
+def ensure_lartimmar_db(path):
+    """Bring lartimmar.db up to date."""
+    _ensure(path, LARTIMMAR_MIGRATIONS)
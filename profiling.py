@@ -0,0 +1,99 @@
+"""Opt-in cProfile capture of slow requests and sync jobs.
+
+Enabled with KIOSK_PROFILE=1. Every Flask request and sync job then runs
+under cProfile, and those that take at least KIOSK_PROFILE_MIN_MS
+(default 200) are written to KIOSK_PROFILE_DIR (default ./profiles) as
+`<kind>__<name>__<unix ms>__<pid>__<duration ms>.prof`. Only the newest
+KIOSK_PROFILE_KEEP (default 200) files are kept. Summarize them with
+tools/profile_summary.py.
+
+cProfile only sees the thread that started it, and on Python 3.12+ only
+one profiler can run at a time; a request that overlaps another
+profiled one is simply not profiled.
+"""
+import cProfile
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILE_ENABLED = os.environ.get("KIOSK_PROFILE") == "1"
+PROFILE_DIR = os.environ.get("KIOSK_PROFILE_DIR") or os.path.join(BASE_DIR, "profiles")
+PROFILE_MIN_MS = float(os.environ.get("KIOSK_PROFILE_MIN_MS", "200"))
+PROFILE_KEEP = int(os.environ.get("KIOSK_PROFILE_KEEP", "200"))
+
+_rotate_lock = threading.Lock()
+
+
+def _safe(name):
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_") or "root"
+
+
+def parse_profile_name(filename):
+    """(kind, name, unix ms, pid, duration ms) from a profile file name, or None."""
+    parts = os.path.basename(filename)[:-len(".prof")].split("__")
+    if len(parts) != 5 or not filename.endswith(".prof"):
+        return None
+    kind, name, stamp, pid, duration = parts
+    try:
+        return kind, name, int(stamp), int(pid), float(duration)
+    except ValueError:
+        return None
+
+
+def _rotate():
+    with _rotate_lock:
+        try:
+            files = [f for f in os.listdir(PROFILE_DIR) if f.endswith(".prof")]
+        except OSError:
+            return
+        by_age = sorted(files, key=lambda f: (parse_profile_name(f) or ("", "", 0))[2])
+        for old in by_age[:max(0, len(by_age) - PROFILE_KEEP)]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old))
+            except OSError:
+                pass
+
+
+def start():
+    """Start profiling this thread; returns a token for finish(), or None."""
+    if not PROFILE_ENABLED:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active (Python 3.12+ allows only one)
+        return None
+    return profiler, time.perf_counter()
+
+
+def finish(token, kind, name):
+    """Stop profiling and save the profile if it ran for at least PROFILE_MIN_MS."""
+    if token is None:
+        return
+    profiler, started = token
+    profiler.disable()
+    elapsed_ms = (time.perf_counter() - started) * 1000.0
+    if elapsed_ms < PROFILE_MIN_MS:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = (f"{_safe(kind)}__{_safe(name)}__{int(time.time() * 1000)}__"
+                    f"{os.getpid()}__{elapsed_ms:.0f}.prof")
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        _rotate()
+    except OSError as e:
+        print(f"[Profile] Could not save profile for {kind} {name}: {e}")
+
+
+@contextmanager
+def profiled(kind, name):
+    token = start()
+    try:
+        yield
+    finally:
+        finish(token, kind, name)
@@ -0,0 +1,101 @@
+"""Attendance statistics read from the rollup tables.
+
+The tables are created and kept current by triggers (see
+migrations._add_checkin_rollups / _add_lartimmar_rollups), so every
+query here reads at most one row per day, hour and type, or per member
+and month. They never scan the check-ins themselves. Used by the /stats
+endpoint in app.py and by tools/stats.py.
+
+Periods are "YYYY" or "YYYY-MM"; member totals are only kept per month,
+so shorter periods are not supported.
+"""
+import calendar
+import re
+from datetime import date
+
+PERIOD_RE = re.compile(r"^(\d{4})(?:-(0[1-9]|1[0-2]))?$")
+
+
+def period_range(period):
+    """("YYYY-MM-DD" first day, "YYYY-MM-DD" last day) of "YYYY" or "YYYY-MM".
+
+    Raises ValueError for anything else.
+    """
+    m = PERIOD_RE.match(period or "")
+    if not m:
+        raise ValueError(f"Invalid period {period!r}, expected YYYY or YYYY-MM")
+    year = int(m.group(1))
+    if m.group(2):
+        month = int(m.group(2))
+        last = calendar.monthrange(year, month)[1]
+        return date(year, month, 1).isoformat(), date(year, month, last).isoformat()
+    return f"{year:04d}-01-01", f"{year:04d}-12-31"
+
+
+def current_period():
+    return date.today().strftime("%Y-%m")
+
+
+def checkin_stats(conn, period, top=20):
+    """Check-in totals for `period` from checkins.db."""
+    first, last = period_range(period)
+    by_day = {}
+    by_hour = {}
+    by_type = {}
+    rows = conn.execute(
+        "SELECT day, hour, checkin_type, visits FROM stats_hourly WHERE day BETWEEN ? AND ?",
+        (first, last),
+    )
+    for day, hour, checkin_type, visits in rows:
+        by_day[day] = by_day.get(day, 0) + visits
+        hour_key = f"{hour:02d}"
+        by_hour[hour_key] = by_hour.get(hour_key, 0) + visits
+        by_type[checkin_type] = by_type.get(checkin_type, 0) + visits
+
+    members = conn.execute(
+        "SELECT MAX(name), SUM(visits), MAX(last_visit) FROM stats_member_monthly "
+        "WHERE month BETWEEN ? AND ? GROUP BY name_key "
+        "ORDER BY SUM(visits) DESC, MAX(name) LIMIT ?",
+        (first[:7], last[:7], top),
+    ).fetchall()
+    unique_members = conn.execute(
+        "SELECT COUNT(DISTINCT name_key) FROM stats_member_monthly WHERE month BETWEEN ? AND ?",
+        (first[:7], last[:7]),
+    ).fetchone()[0]
+
+    return {
+        "total": sum(by_day.values()),
+        "unique_members": unique_members,
+        "by_day": dict(sorted(by_day.items())),
+        "by_hour": dict(sorted(by_hour.items())),
+        "by_type": dict(sorted(by_type.items())),
+        "top_members": [
+            {"name": name, "visits": visits, "last_visit": last_visit}
+            for name, visits, last_visit in members
+        ],
+    }
+
+
+def lartimmar_stats(conn, period):
+    """Lärtimmar hours for `period` from lartimmar.db."""
+    first, last = period_range(period)
+    by_aktivitet = {}
+    by_day = {}
+    rows = conn.execute(
+        "SELECT day, aktivitet, entries, hours, leader_entries FROM stats_lartimmar_daily "
+        "WHERE day BETWEEN ? AND ?",
+        (first, last),
+    )
+    for day, aktivitet, entries, hours, leader_entries in rows:
+        totals = by_aktivitet.setdefault(aktivitet, {"entries": 0, "hours": 0.0, "leader_entries": 0})
+        totals["entries"] += entries
+        totals["hours"] += hours
+        totals["leader_entries"] += leader_entries
+        by_day[day] = by_day.get(day, 0.0) + hours
+
+    return {
+        "entries": sum(t["entries"] for t in by_aktivitet.values()),
+        "hours": sum(t["hours"] for t in by_aktivitet.values()),
+        "by_aktivitet": dict(sorted(by_aktivitet.items())),
+        "hours_by_day": dict(sorted(by_day.items())),
+    }
@@ -43,7 +43,7 @@ echo "Gunicorn started with PID: $GUNICORN_PID" >> "$LOGFILE"
 # Wait for server to be ready
 echo "Waiting for server to start..." >> "$LOGFILE"
 for i in {1..30}; do
-    if curl -s http://localhost:5000 > /dev/null; then
+    if curl -sf http://localhost:5000/healthz > /dev/null; then
         echo "Server ready after $i seconds" >> "$LOGFILE"
         break
     fi
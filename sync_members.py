@@ -4,15 +4,38 @@ from google.oauth2.service_account import Credentials
 from datetime import datetime, timezone
 import argparse
 import os
-import sys
+import socket
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import migrations
+import profiling
+from member_names import member_identity, normalize_name
 
 SHEET_NAME = "KioskTest"
 JSON_KEY = "credentials.json"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "checkins.db")
+DB_PATH = os.environ.get("APP_DB_PATH") or os.path.join(BASE_DIR, "checkins.db")
 LARTIMMAR_DB_PATH = os.environ.get("LARTIMMAR_DB_PATH") or os.path.join(BASE_DIR, "lartimmar.db")
 LARTIMMAR_SHEET = "Lartimmar"
+# Rows claimed, uploaded and marked exported per step, so a long backlog
+# is sent as several bounded requests and progress survives a failure.
+EXPORT_CHUNK_SIZE = int(os.environ.get("KIOSK_EXPORT_CHUNK_SIZE", "500"))
+# Seconds an export batch keeps its claimed rows. A batch whose exporter
+# died is taken over by the next export once its lease has run out, so
+# this must comfortably exceed one chunk's upload including retries.
+EXPORT_LEASE_SECONDS = float(os.environ.get("KIOSK_EXPORT_LEASE_S", "300"))
+# Member changes kept for the kiosk page's delta feed (/members?since=).
+# A page further behind than this reloads the full list.
+MEMBER_CHANGES_KEEP = 5000
+# Independent sync jobs (import, the two exports) run on this many threads.
+SYNC_WORKERS = 3
+# Prefix of the export key written with every exported row; must be unique
+# per kiosk when several kiosks export to the same spreadsheet.
+KIOSK_ID = os.environ.get("KIOSK_ID") or socket.gethostname()
 
 
 def resolve_credentials_file():
@@ -31,6 +54,10 @@ def resolve_credentials_file():
 
 
 def get_gsheet_client():
+    # KIOSK_SHEETS_BACKEND=fake runs against the in-memory stand-in (fake_sheets.py)
+    if os.environ.get("KIOSK_SHEETS_BACKEND") == "fake":
+        import fake_sheets
+        return fake_sheets.backend_from_env().client()
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
@@ -41,124 +68,266 @@ def get_gsheet_client():
     return gspread.authorize(creds)
 
 
-def ensure_tables():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS checkins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            timestamp TEXT,
-            exported INTEGER DEFAULT 0,
-            person_id TEXT,
-            checkin_type TEXT
-        )
-        """
-    )
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS members (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            year_of_birth TEXT,
-            avgiftstyp TEXT,
-            sheet_id TEXT,
-            last_updated TEXT
-        )
+# Header rows written to the worksheets this module appends to.
+# The export key (see export_key()) is always the last column.
+LOGG_HEADER = ["name", "id", "type", "timestamp", "date", "hour", "key"]
+LARTIMMAR_HEADER = ["timestamp", "datum", "aktivitet", "namn", "personnummer", "antal_timmar", "ledare", "key"]
+SYNC_LOG_HEADER = ["timestamp", "action", "target", "rows", "status", "note"]
+
+
+class SyncSession:
+    """Google Sheets access shared by the jobs of one sync cycle.
+
+    Authorizes once (google-auth refreshes the token by itself when it
+    expires), caches the spreadsheet and worksheet handles and remembers
+    which worksheets already had their header verified, so a cycle costs
+    a few round-trips instead of a full auth/open dance per call.
+    """
+
+    def __init__(self, client_factory=None):
+        self._client_factory = client_factory or get_gsheet_client
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+        self._verified_headers = set()
+        self._lock = threading.RLock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._client_factory()
+            return self._client
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = self.client().open(SHEET_NAME)
+            return self._spreadsheet
+
+    def worksheet(self, title, header=None, verify_header=True, rows=1000, cols=10):
+        """Return the worksheet `title`, creating it with `header` if missing.
+
+        Raises gspread.WorksheetNotFound when it does not exist and no
+        header was given. With `verify_header`, cell A1 is checked (and the
+        header inserted if needed) once per session.
         """
-    )
+        with self._lock:
+            ws = self._worksheets.get(title)
+            if ws is None:
+                sh = self.spreadsheet()
+                try:
+                    ws = sh.worksheet(title)
+                except gspread.WorksheetNotFound:
+                    if header is None:
+                        raise
+                    ws = sh.add_worksheet(title, rows=rows, cols=cols)
+                    ws.append_row(header)
+                    self._verified_headers.add(title)
+                self._worksheets[title] = ws
+
+            if header is not None and verify_header and title not in self._verified_headers:
+                # Read row 1. If empty or not starting with the first header column, assume missing header.
+                first_row = ws.row_values(1)
+                if not first_row or first_row[0].lower() != header[0].lower():
+                    print(f"Adding missing header to {title} sheet.")
+                    ws.insert_row(header, index=1)
+                else:
+                    # Sheets created before a column was added (e.g. "key")
+                    for col in range(len(first_row), len(header)):
+                        ws.update_cell(1, col + 1, header[col])
+                self._verified_headers.add(title)
+            return ws
+
+    def forget(self, title=None):
+        """Drop cached handles after an error so the next call fetches them again."""
+        with self._lock:
+            if title is None:
+                self._spreadsheet = None
+                self._worksheets.clear()
+                self._verified_headers.clear()
+            else:
+                self._worksheets.pop(title, None)
+                self._verified_headers.discard(title)
 
-    # Migrate older schemas (CREATE TABLE IF NOT EXISTS will not add missing columns)
-    cursor.execute("PRAGMA table_info(checkins)")
-    checkins_cols = {row[1] for row in cursor.fetchall()}
-    if "exported" not in checkins_cols:
-        cursor.execute("ALTER TABLE checkins ADD COLUMN exported INTEGER DEFAULT 0")
-    if "person_id" not in checkins_cols:
-        cursor.execute("ALTER TABLE checkins ADD COLUMN person_id TEXT")
-    if "checkin_type" not in checkins_cols:
-        cursor.execute("ALTER TABLE checkins ADD COLUMN checkin_type TEXT")
-
-    # CLEANUP: Reset any rows stuck in processing state (2) from previous crashes
-    cursor.execute("UPDATE checkins SET exported = 0 WHERE exported = 2")
-
-    cursor.execute("PRAGMA table_info(members)")
-    members_cols = {row[1] for row in cursor.fetchall()}
-    if "year_of_birth" not in members_cols:
-        cursor.execute("ALTER TABLE members ADD COLUMN year_of_birth TEXT")
-    if "avgiftstyp" not in members_cols:
-        cursor.execute("ALTER TABLE members ADD COLUMN avgiftstyp TEXT")
-    if "sheet_id" not in members_cols:
-        cursor.execute("ALTER TABLE members ADD COLUMN sheet_id TEXT")
-    if "last_updated" not in members_cols:
-        cursor.execute("ALTER TABLE members ADD COLUMN last_updated TEXT")
-    conn.commit()
-    conn.close()
 
+def log_sync(action, target, rows=0, status="ok", note=""):
+    """Record a sync event locally; flush_sync_log() sends it to the SyncLog sheet."""
+    try:
+        migrations.ensure_checkins_db(DB_PATH)
+        conn = sqlite3.connect(DB_PATH, timeout=30.0)
+        try:
+            ts = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            conn.execute(
+                "INSERT INTO sync_log (timestamp, action, target, rows, status, note) VALUES (?, ?, ?, ?, ?, ?)",
+                (ts, action, target, rows, status, note),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Could not write sync log: {e}")
 
-def ensure_lartimmar_table():
-    conn = sqlite3.connect(LARTIMMAR_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS lartimmar (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            aktivitet TEXT,
-            namn TEXT,
-            personnummer TEXT,
-            antal_timmar REAL,
-            ledare INTEGER DEFAULT 0,
-            exported INTEGER DEFAULT 0
-        )
-        """
-    )
-    cursor.execute("PRAGMA table_info(lartimmar)")
-    cols = {row[1] for row in cursor.fetchall()}
-    if "exported" not in cols:
-        cursor.execute("ALTER TABLE lartimmar ADD COLUMN exported INTEGER DEFAULT 0")
-    # Reset any rows stuck in processing state from previous crashes
-    cursor.execute("UPDATE lartimmar SET exported = 0 WHERE exported = 2")
-    conn.commit()
-    conn.close()
 
+def flush_sync_log(session=None, limit=500):
+    """Append unflushed sync log entries to the SyncLog sheet in one request.
 
-def log_sync(action, target, rows=0, status="ok", note=""):
+    Called at the end of each sync cycle. Entries are deleted locally only
+    after the append succeeded, so a failed flush is retried next cycle.
+    Returns the number of entries flushed, or None on failure.
+    """
+    migrations.ensure_checkins_db(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=30.0)
     try:
-        client = get_gsheet_client()
-        sh = client.open(SHEET_NAME)
+        rows = conn.execute(
+            "SELECT id, timestamp, action, target, rows, status, note FROM sync_log ORDER BY id LIMIT ?",
+            (limit,),
+        ).fetchall()
+        if not rows:
+            return 0
+        session = session or SyncSession()
         try:
-            log_ws = sh.worksheet("SyncLog")
-        except gspread.WorksheetNotFound:
-            log_ws = sh.add_worksheet("SyncLog", rows=1000, cols=6)
-            log_ws.append_row(["timestamp", "action", "target", "rows", "status", "note"]) 
+            log_ws = session.worksheet("SyncLog", header=SYNC_LOG_HEADER, verify_header=False, cols=6)
+            log_ws.append_rows([[ts, action, target, str(n), status, note or ""]
+                                for _, ts, action, target, n, status, note in rows])
+        except Exception as e:
+            session.forget("SyncLog")
+            print(f"Could not flush sync log to sheet: {e}")
+            return None
+        conn.execute("DELETE FROM sync_log WHERE id <= ?", (rows[-1][0],))
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
 
-        ts = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-        log_ws.append_row([ts, action, target, str(rows), status, note])
-    except Exception as e:
-        print(f"Could not write sync log to sheet: {e}")
+
+def apply_member_diff(conn, parsed, now):
+    """Bring `members` in line with `parsed` using the smallest set of writes.
+
+    `parsed` holds (sheet_id, name, year_of_birth, avgiftstyp) tuples. Rows
+    are matched on `sheet_id`, then on their derived identity (rows stored
+    before the sheet had an id column, or before sheet ids were stored),
+    then on a name that only one unmatched row and one unmatched sheet row
+    share, so a corrected year of birth updates the member in place.
+    Matched rows keep their id, and a missing or stale `name_key` counts
+    as a change, so every import repairs it. Sheet rows sharing an id are
+    all kept.
+    Returns (added, changed, removed); nothing is written when nothing
+    changed.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT id, sheet_id, name, name_key, year_of_birth, avgiftstyp FROM members ORDER BY id")
+    existing = []
+    by_sheet_id = {}
+    by_identity = {}
+    for row_id, sheet_id, name, name_key, yob, m_type in cur.fetchall():
+        row = (row_id, sheet_id, name or "", name_key, yob, m_type or "")
+        existing.append(row)
+        identity = member_identity(row[2], yob)
+        if sheet_id:
+            by_sheet_id.setdefault(sheet_id, []).append(row)
+        if not sheet_id or sheet_id == identity:
+            by_identity.setdefault(identity, []).append(row)
+
+    counts = {}
+    for sheet_id, name, _, _ in parsed:
+        counts[sheet_id] = counts.get(sheet_id, 0) + 1
+    for sheet_id, count in counts.items():
+        if count > 1:
+            print(f"Warning: {count} members in the sheet share the id {sheet_id!r}; keeping all of them")
+
+    claimed = set()
+
+    def take(rows):
+        for row in rows or ():
+            if row[0] not in claimed:
+                claimed.add(row[0])
+                return row
+        return None
+
+    matches = []
+    unmatched = []
+    for entry in parsed:
+        sheet_id, name, yob, _ = entry
+        row = take(by_sheet_id.get(sheet_id)) or take(by_identity.get(member_identity(name, yob)))
+        if row is None:
+            unmatched.append(entry)
+        else:
+            matches.append((entry, row))
+
+    # Last resort: a name only one leftover row and one new sheet row have
+    leftover_by_key = {}
+    for row in existing:
+        if row[0] not in claimed:
+            leftover_by_key.setdefault(normalize_name(row[2]), []).append(row)
+    new_by_key = {}
+    for entry in unmatched:
+        new_by_key.setdefault(normalize_name(entry[1]), []).append(entry)
+
+    inserts = []
+    for key, entries in new_by_key.items():
+        rows = leftover_by_key.get(key, [])
+        if len(entries) == 1 and len(rows) == 1:
+            claimed.add(rows[0][0])
+            matches.append((entries[0], rows[0]))
+            continue
+        for sheet_id, name, yob, m_type in entries:
+            inserts.append((sheet_id, name, normalize_name(name), yob, m_type, now))
+
+    updates = [
+        (sheet_id, name, normalize_name(name), yob, m_type, now, row[0])
+        for (sheet_id, name, yob, m_type), row in matches
+        if row[1:] != (sheet_id, name, normalize_name(name), yob, m_type)
+    ]
+    deletes = [(row[0],) for row in existing if row[0] not in claimed]
+
+    if inserts or updates or deletes:
+        with conn:
+            cur.executemany(
+                "INSERT INTO members (sheet_id, name, name_key, year_of_birth, avgiftstyp, last_updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                inserts,
+            )
+            cur.executemany(
+                "UPDATE members SET sheet_id = ?, name = ?, name_key = ?, year_of_birth = ?, avgiftstyp = ?, "
+                "last_updated = ? WHERE id = ?",
+                updates,
+            )
+            cur.executemany("DELETE FROM members WHERE id = ?", deletes)
+    return len(inserts), len(updates), len(deletes)
+
+
+def prune_member_changes(conn, keep=MEMBER_CHANGES_KEEP):
+    """Drop all but the last `keep` generations of the member change log."""
+    with conn:
+        floor = conn.execute(
+            "SELECT value FROM kiosk_meta WHERE key = 'members_generation'"
+        ).fetchone()[0] - keep
+        conn.execute("DELETE FROM member_changes WHERE generation <= ?", (floor,))
+        conn.execute(
+            "UPDATE kiosk_meta SET value = MAX(value, ?) WHERE key = 'member_changes_floor'",
+            (floor,),
+        )
 
 
-def import_members_from_sheet():
-    ensure_tables()
+def import_members_from_sheet(full_refresh=False, session=None):
+    """Import the member list from the sheet. Returns False if the import failed."""
+    migrations.ensure_checkins_db(DB_PATH)
+    session = session or SyncSession()
     try:
-        client = get_gsheet_client()
-        sh = client.open(SHEET_NAME)
-
         source_name = "Members"
         try:
-            ws = sh.worksheet("Members")
+            ws = session.worksheet("Members")
             all_values = ws.get_all_values()
         except gspread.WorksheetNotFound:
             # Fallback to first sheet (common setup)
             source_name = "sheet1"
-            ws = sh.sheet1
+            ws = session.spreadsheet().sheet1
             all_values = ws.get_all_values()
 
         if not all_values:
             print("No member rows found.")
             log_sync("read", source_name, rows=0, status="empty")
-            return
+            return True
 
         # Decide whether first row is a header
         first = [c.strip() for c in (all_values[0] or [])]
@@ -184,6 +353,9 @@ def import_members_from_sheet():
             "typ",
             "medlemstyp",
         )
+        # Optional stable member id column; without it members are keyed on
+        # name + year of birth (see member_identity).
+        id_keys = ("id", "medlemsnummer", "medlemsnr", "member_id", "sheet_id")
         has_header = any(x in name_keys for x in first_l) or any(x in year_keys for x in first_l)
 
         if has_header:
@@ -201,6 +373,7 @@ def import_members_from_sheet():
             name = (r[0].strip() if len(r) >= 1 else "")
             yob = (r[1].strip() if len(r) >= 2 else "")
             m_type = ""
+            sheet_id = ""
 
             if has_header:
                 data = {header[i]: (r[i].strip() if i < len(r) else "") for i in range(len(header))}
@@ -233,6 +406,7 @@ def import_members_from_sheet():
                     or data.get("medlemstyp")
                     or ""
                 )
+                sheet_id = next((data[k] for k in id_keys if data.get(k)), "")
 
             if not name:
                 continue
@@ -245,359 +419,417 @@ def import_members_from_sheet():
             # Truncate membership type to 20 chars as requested
             m_type = m_type[:20]
 
-            parsed.append((name, yob_text, m_type, now))
+            parsed.append((sheet_id or member_identity(name, yob_text), name, yob_text, m_type))
 
         if not parsed:
             print(f"No valid members parsed from {source_name}; keeping existing local members.")
             log_sync("read", source_name, rows=0, status="empty", note="no valid parsed members")
-            return
+            return True
 
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(DB_PATH, timeout=30.0)
         try:
+            if full_refresh:
+                with conn:
+                    cur = conn.cursor()
+                    # Full refresh so local DB matches the sheet (including removals)
+                    cur.execute("DELETE FROM members")
+                    cur.executemany(
+                        "INSERT INTO members (sheet_id, name, name_key, year_of_birth, avgiftstyp, last_updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [(sid, name, normalize_name(name), yob, m_type, now) for sid, name, yob, m_type in parsed],
+                    )
+                added, changed, removed = len(parsed), 0, None
+            else:
+                added, changed, removed = apply_member_diff(conn, parsed, now)
+            # Reported by /metrics as the last successful import
             with conn:
-                cur = conn.cursor()
-                # Full refresh so local DB matches the sheet (including removals)
-                cur.execute("DELETE FROM members")
-                cur.executemany(
-                    "INSERT INTO members (name, year_of_birth, avgiftstyp, last_updated) VALUES (?, ?, ?, ?)",
-                    parsed,
+                conn.execute(
+                    "INSERT OR REPLACE INTO kiosk_meta (key, value) VALUES ('members_last_import', ?)",
+                    (int(time.time()),),
                 )
+            prune_member_changes(conn)
         finally:
             conn.close()
 
-        print(f"Imported members from {source_name}: {len(parsed)} rows")
-        log_sync("read", source_name, rows=len(parsed), status="ok")
+        if full_refresh:
+            note = "full refresh"
+        else:
+            note = f"added={added} changed={changed} removed={removed}"
+        print(f"Imported members from {source_name}: {len(parsed)} rows ({note})")
+        log_sync("read", source_name, rows=len(parsed), status="ok", note=note)
+        return True
 
     except Exception as e:
         print(f"Error importing members: {e}")
         log_sync("read", "Members", rows=0, status="error", note=str(e))
+        return False
+
+
+def claim_export_chunk(conn, table, chunk_size=None, lease_seconds=None, now=None):
+    """Claim the next rows of `table` for a new export batch.
+
+    Claimed rows are set to processing (2) with a fresh batch id and a
+    lease, in one transaction, so concurrent exporters (threads or
+    processes) always get disjoint batches. Rows whose lease has expired
+    (their exporter died or gave up) are taken over first, then unexported
+    rows, oldest first. Returns (batch id, rows claimed, rows taken over);
+    taken-over rows may already be in the sheet and must be reconciled.
+    """
+    size = chunk_size or EXPORT_CHUNK_SIZE
+    now = time.time() if now is None else now
+    until = now + (EXPORT_LEASE_SECONDS if lease_seconds is None else lease_seconds)
+    batch = uuid.uuid4().hex
+    try:
+        # Rows at 2 without a lease predate leases or were reset by reset-exports
+        taken_over = conn.execute(
+            f"UPDATE {table} SET export_batch = ?, lease_until = ? WHERE id IN "
+            f"(SELECT id FROM {table} WHERE exported = 2 AND (lease_until IS NULL OR lease_until < ?) "
+            f"ORDER BY id LIMIT ?)",
+            (batch, until, now, size),
+        ).rowcount
+        fresh = 0
+        if taken_over < size:
+            fresh = conn.execute(
+                f"UPDATE {table} SET exported = 2, export_batch = ?, lease_until = ? WHERE id IN "
+                f"(SELECT id FROM {table} WHERE exported = 0 ORDER BY id LIMIT ?)",
+                (batch, until, size - taken_over),
+            ).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if taken_over:
+        print(f"Took over {taken_over} {table} rows from an interrupted export")
+    return batch, taken_over + fresh, taken_over
+
+
+def finish_export_batch(conn, table, batch):
+    """Mark the rows of `batch` exported (1).
+
+    Rows another exporter took over after this batch's lease expired are
+    left to that exporter. Returns the number of rows marked.
+    """
+    cursor = conn.execute(
+        f"UPDATE {table} SET exported = 1, export_batch = NULL, lease_until = NULL "
+        f"WHERE export_batch = ? AND exported = 2",
+        (batch,),
+    )
+    conn.commit()
+    return cursor.rowcount
+
 
+def release_export_batch(conn, table, batch):
+    """Expire the lease of a failed batch so the next export takes it over.
 
-def export_new_rows():
-    ensure_tables()
-    
-    # Acquire file lock to prevent multiple workers from exporting simultaneously
-    lock_file_path = os.path.join(BASE_DIR, "export.lock")
-    lock_file = None
-    
+    The rows stay at 2: their append may have reached the sheet, so the
+    exporter taking them over reconciles them against the export keys.
+    """
     try:
-        lock_file = open(lock_file_path, "w")
-        # Try to acquire exclusive lock (non-blocking)
-        try:
-            if sys.platform == "win32":
-                import msvcrt
-                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
-            else:
-                import fcntl
-                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except (IOError, OSError):
-            # Another process is already exporting
-            print("Export already in progress by another worker, skipping...")
-            lock_file.close()
-            return
-        
-        # Use longer timeout for slow systems (30 seconds instead of default 5)
-        conn = sqlite3.connect(DB_PATH, timeout=30.0)
-        cursor = conn.cursor()
-        
-        # CLEANUP: Reset any rows stuck at exported=2 from previous crashes/timeouts
-        # This ensures rows aren't lost if export failed partway through
-        cursor.execute("UPDATE checkins SET exported = 0 WHERE exported = 2")
-        stuck_count = cursor.rowcount
-        if stuck_count > 0:
-            print(f"Reset {stuck_count} rows stuck in processing state")
+        conn.execute(f"UPDATE {table} SET lease_until = 0 WHERE export_batch = ? AND exported = 2", (batch,))
         conn.commit()
-        
-        # 0 = EJ EXPORTERAD
-        # 1 = EXPORTERAD
-        # 2 = BEARBETAS (Låser raderna så ingen annan tråd tar dem)
+    except sqlite3.Error as e:
+        # The lease then simply runs out on its own
+        print(f"Could not release {table} export batch: {e}")
 
-        # STEP 1: Claim rows by marking them as processing (2)
-        # Now with file lock + cleanup, we safely claim rows
-        cursor.execute("UPDATE checkins SET exported = 2 WHERE exported = 0")
-        if cursor.rowcount == 0:
-            # Nothing to process
-            conn.commit()
-            conn.close()
-            return
 
-        conn.commit() # Commit the claim immediately
+def export_key(table, row_id):
+    """Stable key identifying an exported row in the sheet, e.g. "kiosk1:checkins:42"."""
+    return f"{KIOSK_ID}:{table}:{row_id}"
 
-        # STEP 2: Fetch only the rows we just claimed
-        cursor.execute(
-            "SELECT c.id, c.name, m.year_of_birth, c.timestamp, c.person_id, c.checkin_type "
-            "FROM checkins c LEFT JOIN members m ON lower(trim(c.name)) = lower(trim(m.name)) "
-            "WHERE c.exported = 2"
-        )
-        rows = cursor.fetchall()
-        
-        if not rows:
-            # Should hopefully not happen if rowcount > 0, but good safety
-            conn.close()
-            return
 
-        # Prepare rows
-        # Format: Name, ID (Year or PersonID), Type (Avgiftstyp or "engångsavgift"), Timestamp, Date, Hour
-        data_to_upload = []
-        ids_to_finalize = []
+def sheet_export_keys(session, title, header):
+    """Set of export keys already present in worksheet `title` (one column read)."""
+    sheet = session.worksheet(title, header=header)
+    return set(sheet.col_values(len(header))[1:])
 
-        for row in rows:
-            c_id, c_name, m_year, c_timestamp, c_person_id, c_checkin_type = row
-            ids_to_finalize.append(c_id)
-            
-            name = c_name
-            
-            # Determine ID and Type
-            if c_checkin_type == "engångsavgift":
-                id_val = c_person_id if c_person_id else ""
-                type_val = "engångsavgift"
+
+def upload_rows(session, title, header, rows, max_retries=3):
+    """Append `rows` to worksheet `title`, retrying a failed request.
+
+    Each row ends with its export key. A failed append may still have
+    reached the sheet, so retries only send rows whose key is missing.
+    """
+    for attempt in range(max_retries):
+        try:
+            if attempt:
+                present = sheet_export_keys(session, title, header)
+                rows = [r for r in rows if r[-1] not in present]
+                if not rows:
+                    return
+            # Header is checked once per session, not on every chunk.
+            sheet = session.worksheet(title, header=header)
+            sheet.append_rows(rows)
+            return
+        except Exception as upload_err:
+            print(f"{title} upload attempt {attempt + 1}/{max_retries} failed: {upload_err}")
+            session.forget(title)
+            if attempt < max_retries - 1:
+                time.sleep(2)  # Wait before retry
             else:
-                id_val = m_year if m_year is not None else ""
-                type_val = "" 
+                raise  # Re-raise if all retries exhausted
 
-            # Derive date and hour (YYYY-MM-DD, HH:00) to ease pivots in Sheets
-            date_part = ""
-            hour_part = ""
-            if c_timestamp:
-                try:
-                    parts = c_timestamp.split(" ")
-                    if len(parts) >= 2:
-                        date_part = parts[0]
-                        time_part = parts[1]
-                        hour_part = time_part.split(":")[0] + ":00"
-                except Exception:
-                    pass
-
-            data_to_upload.append([name, id_val, type_val, c_timestamp, date_part, hour_part])
-
-        # STEP 3: Upload to Google Sheets
-        # Add retry logic for slow/unreliable network
-        max_upload_retries = 3
-        upload_success = False
-        
-        for upload_attempt in range(max_upload_retries):
-            try:
-                client = get_gsheet_client()
-                sh = client.open(SHEET_NAME)
-                try:
-                    sheet = sh.worksheet("Logg")
-                    # Check if header exists, otherwise add it
-                    # Read cell A1. If empty or not "name", assume missing header.
-                    # (Note: This is a simple check. If the sheet is completely empty, A1 is empty)
-                    val_a1 = sheet.acell('A1').value
-                    if not val_a1 or val_a1.lower() != "name":
-                        # If overwrite risk, maybe insert row? Or just append header?
-                        # If sheet is empty, append_row will put it at the top.
-                        print("Adding missing header to Logg sheet.")
-                        sheet.insert_row(["name", "id", "type", "timestamp", "date", "hour"], index=1)
-                except gspread.WorksheetNotFound:
-                    sheet = sh.add_worksheet("Logg", rows=1000, cols=10)
-                    sheet.append_row(["name", "id", "type", "timestamp", "date", "hour"]) 
-
-                sheet.append_rows(data_to_upload)
-                upload_success = True
-                break  # Success, exit retry loop
-            except Exception as upload_err:
-                print(f"Upload attempt {upload_attempt + 1}/{max_upload_retries} failed: {upload_err}")
-                if upload_attempt < max_upload_retries - 1:
-                    time.sleep(2)  # Wait before retry
-                else:
-                    raise  # Re-raise if all retries exhausted
-        
-        if not upload_success:
-            raise Exception("Failed to upload to Google Sheets after all retries")
 
-        # STEP 4: Mark as Done (1)
-        cursor.executemany("UPDATE checkins SET exported = 1 WHERE id = ?", [(i,) for i in ids_to_finalize])
-        conn.commit()
+def export_new_rows(session=None, reconcile=False):
+    """Export unexported check-ins to the Logg sheet.
+
+    With `reconcile` (implied for rows taken over from an interrupted
+    export) rows whose export key is already in the sheet are marked
+    exported without being uploaded again. Several exports may run at the
+    same time; each claims its own batches. Returns the number of rows
+    exported, or None if the export failed.
+    """
+    migrations.ensure_checkins_db(DB_PATH)
+    session = session or SyncSession()
+    conn = None
+    batch = None
+    exported = 0
+
+    try:
+        # Use longer timeout for slow systems (30 seconds instead of default 5)
+        conn = sqlite3.connect(DB_PATH, timeout=30.0)
+        cursor = conn.cursor()
 
-        print(f"Exporterat {len(data_to_upload)} nya rader!")
-        log_sync("write", "Logg", rows=len(data_to_upload), status="ok")
+        # 0 = EJ EXPORTERAD
+        # 1 = EXPORTERAD
+        # 2 = BEARBETAS (batch `export_batch` äger raderna till `lease_until`)
+        present = sheet_export_keys(session, "Logg", LOGG_HEADER) if reconcile else None
+
+        # Each chunk is claimed (2), uploaded and marked done (1) on its own,
+        # so a failure only leaves the current chunk unfinished.
+        while True:
+            batch, claimed, taken_over = claim_export_chunk(conn, "checkins")
+            if not claimed:
+                batch = None
+                break
+            # Taken-over rows may already be in the sheet; compare keys.
+            if taken_over and present is None:
+                present = sheet_export_keys(session, "Logg", LOGG_HEADER)
+
+            # Fetch only the rows of this batch
+            # Year of birth via the indexed name_key; a correlated lookup so a
+            # duplicated member name cannot duplicate the check-in row.
+            cursor.execute(
+                "SELECT c.id, c.name, "
+                "(SELECT m.year_of_birth FROM members m WHERE m.name_key = c.name_key LIMIT 1), "
+                "c.timestamp, c.person_id, c.checkin_type "
+                "FROM checkins c WHERE c.export_batch = ? ORDER BY c.id",
+                (batch,),
+            )
+
+            # Prepare rows
+            # Format: Name, ID (Year or PersonID), Type (Avgiftstyp or "engångsavgift"), Timestamp, Date, Hour
+            data_to_upload = []
+
+            for row in cursor:
+                c_id, c_name, m_year, c_timestamp, c_person_id, c_checkin_type = row
+
+                name = c_name
+
+                # Determine ID and Type
+                if c_checkin_type == "engångsavgift":
+                    id_val = c_person_id if c_person_id else ""
+                    type_val = "engångsavgift"
+                else:
+                    id_val = m_year if m_year is not None else ""
+                    type_val = ""
+
+                # Derive date and hour (YYYY-MM-DD, HH:00) to ease pivots in Sheets
+                date_part = ""
+                hour_part = ""
+                if c_timestamp:
+                    try:
+                        parts = c_timestamp.split(" ")
+                        if len(parts) >= 2:
+                            date_part = parts[0]
+                            time_part = parts[1]
+                            hour_part = time_part.split(":")[0] + ":00"
+                    except Exception:
+                        pass
+
+                key = export_key("checkins", c_id)
+                if present is None or key not in present:
+                    data_to_upload.append([name, id_val, type_val, c_timestamp, date_part, hour_part, key])
+
+            # Upload to Google Sheets, retrying for slow/unreliable network
+            if data_to_upload:
+                upload_rows(session, "Logg", LOGG_HEADER, data_to_upload)
+
+            # Mark as Done (1)
+            finish_export_batch(conn, "checkins", batch)
+            batch = None
+            exported += len(data_to_upload)
+
+        if exported:
+            print(f"Exporterat {exported} nya rader!")
+            log_sync("write", "Logg", rows=exported, status="ok")
+        return exported
 
     except Exception as e:
         print(f"Fel vid export: {e}")
-        # Rollback claimed rows to 0 so they can be tried again
-        try:
-            # Only attempt rollback if we have a valid connection
-            if 'conn' in locals() and conn:
-                if 'cursor' not in locals():
-                    cursor = conn.cursor()
-                cursor.execute("UPDATE checkins SET exported = 0 WHERE exported = 2")
-                conn.commit()
-        except Exception as rollback_err:
-            print(f"Rollback failed: {rollback_err}")
-        
-        log_sync("write", "Logg", rows=0, status="error", note=str(e))
+        # The failed chunk stays at 2: its append may have reached the sheet,
+        # and the next export takes it over and reconciles the export keys.
+        if batch is not None and conn is not None:
+            release_export_batch(conn, "checkins", batch)
+        log_sync("write", "Logg", rows=exported, status="error", note=str(e))
+        return None
     finally:
-        if 'conn' in locals() and conn:
+        if conn:
             conn.close()
-        # Release file lock
-        if lock_file:
-            try:
-                if sys.platform == "win32":
-                    import msvcrt
-                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
-                else:
-                    import fcntl
-                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
-                lock_file.close()
-            except Exception:
-                pass
 
 
-def export_new_lartimmar():
-    """Export new Lartimmar rows from the local DB to the Google Sheet."""
-    ensure_lartimmar_table()
+def export_new_lartimmar(session=None, reconcile=False):
+    """Export new Lartimmar rows from the local DB to the Google Sheet.
 
-    lock_file_path = os.path.join(BASE_DIR, "export_lartimmar.lock")
-    lock_file = None
+    Batches and `reconcile` work as in export_new_rows(). Returns the
+    number of rows exported, or None if the export failed.
+    """
+    migrations.ensure_lartimmar_db(LARTIMMAR_DB_PATH)
+    session = session or SyncSession()
     conn = None
+    batch = None
+    exported = 0
 
     try:
-        lock_file = open(lock_file_path, "w")
-        try:
-            if sys.platform == "win32":
-                import msvcrt
-                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
-            else:
-                import fcntl
-                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except (IOError, OSError):
-            print("Lartimmar export already in progress, skipping...")
-            lock_file.close()
-            return
-
         conn = sqlite3.connect(LARTIMMAR_DB_PATH, timeout=30.0)
         cursor = conn.cursor()
+        present = sheet_export_keys(session, LARTIMMAR_SHEET, LARTIMMAR_HEADER) if reconcile else None
 
-        # Reset rows stuck in processing state
-        cursor.execute("UPDATE lartimmar SET exported = 0 WHERE exported = 2")
-        conn.commit()
+        # Claim, upload and finalize one chunk at a time
+        while True:
+            batch, claimed, taken_over = claim_export_chunk(conn, "lartimmar")
+            if not claimed:
+                batch = None
+                break
+            if taken_over and present is None:
+                present = sheet_export_keys(session, LARTIMMAR_SHEET, LARTIMMAR_HEADER)
+
+            cursor.execute(
+                "SELECT id, timestamp, aktivitet, namn, personnummer, antal_timmar, ledare "
+                "FROM lartimmar WHERE export_batch = ? ORDER BY id",
+                (batch,),
+            )
+
+            data_to_upload = []
+            for r in cursor:
+                r_id, ts, aktivitet, namn, personnummer, timmar, ledare = r
+                key = export_key("lartimmar", r_id)
+                if present is not None and key in present:
+                    continue
+                datum = (ts or "")[:10]
+                data_to_upload.append([
+                    ts or "",
+                    datum,
+                    aktivitet or "",
+                    namn or "",
+                    personnummer or "",
+                    "" if timmar is None else float(timmar),
+                    "Ja" if ledare else "Nej",
+                    key,
+                ])
+
+            if data_to_upload:
+                upload_rows(session, LARTIMMAR_SHEET, LARTIMMAR_HEADER, data_to_upload)
+
+            finish_export_batch(conn, "lartimmar", batch)
+            batch = None
+            exported += len(data_to_upload)
+
+        if exported:
+            print(f"Exporterat {exported} nya l\u00e4rtimmar-rader!")
+            log_sync("write", LARTIMMAR_SHEET, rows=exported, status="ok")
+        return exported
 
-        # Claim rows
-        cursor.execute("UPDATE lartimmar SET exported = 2 WHERE exported = 0")
-        if cursor.rowcount == 0:
-            conn.commit()
-            return
-        conn.commit()
+    except Exception as e:
+        print(f"Fel vid l\u00e4rtimmar-export: {e}")
+        # Failed chunk stays at 2 and is taken over by the next export
+        if batch is not None and conn is not None:
+            release_export_batch(conn, "lartimmar", batch)
+        log_sync("write", LARTIMMAR_SHEET, rows=exported, status="error", note=str(e))
+        return None
+    finally:
+        if conn:
+            conn.close()
 
-        cursor.execute(
-            "SELECT id, timestamp, aktivitet, namn, personnummer, antal_timmar, ledare "
-            "FROM lartimmar WHERE exported = 2"
-        )
-        rows = cursor.fetchall()
-        if not rows:
-            return
 
-        data_to_upload = []
-        ids_to_finalize = []
-        for r in rows:
-            r_id, ts, aktivitet, namn, personnummer, timmar, ledare = r
-            ids_to_finalize.append(r_id)
-            datum = (ts or "")[:10]
-            data_to_upload.append([
-                ts or "",
-                datum,
-                aktivitet or "",
-                namn or "",
-                personnummer or "",
-                "" if timmar is None else float(timmar),
-                "Ja" if ledare else "Nej",
-            ])
-
-        # Upload with retry
-        max_upload_retries = 3
-        upload_success = False
-        for attempt in range(max_upload_retries):
-            try:
-                client = get_gsheet_client()
-                sh = client.open(SHEET_NAME)
-                try:
-                    sheet = sh.worksheet(LARTIMMAR_SHEET)
-                    val_a1 = sheet.acell('A1').value
-                    if not val_a1 or val_a1.lower() != "timestamp":
-                        print(f"Adding missing header to {LARTIMMAR_SHEET} sheet.")
-                        sheet.insert_row(
-                            ["timestamp", "datum", "aktivitet", "namn", "personnummer", "antal_timmar", "ledare"],
-                            index=1,
-                        )
-                except gspread.WorksheetNotFound:
-                    sheet = sh.add_worksheet(LARTIMMAR_SHEET, rows=1000, cols=10)
-                    sheet.append_row(
-                        ["timestamp", "datum", "aktivitet", "namn", "personnummer", "antal_timmar", "ledare"]
-                    )
+def run_sync_jobs(jobs, session=None):
+    """Run independent sync jobs concurrently, sharing one Sheets session.
 
-                sheet.append_rows(data_to_upload)
-                upload_success = True
-                break
-            except Exception as upload_err:
-                print(f"Lartimmar upload attempt {attempt + 1}/{max_upload_retries} failed: {upload_err}")
-                if attempt < max_upload_retries - 1:
-                    time.sleep(2)
-                else:
-                    raise
+    `jobs` maps a name to a callable taking the session. The jobs are
+    network-bound, so overlapping them cuts the cycle to roughly the
+    slowest job. Returns {name: result}; a job that raised gives None.
+    Prints a timing summary for the cycle.
+    """
+    session = session or SyncSession()
+    timings = {}
 
-        if not upload_success:
-            raise Exception("Failed to upload Lartimmar to Google Sheets after all retries")
+    def timed(name, job):
+        t0 = time.monotonic()
+        try:
+            with profiling.profiled("sync", name):
+                return job(session)
+        except Exception as e:
+            print(f"Sync job {name} failed: {e}")
+            return None
+        finally:
+            timings[name] = time.monotonic() - t0
 
-        cursor.executemany(
-            "UPDATE lartimmar SET exported = 1 WHERE id = ?",
-            [(i,) for i in ids_to_finalize],
-        )
-        conn.commit()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(SYNC_WORKERS, len(jobs)) or 1) as pool:
+        futures = {name: pool.submit(timed, name, job) for name, job in jobs.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    for name, seconds in timings.items():
+        metrics.set_gauge("kiosk_sync_phase_duration_seconds", {"phase": name}, seconds)
+    summary = ", ".join(f"{name} {timings[name]:.1f}s" for name in jobs)
+    print(f"Sync cycle took {time.monotonic() - started:.1f}s ({summary})")
+    return results
 
-        print(f"Exporterat {len(data_to_upload)} nya l\u00e4rtimmar-rader!")
-        log_sync("write", LARTIMMAR_SHEET, rows=len(data_to_upload), status="ok")
 
-    except Exception as e:
-        print(f"Fel vid l\u00e4rtimmar-export: {e}")
-        try:
-            if conn:
-                cur = conn.cursor()
-                cur.execute("UPDATE lartimmar SET exported = 0 WHERE exported = 2")
-                conn.commit()
-        except Exception as rollback_err:
-            print(f"Lartimmar rollback failed: {rollback_err}")
-        log_sync("write", LARTIMMAR_SHEET, rows=0, status="error", note=str(e))
-    finally:
-        if conn:
-            conn.close()
-        if lock_file:
-            try:
-                if sys.platform == "win32":
-                    import msvcrt
-                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
-                else:
-                    import fcntl
-                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
-                lock_file.close()
-            except Exception:
-                pass
+def sync_all(session=None, reconcile=False):
+    """Import members and export both tables in one concurrent cycle.
+
+    The check-in export reads year of birth from the local members table,
+    so a member changed by this very import may be exported with the
+    previous value; the next import/export cycle picks it up.
+    """
+    return run_sync_jobs({
+        "import-members": lambda s: import_members_from_sheet(session=s),
+        "export-new-rows": lambda s: export_new_rows(session=s, reconcile=reconcile),
+        "export-lartimmar": lambda s: export_new_lartimmar(session=s, reconcile=reconcile),
+    }, session=session)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sync members and export checkins to Google Sheets")
     parser.add_argument("action", nargs="?", choices=["import-members", "export-new-rows", "export-lartimmar", "init-db", "sync-all", "reset-exports"], default="sync-all", help="Action to perform")
+    parser.add_argument("--full-refresh", action="store_true", help="import-members: delete and reinsert all members instead of applying a diff")
+    parser.add_argument("--reconcile", action="store_true", help="exports: skip rows whose export key is already in the sheet")
     args = parser.parse_args()
 
+    session = SyncSession()
     if args.action == "import-members":
-        import_members_from_sheet()
+        import_members_from_sheet(full_refresh=args.full_refresh, session=session)
     elif args.action == "export-new-rows":
-        export_new_rows()
+        export_new_rows(session=session, reconcile=args.reconcile)
     elif args.action == "export-lartimmar":
-        export_new_lartimmar()
+        export_new_lartimmar(session=session, reconcile=args.reconcile)
     elif args.action == "init-db":
-        ensure_tables()
-        ensure_lartimmar_table()
+        migrations.ensure_checkins_db(DB_PATH)
+        migrations.ensure_lartimmar_db(LARTIMMAR_DB_PATH)
         print("Database initialized.")
     elif args.action == "sync-all":
-        import_members_from_sheet()
-        export_new_rows()
-        export_new_lartimmar()
+        sync_all(session=session, reconcile=args.reconcile)
     elif args.action == "reset-exports":
+        migrations.ensure_checkins_db(DB_PATH)
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        cursor.execute("UPDATE checkins SET exported = 0")
+        # Marked as interrupted (2, no lease): the next export takes them
+        # over, compares export keys and uploads only the rows missing from
+        # the sheet.
+        cursor.execute("UPDATE checkins SET exported = 2, export_batch = NULL, lease_until = NULL")
         conn.commit()
         conn.close()
-        print("Done. All rows have been reset to 'unexported'. Clear the 'Logg' sheet in Google Sheets and run 'python sync_members.py' to re-export everything.")
+        print("Done. All rows are marked for re-export. Run 'python sync_members.py export-new-rows' to upload the rows missing from the 'Logg' sheet; there is no need to clear it. Rows exported before export keys were introduced have no key and will be uploaded again. Rows already moved to the archive (archive.py) are not affected.")
+
+    if args.action in ("import-members", "export-new-rows", "export-lartimmar", "sync-all"):
+        # One batched append for everything logged during this run
+        flush_sync_log(session=session)
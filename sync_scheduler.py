@@ -0,0 +1,268 @@
+"""Event-driven scheduler for the background sync worker.
+
+Instead of a fixed 30-minute loop, exports run as soon as enough rows are
+pending or the oldest pending row gets too old. The write routes wake the
+scheduler with a one-byte UDP datagram on localhost (`nudge_sync()`), so
+nothing polls while the kiosk is idle. Member import keeps its own slower
+cadence, and failing Sheets calls back off exponentially.
+
+This module does not import the Google stack at load time; `app.py` can
+import it in every worker just to send nudges.
+"""
+import os
+import select
+import socket
+import sqlite3
+import time
+from datetime import datetime
+
+import metrics
+import profiling
+
+EXPORT_MAX_ROWS = int(os.environ.get("KIOSK_EXPORT_MAX_ROWS", "25"))
+EXPORT_MAX_AGE = float(os.environ.get("KIOSK_EXPORT_MAX_AGE_S", "60"))
+IMPORT_INTERVAL = float(os.environ.get("KIOSK_IMPORT_INTERVAL_S", "1800"))
+# How often old exported rows are moved to the monthly archives (archive.py)
+ARCHIVE_INTERVAL = float(os.environ.get("KIOSK_ARCHIVE_INTERVAL_S", "86400"))
+BACKOFF_BASE = 30.0
+BACKOFF_MAX = float(os.environ.get("KIOSK_SYNC_BACKOFF_MAX_S", "1800"))
+# Without a nudge socket (port taken) the scheduler falls back to polling.
+POLL_INTERVAL = 30.0
+NUDGE_PORT = int(os.environ.get("KIOSK_SYNC_NUDGE_PORT", "5001"))
+
+_nudge_socket = None
+_nudge_pid = None
+
+
+def nudge_sync():
+    """Tell the scheduler (in whichever worker runs it) that rows were written.
+
+    Fire-and-forget: a single non-blocking sendto, errors ignored.
+    """
+    global _nudge_socket, _nudge_pid
+    try:
+        if _nudge_pid != os.getpid():
+            _nudge_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _nudge_socket.setblocking(False)
+            _nudge_pid = os.getpid()
+        _nudge_socket.sendto(b"1", ("127.0.0.1", NUDGE_PORT))
+    except OSError:
+        pass
+
+
+def pending_export(db_path, table):
+    """(row count, age in seconds of the oldest row) of unexported rows in `table`.
+
+    Includes rows left at exported=2 by a failed export so they are retried.
+    Written as IN (0, 2) rather than != 1 so it is an index search on
+    `exported` that only touches the pending rows.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        count, oldest = conn.execute(
+            f"SELECT COUNT(*), MIN(timestamp) FROM {table} WHERE exported IN (0, 2)"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not count:
+        return 0, 0.0
+    try:
+        age = (datetime.now() - datetime.strptime(oldest, "%Y-%m-%d %H:%M:%S")).total_seconds()
+    except (TypeError, ValueError):
+        # Unparseable timestamp: treat as overdue rather than never exporting.
+        age = float("inf")
+    return count, max(age, 0.0)
+
+
+class ExportScheduler:
+    """Decides when to import members and export pending rows.
+
+    `tables` maps a table name to the database file holding it. `step()`
+    runs whatever is due and returns how long to sleep; `run()` loops over
+    it, sleeping on the nudge socket.
+    """
+
+    def __init__(self, tables, import_job=None, export_job=None, session_factory=None,
+                 flush_job=None, before_export=None, archive_job=None, max_rows=EXPORT_MAX_ROWS,
+                 max_age=EXPORT_MAX_AGE, import_interval=IMPORT_INTERVAL,
+                 archive_interval=ARCHIVE_INTERVAL, clock=time.monotonic):
+        self.tables = tables
+        self.import_job = import_job
+        self.export_job = export_job
+        self.session_factory = session_factory
+        self.flush_job = flush_job
+        self.before_export = before_export
+        self.archive_job = archive_job
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.import_interval = import_interval
+        self.archive_interval = archive_interval
+        self.clock = clock
+        # Export and import back off independently: a broken Members sheet
+        # must not hold up exports, and vice versa.
+        self.failures = 0
+        self.retry_at = 0.0
+        self.import_failures = 0
+        self.next_import = clock()
+        self.next_archive = clock()
+        self._socket = None
+
+    def _load_default_jobs(self):
+        # Imported here so only the worker running the scheduler loads gspread.
+        import archive
+        import sync_members
+
+        def import_job(session):
+            return sync_members.import_members_from_sheet(session=session)
+
+        def export_job(session):
+            # The two exports use different databases and worksheets
+            results = sync_members.run_sync_jobs({
+                "export-new-rows": lambda s: sync_members.export_new_rows(session=s),
+                "export-lartimmar": lambda s: sync_members.export_new_lartimmar(session=s),
+            }, session=session)
+            return all(r is not None for r in results.values())
+
+        def archive_job():
+            for table, months in archive.archive_tables(self.tables).items():
+                if months:
+                    sync_members.log_sync("archive", table, rows=sum(months.values()), status="ok",
+                                          note=", ".join(sorted(months)))
+
+        self.import_job = self.import_job or import_job
+        self.export_job = self.export_job or export_job
+        self.session_factory = self.session_factory or sync_members.SyncSession
+        self.flush_job = self.flush_job or (lambda session: sync_members.flush_sync_log(session=session))
+        self.archive_job = self.archive_job or archive_job
+
+    @staticmethod
+    def _backoff_delay(failures):
+        return min(BACKOFF_BASE * (2 ** (failures - 1)), BACKOFF_MAX)
+
+    def _backoff(self, now):
+        self.failures += 1
+        delay = self._backoff_delay(self.failures)
+        self.retry_at = now + delay
+        print(f"[Background] Export failed ({self.failures} in a row), retrying in {delay:.0f}s")
+
+    def _succeeded(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def pending(self):
+        return {table: pending_export(path, table) for table, path in self.tables.items()}
+
+    def _export_due(self, pending):
+        return any(count >= self.max_rows or (count and age >= self.max_age)
+                   for count, age in pending.values())
+
+    def step(self):
+        """Run any due import/export and return the seconds until the next check."""
+        if self.import_job is None or self.export_job is None or self.session_factory is None:
+            self._load_default_jobs()
+        # One Sheets session shared by everything that runs in this step.
+        session = None
+
+        now = self.clock()
+        if now >= self.next_import:
+            session = self.session_factory()
+            started = time.monotonic()
+            with profiling.profiled("sync", "import-members"):
+                imported = self.import_job(session)
+            metrics.set_gauge("kiosk_sync_phase_duration_seconds", {"phase": "import-members"},
+                              time.monotonic() - started)
+            if imported:
+                self.import_failures = 0
+                self.next_import = now + self.import_interval
+            else:
+                self.import_failures += 1
+                delay = self._backoff_delay(self.import_failures)
+                self.next_import = now + delay
+                print(f"[Background] Import failed ({self.import_failures} in a row), retrying in {delay:.0f}s")
+
+        if self.before_export is not None:
+            # Draining the spool is best effort; whatever is already in
+            # SQLite still gets exported.
+            try:
+                self.before_export()
+            except Exception as e:
+                print(f"[Background] Preparing the export failed: {e}")
+        pending = self.pending()
+        now = self.clock()
+        if self._export_due(pending) and now >= self.retry_at:
+            session = session or self.session_factory()
+            if self.export_job(session):
+                self._succeeded()
+            else:
+                self._backoff(now)
+            pending = self.pending()
+
+        # Local only, no Sheets session; runs after the export so freshly
+        # exported rows are not left behind until the next day.
+        now = self.clock()
+        if self.archive_job is not None and now >= self.next_archive:
+            self.next_archive = now + self.archive_interval
+            started = time.monotonic()
+            try:
+                with profiling.profiled("sync", "archive"):
+                    self.archive_job()
+            except Exception as e:
+                print(f"[Background] Archiving failed: {e}")
+            metrics.set_gauge("kiosk_sync_phase_duration_seconds", {"phase": "archive"},
+                              time.monotonic() - started)
+
+        # Sync log entries recorded above go out in one append per cycle
+        if session is not None and self.flush_job is not None:
+            self.flush_job(session)
+        if session is not None:
+            metrics.set_gauge("kiosk_sync_last_cycle_timestamp_seconds", None, time.time())
+            metrics.flush(force=True)
+
+        # Sleep until the import is due or a table's export becomes due
+        # (row threshold now, or its oldest row reaching max_age), but
+        # never before the backoff ends.
+        now = self.clock()
+        wake_at = [self.next_import]
+        if self.archive_job is not None:
+            wake_at.append(self.next_archive)
+        for count, age in pending.values():
+            if count:
+                due_at = now if count >= self.max_rows else now + self.max_age - age
+                wake_at.append(max(due_at, self.retry_at))
+        return max(min(wake_at) - now, 1.0)
+
+    def _open_socket(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", NUDGE_PORT))
+            sock.setblocking(False)
+            self._socket = sock
+        except OSError as e:
+            print(f"[Background] Cannot listen for sync nudges on port {NUDGE_PORT} ({e}); polling instead")
+            self._socket = None
+
+    def wait(self, timeout):
+        """Sleep up to `timeout` seconds or until a nudge arrives."""
+        if self._socket is None:
+            time.sleep(min(timeout, POLL_INTERVAL))
+            return
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if readable:
+            # Coalesce a burst of nudges into one wake-up.
+            try:
+                while True:
+                    self._socket.recv(16)
+            except (BlockingIOError, OSError):
+                pass
+
+    def run(self, initial_delay=10.0):
+        self._open_socket()
+        # Allow server startup before the first import.
+        time.sleep(initial_delay)
+        while True:
+            try:
+                timeout = self.step()
+            except Exception as e:
+                print(f"[Background] Sync error: {e}")
+                timeout = POLL_INTERVAL
+            self.wait(timeout)
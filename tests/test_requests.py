@@ -1,4 +1,5 @@
 import os
+import shutil
 import sqlite3
 import tempfile
 import unittest
@@ -23,11 +24,10 @@ class KioskAppTests(unittest.TestCase):
     def setUpClass(cls):
         os.chdir(PROJECT_ROOT)
         from app import app as flask_app
-        from app import init_db, ensure_members_table
+        from app import init_db
 
         cls.app = flask_app
         init_db()
-        ensure_members_table()
 
         # Seed one unique member so we don't depend on Google Sheets during tests
         cls.test_member_name = f"__TEST_MEMBER__{uuid.uuid4().hex}"
@@ -44,18 +44,109 @@ class KioskAppTests(unittest.TestCase):
     def tearDownClass(cls):
         # Best-effort cleanup of the temp DB files themselves.
         for path in (DB_PATH, LARTIMMAR_DB_PATH):
-            try:
-                os.remove(path)
-            except OSError:
-                pass
+            for suffix in ('', '-wal', '-shm', '.spool', '.spool.lock', '.spool.drain.lock', '.spool.rejected'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+        shutil.rmtree(DB_PATH + '.metrics', ignore_errors=True)
 
-    def test_index_renders_members_json(self):
+    def test_index_does_not_embed_member_list(self):
         with self.app.test_client() as client:
             resp = client.get('/')
             self.assertEqual(resp.status_code, 200)
             html = resp.get_data(as_text=True)
-            self.assertIn('id="members-data"', html)
-            self.assertIn(self.test_member_name, html)
+            self.assertNotIn('id="members-data"', html)
+            self.assertNotIn(self.test_member_name, html)
+            self.assertIn('/members/search', html)
+
+    def test_index_is_cached_and_revalidated(self):
+        import gzip
+
+        with self.app.test_client() as client:
+            first = client.get('/')
+            etag = first.headers['ETag']
+            self.assertTrue(etag)
+            self.assertIn('no-cache', first.headers['Cache-Control'])
+
+            again = client.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.get_data(), b'')
+
+            # Member changes do not touch the page
+            conn = sqlite3.connect(DB_PATH)
+            conn.execute("INSERT INTO members (name) VALUES ('Sidan Oförändrad')")
+            conn.commit()
+            conn.close()
+            self.assertEqual(client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+            zipped = client.get('/', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+            self.assertNotEqual(zipped.headers['ETag'], etag)
+            self.assertEqual(gzip.decompress(zipped.get_data()), first.get_data())
+
+    def test_member_search_matches_word_starts(self):
+        conn = sqlite3.connect(DB_PATH)
+        conn.executemany(
+            "INSERT INTO members (name, year_of_birth) VALUES (?, ?)",
+            [("Åsa Östlund", "1985"), ("Oskar Berg-Ek", "1990"), ("Lars Persson", None)],
+        )
+        conn.commit()
+        conn.close()
+
+        with self.app.test_client() as client:
+            def names(q, **params):
+                resp = client.get('/members/search', query_string={'q': q, **params})
+                self.assertEqual(resp.status_code, 200)
+                return [m['name'] for m in resp.get_json()['members']]
+
+            self.assertEqual(names('öst'), ["Åsa Östlund"])
+            # Swedish letters may be typed without diacritics
+            self.assertEqual(names('asa ost'), ["Åsa Östlund"])
+            self.assertEqual(names('ek'), ["Oskar Berg-Ek"])
+            # Word-start only: "sson" is inside a word
+            self.assertEqual(names('sson'), [])
+            self.assertIn("Oskar Berg-Ek", names('o'))
+            self.assertIn("Åsa Östlund", names('o'))
+            self.assertEqual(len(names('', limit=2)), 2)
+
+    def test_member_feed_sends_only_changes(self):
+        with self.app.test_client() as client:
+            full = client.get('/members').get_json()
+            self.assertTrue(full['full'])
+            self.assertIn(self.test_member_name, [m['name'] for m in full['members']])
+            generation = full['generation']
+            epoch = full['epoch']
+
+            # Up to date: an empty delta
+            same = client.get('/members', query_string={'since': generation, 'epoch': epoch}).get_json()
+            self.assertEqual((same['full'], same['members'], same['removed']), (False, [], []))
+            self.assertEqual(same['epoch'], epoch)
+
+            # A list kept from another database is replaced, not patched
+            other = client.get('/members', query_string={'since': generation, 'epoch': epoch + 1}).get_json()
+            self.assertTrue(other['full'])
+            self.assertEqual(other['epoch'], epoch)
+
+            conn = sqlite3.connect(DB_PATH)
+            new_id = conn.execute("INSERT INTO members (name) VALUES ('Feed Ny')").lastrowid
+            gone_id = conn.execute("INSERT INTO members (name) VALUES ('Feed Borta')").lastrowid
+            conn.commit()
+            middle = client.get('/members', query_string={'since': generation}).get_json()
+            conn.execute("UPDATE members SET avgiftstyp = 'Junior' WHERE id = ?", (new_id,))
+            conn.execute("DELETE FROM members WHERE id = ?", (gone_id,))
+            conn.commit()
+            conn.close()
+
+            delta = client.get('/members', query_string={'since': middle['generation']}).get_json()
+            self.assertFalse(delta['full'])
+            self.assertEqual(delta['members'], [{'id': new_id, 'name': 'Feed Ny', 'year': None, 'avgiftstyp': 'Junior'}])
+            self.assertEqual(delta['removed'], [gone_id])
+
+            # A generation this database never had gets the full list
+            ahead = client.get('/members', query_string={'since': delta['generation'] + 1000}).get_json()
+            self.assertTrue(ahead['full'])
+            self.assertNotIn(gone_id, [m['id'] for m in ahead['members']])
 
     def test_checkin_valid_and_invalid(self):
         with self.app.test_client() as client:
@@ -66,6 +157,243 @@ class KioskAppTests(unittest.TestCase):
             bad = client.post('/checkin', json={'name': 'ThisNameShouldNotExist_12345'})
             self.assertEqual(bad.status_code, 400)
 
+    def test_checkin_sees_members_added_after_index_built(self):
+        late_name = f"__LATE_MEMBER__{uuid.uuid4().hex}"
+        with self.app.test_client() as client:
+            # Build the member index first
+            ok = client.post('/checkin', json={'name': self.test_member_name})
+            self.assertEqual(ok.status_code, 200)
+            self.assertEqual(client.post('/checkin', json={'name': late_name}).status_code, 400)
+
+            conn = sqlite3.connect(DB_PATH)
+            conn.execute("INSERT INTO members (name) VALUES (?)", (late_name,))
+            conn.commit()
+            conn.close()
+
+            # Casefolded lookup picks up the new row via the generation counter
+            late = client.post('/checkin', json={'name': late_name.upper()})
+            self.assertEqual(late.status_code, 200)
+
+    def test_checkin_stores_normalized_name_key(self):
+        import unicodedata
+        from member_names import normalize_name
+
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute("INSERT INTO members (name, name_key, year_of_birth) VALUES (?, ?, ?)",
+                     ("Örjan Nyckel", normalize_name("Örjan Nyckel"), "1970"))
+        conn.commit()
+        conn.close()
+
+        # Decomposed "Ö", extra whitespace and different case still match
+        typed = unicodedata.normalize('NFD', "  ÖRJAN   nyckel ")
+        with self.app.test_client() as client:
+            resp = client.post('/checkin', json={'name': typed})
+            self.assertEqual(resp.status_code, 200)
+
+        conn = sqlite3.connect(DB_PATH)
+        row = conn.execute(
+            "SELECT m.year_of_birth FROM checkins c JOIN members m ON m.name_key = c.name_key "
+            "WHERE c.id = (SELECT MAX(id) FROM checkins)"
+        ).fetchone()
+        conn.close()
+        self.assertEqual(row, ("1970",))
+
+    def test_write_connections_are_warm_and_use_wal(self):
+        from app import get_db
+
+        with self.app.test_client() as client:
+            client.post('/checkin', json={'name': self.test_member_name})
+            conn = get_db(DB_PATH)
+            client.post('/checkin', json={'name': self.test_member_name})
+            self.assertIs(get_db(DB_PATH), conn)
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+
+    def test_group_commit_mode_persists_before_responding(self):
+        import app as app_module
+
+        app_module.GROUP_COMMIT_ENABLED = True
+        try:
+            with self.app.test_client() as client:
+                resp = client.post('/checkin_guest', json={'name': 'Batch Gäst', 'person_id': '010101-0101'})
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            app_module.GROUP_COMMIT_ENABLED = False
+
+        conn = sqlite3.connect(DB_PATH)
+        count = conn.execute("SELECT COUNT(*) FROM checkins WHERE name = 'Batch Gäst'").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(app_module.get_group_writer(DB_PATH).batches, 1)
+
+    def test_busy_database_spools_within_deadline(self):
+        import time
+        import app as app_module
+
+        blocker = sqlite3.connect(DB_PATH)
+        blocker.execute("BEGIN IMMEDIATE")
+        old_deadline = app_module.WRITE_DEADLINE
+        app_module.WRITE_DEADLINE = 0.3
+        try:
+            with self.app.test_client() as client:
+                t0 = time.monotonic()
+                resp = client.post('/checkin_guest', json={'name': 'Spool Gäst', 'person_id': '020202-0202'})
+                self.assertEqual(resp.status_code, 200)
+                self.assertLess(time.monotonic() - t0, 1.5)
+
+                health = client.get('/healthz').get_json()
+                self.assertEqual(health['spool_depth']['checkins'], 1)
+                self.assertGreaterEqual(health['writes']['lock_retries'], 1)
+        finally:
+            app_module.WRITE_DEADLINE = old_deadline
+            blocker.rollback()
+            blocker.close()
+
+        self.assertEqual(app_module.drain_spool(DB_PATH), 1)
+        self.assertEqual(app_module.spool_depth(DB_PATH), 0)
+        conn = sqlite3.connect(DB_PATH)
+        row = conn.execute(
+            "SELECT person_id, checkin_type FROM checkins WHERE name = 'Spool Gäst'"
+        ).fetchone()
+        conn.close()
+        self.assertEqual(row, ('020202-0202', 'engångsavgift'))
+
+    def test_spool_replay_is_idempotent_and_bad_lines_are_set_aside(self):
+        import json
+        import app as app_module
+
+        spool = DB_PATH + '.spool'
+        good = {'table': 'checkins', 'id': uuid.uuid4().hex,
+                'row': {'name': 'Spool Replay', 'timestamp': '2024-05-01 10:00:00'}}
+        bad = {'table': 'checkins', 'id': uuid.uuid4().hex, 'row': {'name': 'x', 'bogus': 1}}
+        with open(spool, 'w', encoding='utf-8') as f:
+            for entry in (good, bad):
+                f.write(json.dumps(entry) + '\n')
+        try:
+            self.assertEqual(app_module.drain_spool(DB_PATH), 1)
+            with open(spool + '.rejected', encoding='utf-8') as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], [bad['id']])
+
+            # A crash after the commit leaves the file to be replayed
+            with open(spool + '.draining', 'w', encoding='utf-8') as f:
+                f.write(json.dumps(good) + '\n')
+            self.assertEqual(app_module.drain_spool(DB_PATH), 0)
+            self.assertFalse(os.path.exists(spool + '.draining'))
+        finally:
+            for suffix in ('', '.draining', '.rejected'):
+                try:
+                    os.remove(spool + suffix)
+                except OSError:
+                    pass
+
+        conn = sqlite3.connect(DB_PATH)
+        count = conn.execute("SELECT COUNT(*) FROM checkins WHERE name = 'Spool Replay'").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 1)
+
+    def test_metrics_endpoint_reports_requests_and_export_lag(self):
+        import json
+        import app as app_module
+
+        # A snapshot from another (live) worker is merged in
+        with open(os.path.join(DB_PATH + '.metrics', '1.json'), 'w') as f:
+            json.dump({'pid': 1, 'gauges': [], 'histograms': [], 'counters': [
+                ['kiosk_sqlite_lock_retries_total', {}, 5],
+            ]}, f)
+        with self.app.test_client() as client:
+            client.post('/checkin', json={'name': self.test_member_name})
+            resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.get_data(as_text=True)
+
+        def value(series):
+            for line in text.splitlines():
+                if line.startswith(series + ' '):
+                    return float(line.split(' ')[1])
+            self.fail(f'{series} missing from /metrics')
+
+        self.assertGreaterEqual(
+            value('kiosk_http_requests_total{method="POST",route="/checkin",status="200"}'), 1)
+        self.assertIn('# TYPE kiosk_http_request_duration_seconds histogram', text)
+        self.assertIn('kiosk_http_request_duration_seconds_bucket{route="/checkin",le="+Inf"}', text)
+        self.assertGreaterEqual(value('kiosk_export_pending_rows{table="checkins"}'), 1)
+        self.assertIn('kiosk_export_oldest_pending_age_seconds{table="checkins"}', text)
+        self.assertGreaterEqual(value('kiosk_members'), 1)
+        with app_module._write_stats_lock:
+            own_retries = app_module.write_stats['lock_retries']
+        self.assertEqual(value('kiosk_sqlite_lock_retries_total'), own_retries + 5)
+        self.assertEqual(value('kiosk_metrics_workers'), 2)
+
+    def test_metrics_keep_totals_of_exited_workers(self):
+        import json
+        import subprocess
+        import sys
+        import metrics
+
+        # A worker that has exited, as gunicorn replaces it
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        metrics_dir = DB_PATH + '.metrics'
+        with open(os.path.join(metrics_dir, f'{proc.pid}.json'), 'w') as f:
+            json.dump({'pid': proc.pid, 'worker': f'{proc.pid}-1', 'gauges': [], 'histograms': [], 'counters': [
+                ['kiosk_spool_drained_rows_total', {}, 7],
+            ]}, f)
+        try:
+            for _ in range(2):
+                counters, _, _ = metrics.aggregate()
+                self.assertGreaterEqual(counters[('kiosk_spool_drained_rows_total', ())], 7)
+            self.assertFalse(os.path.exists(os.path.join(metrics_dir, f'{proc.pid}.json')))
+            with open(os.path.join(metrics_dir, metrics.RETIRED_FILE)) as f:
+                self.assertEqual(json.load(f)['workers'], [f'{proc.pid}-1'])
+        finally:
+            for name in (metrics.RETIRED_FILE, metrics.RETIRED_FILE + '.lock'):
+                try:
+                    os.remove(os.path.join(metrics_dir, name))
+                except OSError:
+                    pass
+
+    def test_stats_follow_new_rows(self):
+        with self.app.test_client() as client:
+            before = client.get('/stats').get_json()
+            client.post('/checkin', json={'name': self.test_member_name})
+            client.post('/checkin', json={'name': self.test_member_name})
+            client.post('/checkin_guest', json={'name': 'Stats Gäst', 'person_id': '900101-0000'})
+            client.post('/lartimmar', json={
+                'aktivitet': 'Statskurs', 'namn': 'Test', 'personnummer': '900101-0000',
+                'antal_timmar': 1.5, 'ledare': True,
+            })
+            after = client.get('/stats').get_json()
+            self.assertEqual(client.get('/stats?period=2024-13').status_code, 400)
+
+        checkins = after['checkins']
+        self.assertEqual(checkins['total'] - before['checkins']['total'], 3)
+        self.assertEqual(checkins['by_type'].get('engångsavgift', 0)
+                         - before['checkins']['by_type'].get('engångsavgift', 0), 1)
+        self.assertEqual(sum(checkins['by_hour'].values()), checkins['total'])
+        member = next(m for m in checkins['top_members'] if m['name'] == self.test_member_name)
+        self.assertGreaterEqual(member['visits'], 2)
+        self.assertEqual(after['lartimmar']['by_aktivitet']['Statskurs'],
+                         {'entries': 1, 'hours': 1.5, 'leader_entries': 1})
+
+    def test_profiling_captures_slow_requests_when_enabled(self):
+        from unittest import mock
+        import profiling
+
+        profile_dir = tempfile.mkdtemp(prefix='kiosk_profiles_')
+        try:
+            with mock.patch.multiple(profiling, PROFILE_ENABLED=True, PROFILE_MIN_MS=0,
+                                     PROFILE_DIR=profile_dir, PROFILE_KEEP=2):
+                with self.app.test_client() as client:
+                    for _ in range(3):
+                        client.post('/checkin', json={'name': self.test_member_name})
+            files = os.listdir(profile_dir)
+            self.assertEqual(len(files), 2)  # rotated down to PROFILE_KEEP
+            kind, name, _, pid, _ = profiling.parse_profile_name(files[0])
+            self.assertEqual((kind, name, pid), ('request', 'POST_checkin', os.getpid()))
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
     def test_lartimmar_valid_and_invalid(self):
         with self.app.test_client() as client:
             ok = client.post('/lartimmar', json={
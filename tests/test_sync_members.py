@@ -0,0 +1,581 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from collections import Counter
+
+import fake_sheets
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class SyncMembersTests(unittest.TestCase):
+    def setUp(self):
+        os.chdir(PROJECT_ROOT)
+        import migrations
+        import sync_members
+
+        self.sync = sync_members
+        fd, self.db_path = tempfile.mkstemp(prefix='kiosk_sync_test_', suffix='.db')
+        os.close(fd)
+        fd, self.lart_path = tempfile.mkstemp(prefix='kiosk_sync_test_lart_', suffix='.db')
+        os.close(fd)
+        self._saved_paths = (sync_members.DB_PATH, sync_members.LARTIMMAR_DB_PATH)
+        sync_members.DB_PATH = self.db_path
+        sync_members.LARTIMMAR_DB_PATH = self.lart_path
+        migrations.ensure_checkins_db(self.db_path)
+        migrations.ensure_lartimmar_db(self.lart_path)
+
+    def tearDown(self):
+        self.sync.DB_PATH, self.sync.LARTIMMAR_DB_PATH = self._saved_paths
+        for path in (self.db_path, self.lart_path):
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def _generation(self, conn):
+        return conn.execute(
+            "SELECT value FROM kiosk_meta WHERE key = 'members_generation'"
+        ).fetchone()[0]
+
+    def test_member_diff_only_writes_changes(self):
+        ident = self.sync.member_identity
+        conn = self._connect()
+        # Legacy rows without sheet_id are matched on name + year
+        conn.executemany(
+            "INSERT INTO members (name, year_of_birth, avgiftstyp) VALUES (?, ?, ?)",
+            [("Anna Ek", "1990", "Vuxen"), ("Bo Berg", "1985", ""), ("Cilla Ås", None, "")],
+        )
+        conn.commit()
+        anna_id = conn.execute("SELECT id FROM members WHERE name = 'Anna Ek'").fetchone()[0]
+
+        parsed = [
+            (ident("Anna Ek", "1990"), "Anna Ek", "1990", "Junior"),
+            (ident("Cilla Ås", None), "Cilla Ås", None, ""),
+            (ident("Dan Dal", "2001"), "Dan Dal", "2001", ""),
+        ]
+        added, changed, removed = self.sync.apply_member_diff(conn, parsed, "now")
+        self.assertEqual((added, removed), (1, 1))
+        # Anna's type changed; Cilla only had her sheet_id backfilled
+        self.assertEqual(changed, 2)
+
+        rows = dict(conn.execute("SELECT name, avgiftstyp FROM members").fetchall())
+        self.assertEqual(rows, {"Anna Ek": "Junior", "Cilla Ås": "", "Dan Dal": ""})
+        # Updated in place, so the row id is stable
+        self.assertEqual(conn.execute("SELECT id FROM members WHERE name = 'Anna Ek'").fetchone()[0], anna_id)
+
+        # A second run with the same sheet writes nothing at all
+        generation = self._generation(conn)
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "later"), (0, 0, 0))
+        self.assertEqual(self._generation(conn), generation)
+        conn.close()
+
+    def test_member_diff_keeps_ids_when_the_sheet_gains_ids_or_years_change(self):
+        ident = self.sync.member_identity
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO members (name, year_of_birth) VALUES (?, ?)",
+            [("Anna Ek", "1990"), ("Bo Berg", "1985")],
+        )
+        conn.commit()
+        ids = dict(conn.execute("SELECT name, id FROM members").fetchall())
+
+        # Id column added to the sheet: legacy rows are backfilled in place
+        parsed = [("7", "Anna Ek", "1990", ""), ("8", "Bo Berg", "1985", "")]
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "now"), (0, 2, 0))
+        self.assertEqual(dict(conn.execute("SELECT name, id FROM members").fetchall()), ids)
+
+        # No id column: a corrected year of birth updates the same row
+        conn.execute("UPDATE members SET sheet_id = NULL")
+        conn.commit()
+        parsed = [(ident("Anna Ek", "1991"), "Anna Ek", "1991", ""), (ident("Bo Berg", "1985"), "Bo Berg", "1985", "")]
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "now"), (0, 2, 0))
+        self.assertEqual(conn.execute("SELECT year_of_birth FROM members WHERE id = ?", (ids["Anna Ek"],)).fetchone(),
+                         ("1991",))
+
+        # A stale name key is repaired by the next import
+        conn.execute("UPDATE members SET name_key = 'fel' WHERE id = ?", (ids["Anna Ek"],))
+        conn.commit()
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "now"), (0, 1, 0))
+        self.assertEqual(conn.execute("SELECT name_key FROM members WHERE id = ?", (ids["Anna Ek"],)).fetchone(),
+                         ("anna ek",))
+
+        # Two sheet rows with the same name and year are both kept
+        parsed.append(parsed[1])
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "now"), (1, 0, 0))
+        self.assertEqual(self.sync.apply_member_diff(conn, parsed, "later"), (0, 0, 0))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM members WHERE name = 'Bo Berg'").fetchone(), (2,))
+        conn.close()
+
+    def test_member_change_log_is_pruned(self):
+        conn = self._connect()
+        for i in range(5):
+            conn.execute("INSERT INTO members (name) VALUES (?)", (f"Medlem {i}",))
+        conn.commit()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM member_changes").fetchone(), (5,))
+
+        self.sync.prune_member_changes(conn, keep=2)
+        generation = self._generation(conn)
+        self.assertEqual(
+            [r[0] for r in conn.execute("SELECT generation FROM member_changes ORDER BY generation")],
+            [generation - 1, generation],
+        )
+        floor = conn.execute("SELECT value FROM kiosk_meta WHERE key = 'member_changes_floor'").fetchone()[0]
+        self.assertEqual(floor, generation - 2)
+        conn.close()
+
+    def test_session_authorizes_once_per_cycle(self):
+        conn = self._connect()
+        conn.execute("INSERT INTO checkins (name, timestamp) VALUES ('Anna Ek', '2024-05-01 18:05:00')")
+        conn.commit()
+        conn.close()
+        lconn = sqlite3.connect(self.lart_path)
+        lconn.execute(
+            "INSERT INTO lartimmar (timestamp, aktivitet, namn, personnummer, antal_timmar) "
+            "VALUES ('2024-05-01 18:00:00', 'Kurs', 'Bo Berg', '850101-1234', 2)"
+        )
+        lconn.commit()
+        lconn.close()
+
+        backend = fake_sheets.FakeSheetsBackend()
+        factory_calls = []
+
+        def factory():
+            factory_calls.append(1)
+            return backend.client()
+
+        session = self.sync.SyncSession(client_factory=factory)
+        self.sync.export_new_rows(session=session)
+        self.sync.export_new_lartimmar(session=session)
+        self.assertEqual(self.sync.flush_sync_log(session=session), 2)
+
+        self.assertEqual(len(factory_calls), 1)
+        self.assertEqual(backend.calls['open'], 1)
+        self.assertEqual(backend.rows('Logg')[0], self.sync.LOGG_HEADER)
+        self.assertEqual(backend.rows('Logg')[1][:4], ['Anna Ek', '', '', '2024-05-01 18:05:00'])
+        self.assertEqual(backend.rows('Lartimmar')[1][3], 'Bo Berg')
+        self.assertEqual(len(backend.rows('SyncLog')), 3)  # header + one line per export
+
+        # A second export in the same session reuses the verified header
+        conn = self._connect()
+        conn.execute("INSERT INTO checkins (name, timestamp) VALUES ('Anna Ek', '2024-05-01 19:00:00')")
+        conn.commit()
+        conn.close()
+        before = Counter(backend.calls)
+        self.sync.export_new_rows(session=session)
+        # ...and its SyncLog line waits for the end-of-cycle flush
+        self.assertEqual(backend.calls - before, Counter({'append_rows': 1}))
+
+    def test_export_is_chunked_and_keeps_progress_on_failure(self):
+        from unittest import mock
+
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO checkins (name, timestamp) VALUES (?, ?)",
+            [(f"Gäst {i}", f"2024-05-01 18:0{i}:00") for i in range(5)],
+        )
+        conn.commit()
+
+        backend = fake_sheets.FakeSheetsBackend()
+        session = self.sync.SyncSession(client_factory=backend.client)
+        session.worksheet('Logg', header=self.sync.LOGG_HEADER)
+        # Header + first chunk go through, the second chunk fails on every retry
+        backend.max_rows['Logg'] = 3
+        with mock.patch.object(self.sync, 'EXPORT_CHUNK_SIZE', 2), \
+                mock.patch.object(self.sync.time, 'sleep'):
+            self.assertIsNone(self.sync.export_new_rows(session=session))
+            states = [r[0] for r in conn.execute("SELECT exported FROM checkins ORDER BY id")]
+            # The failed chunk stays claimed until the next export reconciles it
+            self.assertEqual(states, [1, 1, 2, 2, 0])
+            self.assertEqual([r[0] for r in backend.rows('Logg')[1:]], ["Gäst 0", "Gäst 1"])
+
+            # The next run picks up where the failed one stopped
+            del backend.max_rows['Logg']
+            self.assertEqual(self.sync.export_new_rows(session=session), 3)
+        self.assertEqual([r[0] for r in backend.rows('Logg')[1:]], [f"Gäst {i}" for i in range(5)])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM checkins WHERE exported != 1").fetchone()[0], 0)
+        conn.close()
+
+    def test_export_keys_prevent_duplicate_uploads(self):
+        from unittest import mock
+
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO checkins (name, timestamp) VALUES (?, ?)",
+            [(f"Gäst {i}", f"2024-05-01 18:0{i}:00") for i in range(3)],
+        )
+        conn.commit()
+
+        backend = fake_sheets.FakeSheetsBackend()
+        session = self.sync.SyncSession(client_factory=backend.client)
+        session.worksheet('Logg', header=self.sync.LOGG_HEADER)
+
+        def keys():
+            return [r[-1] for r in backend.rows('Logg')[1:]]
+
+        # The append lands but its response is lost: the retry sends nothing
+        backend.lose_responses['Logg'] = 1
+        with mock.patch.object(self.sync.time, 'sleep'):
+            self.assertEqual(self.sync.export_new_rows(session=session), 3)
+        ids = [r[0] for r in conn.execute("SELECT id FROM checkins ORDER BY id")]
+        self.assertEqual(keys(), [self.sync.export_key('checkins', i) for i in ids])
+
+        # Crash between append and finalize (rows left at 2), plus one new row
+        conn.execute("UPDATE checkins SET exported = 2")
+        conn.execute("INSERT INTO checkins (name, timestamp) VALUES ('Ny Gäst', '2024-05-01 19:00:00')")
+        conn.commit()
+        self.assertEqual(self.sync.export_new_rows(session=session), 1)
+        self.assertEqual(len(keys()), 4)
+        self.assertEqual(len(set(keys())), 4)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM checkins WHERE exported != 1").fetchone()[0], 0)
+        conn.close()
+
+    def test_export_batches_are_disjoint_and_leases_expire(self):
+        conn = self._connect()
+        conn.executemany("INSERT INTO checkins (name, timestamp) VALUES (?, ?)",
+                         [(f"Gäst {i}", "2024-05-01 18:00:00") for i in range(5)])
+        conn.commit()
+        other = self._connect()
+
+        first, claimed, taken_over = self.sync.claim_export_chunk(conn, "checkins", 2, lease_seconds=60, now=1000)
+        self.assertEqual((claimed, taken_over), (2, 0))
+        second, claimed, _ = self.sync.claim_export_chunk(other, "checkins", 2, lease_seconds=60, now=1000)
+        self.assertEqual(claimed, 2)
+        self.assertNotEqual(first, second)
+
+        # The first exporter "dies": its rows stay reserved until the lease runs out
+        _, claimed, taken_over = self.sync.claim_export_chunk(other, "checkins", 2, lease_seconds=60, now=1059)
+        self.assertEqual((claimed, taken_over), (1, 0))
+        third, claimed, taken_over = self.sync.claim_export_chunk(other, "checkins", 2, lease_seconds=60, now=1061)
+        self.assertEqual((claimed, taken_over), (2, 2))
+
+        # A late finish of the expired batch does not touch the rows taken over
+        self.assertEqual(self.sync.finish_export_batch(conn, "checkins", first), 0)
+        self.assertEqual(self.sync.finish_export_batch(other, "checkins", third), 2)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM checkins WHERE exported = 1").fetchone(), (2,))
+        conn.close()
+        other.close()
+
+    def test_parallel_exports_upload_every_row_once(self):
+        import threading
+        from unittest import mock
+
+        conn = self._connect()
+        conn.executemany("INSERT INTO checkins (name, timestamp) VALUES (?, ?)",
+                         [(f"Gäst {i}", "2024-05-01 18:00:00") for i in range(20)])
+        conn.commit()
+
+        backend = fake_sheets.FakeSheetsBackend()
+        session = self.sync.SyncSession(client_factory=backend.client)
+        session.worksheet('Logg', header=self.sync.LOGG_HEADER)
+        results = []
+        with mock.patch.object(self.sync, 'EXPORT_CHUNK_SIZE', 3):
+            threads = [threading.Thread(target=lambda: results.append(self.sync.export_new_rows(session=session)))
+                       for _ in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(sum(results), 20)
+        keys = [r[-1] for r in backend.rows('Logg')[1:]]
+        self.assertEqual(sorted(keys), sorted(self.sync.export_key('checkins', i) for i in range(1, 21)))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM checkins WHERE exported != 1").fetchone(), (0,))
+        conn.close()
+
+    def test_sync_jobs_run_concurrently_on_one_session(self):
+        import threading
+        import time
+
+        session = self.sync.SyncSession(client_factory=fake_sheets.FakeSheetsBackend().client)
+        barrier = threading.Barrier(2, timeout=2)
+        seen = []
+
+        def job(result):
+            def run(s):
+                seen.append(s)
+                barrier.wait()  # only passes if both jobs run at the same time
+                return result
+            return run
+
+        def failing(s):
+            raise RuntimeError('boom')
+
+        t0 = time.monotonic()
+        results = self.sync.run_sync_jobs({'a': job(1), 'b': job(2), 'c': failing}, session=session)
+        self.assertLess(time.monotonic() - t0, 2)
+        self.assertEqual(results, {'a': 1, 'b': 2, 'c': None})
+        self.assertEqual(seen, [session, session])
+
+    def test_sync_all_against_fake_sheets_backend(self):
+        backend = fake_sheets.FakeSheetsBackend(quota_per_minute=100, clock=lambda: 0.0)
+        backend.set_rows('Members', [['name', 'year_of_birth'], ['Anna Ek', '1990']])
+        conn = self._connect()
+        conn.execute("INSERT INTO checkins (name, timestamp) VALUES ('Anna Ek', '2024-05-01 18:05:00')")
+        conn.commit()
+        conn.close()
+
+        session = self.sync.SyncSession(client_factory=backend.client)
+        results = self.sync.sync_all(session=session)
+        self.assertTrue(results['import-members'])
+        self.assertEqual(results['export-new-rows'], 1)
+        self.assertEqual(backend.rows('Logg')[1][0], 'Anna Ek')
+        self.assertEqual(backend.rows('Members')[1], ['Anna Ek', '1990'])
+        self.assertEqual(backend.calls['open'], 1)
+
+        # Quota used up within the same minute: the flush fails and is kept
+        backend.quota_per_minute = sum(backend.calls.values())
+        self.assertIsNone(self.sync.flush_sync_log(session=session))
+        self.assertEqual(backend.errors['quota'], 1)
+
+    def test_sync_log_is_kept_until_flushed(self):
+        self.sync.log_sync("write", "Logg", rows=4, status="ok")
+        self.sync.log_sync("read", "Members", status="error", note="timeout")
+
+        backend = fake_sheets.FakeSheetsBackend()
+        session = self.sync.SyncSession(client_factory=backend.client)
+        session.worksheet('SyncLog', header=self.sync.SYNC_LOG_HEADER)
+        backend.max_rows['SyncLog'] = 1
+        self.assertIsNone(self.sync.flush_sync_log(session=session))
+
+        del backend.max_rows['SyncLog']
+        self.assertEqual(self.sync.flush_sync_log(session=session), 2)
+        self.assertEqual([r[1:] for r in backend.rows('SyncLog')[1:]],
+                         [["write", "Logg", "4", "ok", ""], ["read", "Members", "0", "error", "timeout"]])
+        self.assertEqual(self.sync.flush_sync_log(session=session), 0)
+
+
+class MigrationsTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(prefix='kiosk_migrate_test_', suffix='.db')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_upgrades_unversioned_database_once(self):
+        import migrations
+
+        # Schema as created by the kiosk before name keys and versioning
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE checkins (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, timestamp TEXT)")
+        conn.execute("CREATE TABLE members (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL)")
+        conn.execute("INSERT INTO checkins (name, timestamp) VALUES ('Åsa  Berg', '2024-05-01 10:00:00')")
+        conn.execute("INSERT INTO members (name) VALUES ('ÅSA BERG')")
+        conn.commit()
+        conn.close()
+
+        version = migrations.migrate(self.db_path, migrations.CHECKINS_MIGRATIONS)
+        self.assertEqual(version, len(migrations.CHECKINS_MIGRATIONS))
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self.assertEqual(migrations.schema_version(conn), version)
+            keys = conn.execute(
+                "SELECT c.name_key, m.name_key FROM checkins c, members m"
+            ).fetchone()
+            self.assertEqual(keys, ("åsa berg", "åsa berg"))
+            self.assertEqual(conn.execute("SELECT exported FROM checkins").fetchone(), (0,))
+            conn.execute("INSERT INTO members (name) VALUES ('Ny Medlem')")
+            self.assertEqual(conn.execute(
+                "SELECT value FROM kiosk_meta WHERE key = 'members_generation'"
+            ).fetchone(), (1,))
+            conn.rollback()
+        finally:
+            conn.close()
+
+        # Already current: nothing is applied again
+        applied = []
+        self.assertEqual(migrations.migrate(self.db_path, [applied.append] * version), version)
+        self.assertEqual(applied, [])
+
+
+class ArchiveTests(unittest.TestCase):
+    def setUp(self):
+        import migrations
+
+        self.tmp_dir = tempfile.mkdtemp(prefix='kiosk_archive_test_')
+        self.db_path = os.path.join(self.tmp_dir, 'checkins.db')
+        self.archive_dir = os.path.join(self.tmp_dir, 'archive')
+        migrations.ensure_checkins_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_moves_old_exported_rows_into_monthly_files(self):
+        import archive
+        from datetime import datetime
+
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "INSERT INTO checkins (name, name_key, timestamp, exported) VALUES (?, ?, ?, ?)",
+            [("Old", "old", "2024-01-10 10:00:00", 1),
+             ("Old", "old", "2024-01-20 10:00:00", 1),
+             ("Old pending", "old pending", "2024-01-21 10:00:00", 0),
+             ("Old", "old", "2024-02-01 09:00:00", 1),
+             ("New", "new", "2024-06-01 10:00:00", 1)],
+        )
+        conn.commit()
+
+        moved = archive.archive_table(self.db_path, 'checkins', older_than_days=90,
+                                      archive_dir=self.archive_dir, now=datetime(2024, 6, 2), batch_size=1)
+        self.assertEqual(moved, {'2024-01': 2, '2024-02': 1})
+        self.assertEqual(conn.execute("SELECT name FROM checkins ORDER BY id").fetchall(),
+                         [("Old pending",), ("New",)])
+        # Visits stay counted after the rows left the hot table
+        self.assertEqual(conn.execute("SELECT SUM(visits) FROM stats_hourly").fetchone(), (5,))
+        conn.close()
+
+        files = archive.archive_files('checkins', self.archive_dir)
+        self.assertEqual([month for month, _ in files], ['2024-02', '2024-01'])
+        january = archive.connect_readonly(files[1][1])
+        try:
+            self.assertEqual(january.execute("SELECT id, name_key, exported FROM checkins ORDER BY id").fetchall(),
+                             [(1, "old", 1), (2, "old", 1)])
+            with self.assertRaises(sqlite3.OperationalError):
+                january.execute("DELETE FROM checkins")
+        finally:
+            january.close()
+
+        # Nothing left to move
+        self.assertEqual(archive.archive_table(self.db_path, 'checkins', older_than_days=90,
+                                               archive_dir=self.archive_dir, now=datetime(2024, 6, 2)), {})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExportSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        from sync_scheduler import ExportScheduler
+
+        fd, self.db_path = tempfile.mkstemp(prefix='kiosk_sched_test_', suffix='.db')
+        os.close(fd)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE checkins (id INTEGER PRIMARY KEY, name TEXT, timestamp TEXT, exported INTEGER DEFAULT 0)"
+        )
+        conn.commit()
+        conn.close()
+
+        self.clock = FakeClock()
+        self.runs = []
+        self.export_ok = True
+        self.scheduler = ExportScheduler(
+            tables={'checkins': self.db_path},
+            import_job=lambda session: self.runs.append('import') or True,
+            export_job=self._export,
+            session_factory=lambda: None,
+            max_rows=3,
+            max_age=60,
+            import_interval=1800,
+            clock=self.clock,
+        )
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def _export(self, session):
+        self.runs.append('export')
+        if self.export_ok:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("UPDATE checkins SET exported = 1")
+            conn.commit()
+            conn.close()
+        return self.export_ok
+
+    def _add_checkins(self, count, timestamp=None):
+        from datetime import datetime
+
+        timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany("INSERT INTO checkins (name, timestamp) VALUES ('x', ?)", [(timestamp,)] * count)
+        conn.commit()
+        conn.close()
+
+    def test_exports_only_when_a_threshold_is_reached(self):
+        # First step imports; nothing pending, so sleep until the next import
+        self.assertEqual(self.scheduler.step(), 1800)
+        self.assertEqual(self.runs, ['import'])
+
+        # Below the row threshold and fresh: wait for the oldest row to age
+        self._add_checkins(2)
+        delay = self.scheduler.step()
+        self.assertEqual(self.runs, ['import'])
+        self.assertTrue(55 <= delay <= 60, delay)
+
+        # Reaching max_rows exports right away
+        self._add_checkins(1)
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'export'])
+
+        # A single stale row is exported too
+        self._add_checkins(1, timestamp="2000-01-01 00:00:00")
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'export', 'export'])
+
+    def test_failed_export_backs_off_exponentially(self):
+        self.scheduler.step()
+        self._add_checkins(3)
+        self.export_ok = False
+
+        self.assertEqual(self.scheduler.step(), 30)
+        # Still in backoff: nudges do not trigger another attempt
+        self.clock.now += 10
+        self.assertEqual(self.scheduler.step(), 20)
+        self.assertEqual(self.runs.count('export'), 1)
+
+        self.clock.now += 20
+        self.assertEqual(self.scheduler.step(), 60)
+        self.assertEqual(self.runs.count('export'), 2)
+
+        self.export_ok = True
+        self.clock.now += 60
+        self.scheduler.step()
+        self.assertEqual(self.scheduler.failures, 0)
+        self.assertEqual(self.scheduler.pending(), {'checkins': (0, 0.0)})
+
+    def test_failing_spool_drain_does_not_skip_the_export(self):
+        def before_export():
+            raise sqlite3.OperationalError("table checkins has no column named bogus")
+
+        self.scheduler.before_export = before_export
+        self._add_checkins(3)
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'export'])
+
+    def test_failing_import_does_not_hold_up_exports(self):
+        self.scheduler.import_job = lambda session: self.runs.append('import') and False
+        self._add_checkins(3)
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'export'])
+        self.assertEqual(self.scheduler.next_import, self.clock.now + 30)
+
+        self._add_checkins(3)
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'export', 'export'])
+
+    def test_archive_runs_on_its_own_interval(self):
+        self.scheduler.archive_job = lambda: self.runs.append('archive')
+        self.scheduler.archive_interval = 86400
+        self.scheduler.step()
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'archive'])
+        self.clock.now += 86400
+        self.scheduler.import_job = lambda session: True
+        self.scheduler.step()
+        self.assertEqual(self.runs, ['import', 'archive', 'archive'])
+
+
+if __name__ == '__main__':
+    unittest.main()
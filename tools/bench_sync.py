@@ -0,0 +1,134 @@
+"""Benchmark member import and export against the fake Sheets backend.
+
+Builds a synthetic Members sheet and a backlog of check-ins/Lärtimmar in
+throwaway databases, then runs sync_members against fake_sheets with the
+given latency, quota and failure rate. Prints wall time, API calls per
+method and rows/second for each phase. No credentials.json needed.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(sync_members, backend, members, checkins, lartimmar):
+    import migrations
+
+    backend.set_rows("Members", [["name", "year_of_birth", "avgiftstyp"]] + [
+        [f"Medlem {i:05d}", str(1950 + i % 60), "Vuxen" if i % 3 else "Junior"] for i in range(members)
+    ])
+    migrations.ensure_checkins_db(sync_members.DB_PATH)
+    migrations.ensure_lartimmar_db(sync_members.LARTIMMAR_DB_PATH)
+
+    conn = sqlite3.connect(sync_members.DB_PATH)
+    conn.executemany(
+        "INSERT INTO checkins (name, name_key, timestamp) VALUES (?, ?, ?)",
+        ((f"Medlem {i % max(members, 1):05d}", f"medlem {i % max(members, 1):05d}",
+          f"2024-05-{1 + i % 28:02d} {8 + i % 12:02d}:{i % 60:02d}:00") for i in range(checkins)),
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(sync_members.LARTIMMAR_DB_PATH)
+    conn.executemany(
+        "INSERT INTO lartimmar (timestamp, aktivitet, namn, personnummer, antal_timmar, ledare) "
+        "VALUES (?, 'Träning', ?, '900101-1234', 1.5, ?)",
+        ((f"2024-05-{1 + i % 28:02d} 18:00:00", f"Ledare {i}", i % 2) for i in range(lartimmar)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def run_phase(label, backend, rows, job):
+    before = backend.calls.copy()
+    errors_before = sum(backend.errors.values())
+    t0 = time.perf_counter()
+    result = job()
+    elapsed = time.perf_counter() - t0
+    calls = backend.calls - before
+    rate = rows / elapsed if elapsed else 0.0
+    print(f"{label:<16} | {rows:>7} rows | {elapsed:7.2f} s | {rate:9.1f} rows/s | "
+          f"{sum(calls.values()):>4} calls | errors {sum(backend.errors.values()) - errors_before} | result {result}")
+    print(f"{'':<16} | " + ", ".join(f"{name} {n}" for name, n in sorted(calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync_members against a fake Google Sheet")
+    parser.add_argument("--members", type=int, default=1000, help="Rows in the Members sheet (default 1000)")
+    parser.add_argument("--checkins", type=int, default=5000, help="Unexported check-ins (default 5000)")
+    parser.add_argument("--lartimmar", type=int, default=500, help="Unexported Lärtimmar rows (default 500)")
+    parser.add_argument("--latency-ms", type=float, default=300, help="Simulated latency per API call (default 300)")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Extra random latency per call (default 0)")
+    parser.add_argument("--quota", type=int, help="Max API calls per minute (default unlimited)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability a call fails (default 0)")
+    parser.add_argument("--chunk-size", type=int, help="Export chunk size (default KIOSK_EXPORT_CHUNK_SIZE)")
+    parser.add_argument("--sequential", action="store_true", help="Run the sync jobs one after another")
+    parser.add_argument("--exporters", type=int, default=1,
+                        help="Concurrent check-in exporters in the export-new-rows phase (default 1)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for failures and jitter")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="kiosk_bench_sync_")
+    sys.path.insert(0, BASE_DIR)
+    import fake_sheets
+    import sync_members
+
+    sync_members.DB_PATH = os.path.join(tmp_dir, "checkins.db")
+    sync_members.LARTIMMAR_DB_PATH = os.path.join(tmp_dir, "lartimmar.db")
+    if args.chunk_size:
+        sync_members.EXPORT_CHUNK_SIZE = args.chunk_size
+
+    backend = fake_sheets.FakeSheetsBackend(
+        latency=args.latency_ms / 1000.0,
+        jitter=args.jitter_ms / 1000.0,
+        quota_per_minute=args.quota,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    try:
+        seed(sync_members, backend, args.members, args.checkins, args.lartimmar)
+        print(f"{args.members} members, {args.checkins} check-ins, {args.lartimmar} Lärtimmar rows, "
+              f"{args.latency_ms:.0f} ms/call, chunk size {sync_members.EXPORT_CHUNK_SIZE}")
+
+        session = sync_members.SyncSession(client_factory=backend.client)
+        run_phase("import-members", backend, args.members,
+                  lambda: sync_members.import_members_from_sheet(session=session))
+
+        def export_rows():
+            # Each exporter claims its own leased batches
+            with ThreadPoolExecutor(max_workers=args.exporters) as pool:
+                futures = [pool.submit(sync_members.export_new_rows, session=session)
+                           for _ in range(args.exporters)]
+                return sum(f.result() or 0 for f in futures)
+
+        run_phase("export-new-rows", backend, args.checkins, export_rows)
+        run_phase("export-lartimmar", backend, args.lartimmar,
+                  lambda: sync_members.export_new_lartimmar(session=session))
+        run_phase("flush-sync-log", backend, 0,
+                  lambda: sync_members.flush_sync_log(session=session))
+
+        # Same work again, as one cycle on a fresh session and data set
+        seed(sync_members, backend, args.members, args.checkins, args.lartimmar)
+        session = sync_members.SyncSession(client_factory=backend.client)
+        total = args.members + args.checkins + args.lartimmar
+        if args.sequential:
+            run_phase("cycle (serial)", backend, total, lambda: [
+                sync_members.import_members_from_sheet(session=session),
+                sync_members.export_new_rows(session=session),
+                sync_members.export_new_lartimmar(session=session),
+            ])
+        else:
+            run_phase("cycle (sync_all)", backend, total,
+                      lambda: sync_members.sync_all(session=session))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
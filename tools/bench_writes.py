@@ -0,0 +1,98 @@
+"""Measure /checkin write throughput with and without group commit.
+
+Drives concurrent check-ins through the Flask test client against a
+throwaway database (one thread per simulated kiosk/phone) and prints
+rows/second and latency percentiles for each mode.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEMBER_NAME = "Bench Medlem"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def run_mode(app_module, group_commit, threads, per_thread):
+    app_module.GROUP_COMMIT_ENABLED = group_commit
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(threads)
+
+    def worker():
+        client = app_module.app.test_client()
+        local = []
+        start_barrier.wait()
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            resp = client.post('/checkin', json={'name': MEMBER_NAME})
+            local.append(time.perf_counter() - t0)
+            if resp.status_code != 200:
+                with lock:
+                    errors.append(resp.get_data(as_text=True))
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    t0 = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    total = threads * per_thread
+    label = "group commit" if group_commit else "direct"
+    print(f"{label:<13} | {total:>6} rows | {elapsed:7.2f} s | {total / elapsed:8.1f} rows/s | "
+          f"p50 {percentile(latencies, 50) * 1000:6.1f} ms | p95 {percentile(latencies, 95) * 1000:6.1f} ms | "
+          f"errors {len(errors)}")
+    if group_commit:
+        writer = app_module.get_group_writer(app_module.DB_PATH)
+        if writer.batches:
+            print(f"{'':<13} | {writer.batches} batches, {writer.rows / writer.batches:.1f} rows/batch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark check-in writes (direct vs group commit)")
+    parser.add_argument("--threads", type=int, default=16, help="Concurrent clients (default 16)")
+    parser.add_argument("--requests", type=int, default=200, help="Check-ins per client (default 200)")
+    parser.add_argument("--synchronous", choices=["NORMAL", "FULL"], default="FULL",
+                        help="synchronous mode for direct writes; FULL compares like-for-like "
+                             "with group commit, which always fsyncs (default FULL)")
+    parser.add_argument("--dir", help="Directory for the throwaway DBs (use the kiosk's disk, not tmpfs)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="kiosk_bench_", dir=args.dir)
+    os.environ['KIOSK_SQLITE_SYNCHRONOUS'] = args.synchronous
+    os.environ['APP_DB_PATH'] = os.path.join(tmp_dir, "checkins.db")
+    os.environ['LARTIMMAR_DB_PATH'] = os.path.join(tmp_dir, "lartimmar.db")
+    sys.path.insert(0, BASE_DIR)
+    import app as app_module
+    from member_names import normalize_name
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.execute("INSERT INTO members (name, name_key) VALUES (?, ?)", (MEMBER_NAME, normalize_name(MEMBER_NAME)))
+    conn.commit()
+    conn.close()
+
+    print(f"DB: {app_module.DB_PATH}, {args.threads} clients x {args.requests} check-ins, "
+          f"direct synchronous={args.synchronous}")
+    for group_commit in (False, True):
+        run_mode(app_module, group_commit, args.threads, args.requests)
+
+
+if __name__ == "__main__":
+    main()
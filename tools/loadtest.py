@@ -0,0 +1,279 @@
+"""HTTP load test for the kiosk endpoints under gunicorn.
+
+Starts the app like start_kiosk.sh does (gunicorn, 4 workers by default)
+against throwaway databases seeded with synthetic members, then drives
+concurrent /checkin, /checkin_guest, /lartimmar and GET / traffic over
+keep-alive connections. Prints throughput, p50/p95/p99 latency and error
+rate per endpoint, plus the write-path counters the workers report on
+/healthz (lock retries, deadline misses, spooled rows).
+
+With --with-export the background sync also runs (KIOSK_BG_SYNC=1)
+against the fake Sheets backend, so exports compete with the writes.
+
+    python tools/loadtest.py --clients 32 --duration 30 --with-export
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = "checkin=60,guest=10,lartimmar=10,index=20"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("checkin", "guest", "lartimmar", "index"):
+            raise SystemExit(f"Unknown endpoint in --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def seed_members(db_path, count):
+    sys.path.insert(0, BASE_DIR)
+    import migrations
+    from member_names import member_identity, normalize_name
+
+    migrations.ensure_checkins_db(db_path)
+    names = [f"Last Medlem {i:05d}" for i in range(count)]
+    years = [str(1950 + i % 60) for i in range(count)]
+    conn = sqlite3.connect(db_path)
+    # With the sheet_id the import derives, so importing the same list is a no-op
+    conn.executemany(
+        "INSERT INTO members (sheet_id, name, name_key, year_of_birth, avgiftstyp) VALUES (?, ?, ?, ?, '')",
+        ((member_identity(n, y), n, normalize_name(n), y) for n, y in zip(names, years)),
+    )
+    conn.commit()
+    conn.close()
+    return names
+
+
+def start_server(args, env, port):
+    cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}"]
+    if args.threads > 1:
+        cmd += ["--threads", str(args.threads)]
+    cmd.append("app:app")
+    log = open(os.path.join(env["LOADTEST_DIR"], "gunicorn.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {proc.returncode}, see {log.name}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/healthz")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not become ready within 60 s")
+
+
+def build_request(kind, names, rnd):
+    if kind == "index":
+        return "GET", "/", None
+    if kind == "checkin":
+        return "POST", "/checkin", {"name": rnd.choice(names)}
+    if kind == "guest":
+        return "POST", "/checkin_guest", {"name": f"Gäst {rnd.randrange(10000)}", "person_id": "900101-1234"}
+    return "POST", "/lartimmar", {
+        "aktivitet": "Träning",
+        "namn": f"Ledare {rnd.randrange(1000)}",
+        "personnummer": "900101-1234",
+        "antal_timmar": 1.5,
+        "ledare": rnd.random() < 0.5,
+    }
+
+
+def client_loop(port, names, mix, stop_at, seed, results, lock):
+    rnd = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    local = {k: {"latencies": [], "errors": 0} for k in kinds}
+    conn = None
+    while time.monotonic() < stop_at:
+        kind = rnd.choices(kinds, weights)[0]
+        method, path, payload = build_request(kind, names, rnd)
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+        t0 = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            ok = resp.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = None
+        local[kind]["latencies"].append(time.perf_counter() - t0)
+        if not ok:
+            local[kind]["errors"] += 1
+    if conn is not None:
+        conn.close()
+    with lock:
+        for kind, data in local.items():
+            results[kind]["latencies"].extend(data["latencies"])
+            results[kind]["errors"] += data["errors"]
+
+
+def collect_worker_stats(port, workers, attempts=200):
+    """Sum /healthz write counters over the workers (best effort: requests
+    land on whichever worker accepts them, so some may not be seen)."""
+    seen = {}
+    for _ in range(attempts):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/healthz")
+            data = json.loads(conn.getresponse().read())
+            conn.close()
+        except (OSError, ValueError, http.client.HTTPException):
+            continue
+        seen[data["pid"]] = data
+        if len(seen) >= workers:
+            break
+    totals = {}
+    for data in seen.values():
+        for key, value in data["writes"].items():
+            totals[key] = totals.get(key, 0) + value
+    spool = next(iter(seen.values()))["spool_depth"] if seen else {}
+    return len(seen), totals, spool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the kiosk endpoints under gunicorn")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers (default 4, as start_kiosk.sh)")
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker (default 1)")
+    parser.add_argument("--members", type=int, default=3000, help="Seeded members (default 3000)")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients (default 16)")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of load (default 20)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Endpoint weights (default {DEFAULT_MIX})")
+    parser.add_argument("--with-export", action="store_true",
+                        help="Run the background sync against the fake Sheets backend during the test")
+    parser.add_argument("--sheets-latency-ms", type=float, default=300,
+                        help="Fake Sheets latency per call with --with-export (default 300)")
+    parser.add_argument("--port", type=int, help="Port to bind (default: a free one)")
+    parser.add_argument("--dir", help="Directory for the throwaway DBs (use the kiosk's disk, not tmpfs)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp directory (DBs, gunicorn.log)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    tmp_dir = tempfile.mkdtemp(prefix="kiosk_loadtest_", dir=args.dir)
+    db_path = os.path.join(tmp_dir, "checkins.db")
+    lart_path = os.path.join(tmp_dir, "lartimmar.db")
+    port = args.port or free_port()
+
+    env = dict(os.environ)
+    # The sync-role lock (background_sync.lock) follows APP_DB_PATH into
+    # tmp_dir, so a kiosk running on the same device does not keep it.
+    env.update({
+        "APP_DB_PATH": db_path,
+        "LARTIMMAR_DB_PATH": lart_path,
+        "LOADTEST_DIR": tmp_dir,
+        "PYTHONUNBUFFERED": "1",
+        "KIOSK_SYNC_NUDGE_PORT": str(free_port()),
+        "KIOSK_BG_SYNC": "1" if args.with_export else "0",
+    })
+    if args.with_export:
+        env.update({
+            "KIOSK_SHEETS_BACKEND": "fake",
+            "KIOSK_FAKE_SHEETS_PATH": os.path.join(tmp_dir, "sheets.json"),
+            "KIOSK_FAKE_SHEETS_LATENCY_MS": str(args.sheets_latency_ms),
+        })
+
+    names = seed_members(db_path, args.members)
+    if args.with_export:
+        # Same members in the fake sheet, so the startup import is a no-op diff
+        with open(env["KIOSK_FAKE_SHEETS_PATH"], "w", encoding="utf-8") as f:
+            json.dump({"Members": [["name", "year_of_birth"]] + [
+                [n, str(1950 + i % 60)] for i, n in enumerate(names)
+            ]}, f, ensure_ascii=False)
+    proc = start_server(args, env, port)
+    try:
+        if args.with_export:
+            # The scheduler starts after a 10 s grace period
+            print("Waiting for the background sync to start...")
+            time.sleep(11)
+
+        results = {k: {"latencies": [], "errors": 0} for k in mix}
+        lock = threading.Lock()
+        stop_at = time.monotonic() + args.duration
+        threads = [
+            threading.Thread(target=client_loop, args=(port, names, mix, stop_at, i, results, lock))
+            for i in range(args.clients)
+        ]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+
+        print(f"{args.workers} workers x {args.threads} threads, {args.clients} clients, {elapsed:.1f} s, "
+              f"{args.members} members, export {'on' if args.with_export else 'off'}")
+        print(f"{'endpoint':<10} | {'requests':>8} | {'req/s':>8} | {'p50 ms':>7} | {'p95 ms':>7} | "
+              f"{'p99 ms':>7} | {'errors':>6}")
+        total = errors = 0
+        for kind, data in results.items():
+            lat = sorted(data["latencies"])
+            total += len(lat)
+            errors += data["errors"]
+            print(f"{kind:<10} | {len(lat):>8} | {len(lat) / elapsed:>8.1f} | "
+                  f"{percentile(lat, 50) * 1000:>7.1f} | {percentile(lat, 95) * 1000:>7.1f} | "
+                  f"{percentile(lat, 99) * 1000:>7.1f} | {data['errors']:>6}")
+        print(f"{'total':<10} | {total:>8} | {total / elapsed:>8.1f} | error rate {errors / max(total, 1):.2%}")
+
+        seen, totals, spool = collect_worker_stats(port, args.workers)
+        print(f"write counters ({seen}/{args.workers} workers): "
+              + ", ".join(f"{k} {v}" for k, v in sorted(totals.items()))
+              + f" | spool depth {spool}")
+        if args.with_export:
+            for path, table in ((db_path, "checkins"), (lart_path, "lartimmar")):
+                conn = sqlite3.connect(path)
+                done, count = conn.execute(
+                    f"SELECT SUM(exported = 1), COUNT(*) FROM {table}"
+                ).fetchone()
+                conn.close()
+                print(f"exported {table}: {done or 0}/{count}")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if args.keep:
+            print(f"Kept {tmp_dir}")
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Measure gunicorn boot time and per-worker memory for the kiosk app.
+
+Starts gunicorn the way start_kiosk.sh does (4 workers) against
+throwaway databases, once with gunicorn.conf.py (app preloaded in the
+master) and once without it (every worker imports the app itself), and
+reports:
+
+- time from launch until every worker has answered /healthz
+- RSS and PSS per process (PSS splits shared copy-on-write pages between
+  the processes sharing them, so it shows what preloading saves)
+
+Also times `import app` and `import sync_members` in a fresh interpreter.
+Linux only (reads /proc).
+
+    python tools/measure_startup.py --workers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_seconds(module, env):
+    code = (f"import time; t = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - t)")
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=BASE_DIR, env=env)
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def memory_kb(pid):
+    """(RSS, PSS) in kB for `pid`."""
+    rss = pss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, pss
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def run_mode(label, args, env, use_config):
+    port = free_port()
+    cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}"]
+    empty_config = None
+    if not use_config:
+        fd, empty_config = tempfile.mkstemp(suffix=".py")
+        os.close(fd)
+        cmd += ["--config", empty_config]
+    cmd.append("app:app")
+
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pids = set()
+    first_ready = None
+    try:
+        deadline = time.monotonic() + 60
+        while len(pids) < args.workers and time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise SystemExit(f"{label}: gunicorn exited with {proc.returncode}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+                conn.request("GET", "/healthz")
+                data = json.loads(conn.getresponse().read())
+                conn.close()
+                pids.add(data["pid"])
+                first_ready = first_ready or time.perf_counter() - t0
+            except (OSError, ValueError, http.client.HTTPException):
+                time.sleep(0.02)
+        all_ready = time.perf_counter() - t0
+        time.sleep(0.5)  # let the workers settle before reading memory
+
+        master_rss, master_pss = memory_kb(proc.pid)
+        workers = [(pid, *memory_kb(pid)) for pid in children(proc.pid)]
+        print(f"{label}: first response {first_ready:.2f} s, all {len(pids)} workers {all_ready:.2f} s")
+        print(f"  master     pid {proc.pid:>7} | RSS {master_rss / 1024:6.1f} MB | PSS {master_pss / 1024:6.1f} MB")
+        for pid, rss, pss in workers:
+            print(f"  worker     pid {pid:>7} | RSS {rss / 1024:6.1f} MB | PSS {pss / 1024:6.1f} MB")
+        total_pss = master_pss + sum(w[2] for w in workers)
+        print(f"  total PSS {total_pss / 1024:.1f} MB")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if empty_config:
+            os.remove(empty_config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure kiosk gunicorn startup time and memory")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers (default 4)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="kiosk_startup_")
+    env = dict(os.environ)
+    env.update({
+        "APP_DB_PATH": os.path.join(tmp_dir, "checkins.db"),
+        "LARTIMMAR_DB_PATH": os.path.join(tmp_dir, "lartimmar.db"),
+        "KIOSK_BG_SYNC": "0",
+    })
+    try:
+        print(f"import app:          {import_seconds('app', env) * 1000:7.1f} ms")
+        print(f"import sync_members: {import_seconds('sync_members', env) * 1000:7.1f} ms "
+              "(only paid by the worker running the background sync)")
+        run_mode("preload (gunicorn.conf.py)", args, env, use_config=True)
+        run_mode("no preload", args, env, use_config=False)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Summarize profiles captured with KIOSK_PROFILE=1 (see profiling.py).
+
+Lists how many slow requests/sync jobs were captured per name with their
+median and worst duration, then merges the matching profiles and prints
+the hottest functions.
+
+    python tools/profile_summary.py --kind request --top 20
+"""
+import argparse
+import os
+import pstats
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from profiling import PROFILE_DIR, parse_profile_name  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize captured kiosk profiles")
+    parser.add_argument("dir", nargs="?", default=PROFILE_DIR, help=f"Profile directory (default {PROFILE_DIR})")
+    parser.add_argument("--kind", choices=["request", "sync"], help="Only requests or only sync jobs")
+    parser.add_argument("--match", help="Only profiles whose name contains this text")
+    parser.add_argument("--top", type=int, default=25, help="Functions to show (default 25)")
+    parser.add_argument("--sort", choices=["cumulative", "tottime", "ncalls"], default="tottime",
+                        help="Sort order for the function table (default tottime)")
+    args = parser.parse_args()
+
+    try:
+        names = sorted(os.listdir(args.dir))
+    except OSError as e:
+        raise SystemExit(f"Cannot read {args.dir}: {e}")
+
+    selected = []
+    durations = {}
+    for fn in names:
+        info = parse_profile_name(fn)
+        if info is None:
+            continue
+        kind, name, _, _, duration = info
+        if args.kind and kind != args.kind:
+            continue
+        if args.match and args.match not in name:
+            continue
+        selected.append(os.path.join(args.dir, fn))
+        durations.setdefault((kind, name), []).append(duration)
+
+    if not selected:
+        raise SystemExit("No matching profiles.")
+
+    print(f"{len(selected)} profiles in {args.dir}")
+    print(f"{'kind':<8} | {'name':<40} | {'count':>5} | {'median ms':>9} | {'max ms':>8}")
+    for (kind, name), values in sorted(durations.items(), key=lambda item: -max(item[1])):
+        values.sort()
+        print(f"{kind:<8} | {name[:40]:<40} | {len(values):>5} | {values[len(values) // 2]:>9.0f} | {values[-1]:>8.0f}")
+    print()
+
+    stats = pstats.Stats(selected[0])
+    for path in selected[1:]:
+        stats.add(path)
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+
+
+if __name__ == "__main__":
+    main()
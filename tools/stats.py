@@ -0,0 +1,85 @@
+"""Print attendance statistics from the rollup tables (see rollups.py).
+
+Same numbers as the /stats endpoint, without the kiosk running.
+
+    python tools/stats.py              # current month
+    python tools/stats.py 2024-05 --top 10
+    python tools/stats.py 2024 --json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import migrations  # noqa: E402
+import rollups  # noqa: E402
+
+DB_PATH = os.environ.get("APP_DB_PATH") or os.path.join(BASE_DIR, "checkins.db")
+LARTIMMAR_DB_PATH = os.environ.get("LARTIMMAR_DB_PATH") or os.path.join(BASE_DIR, "lartimmar.db")
+
+
+def bar(value, largest, width=40):
+    return "#" * round(width * value / largest) if largest else ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attendance statistics for a month or year")
+    parser.add_argument("period", nargs="?", default=rollups.current_period(), help="YYYY-MM or YYYY (default this month)")
+    parser.add_argument("--top", type=int, default=20, help="Members to list (default 20)")
+    parser.add_argument("--json", action="store_true", help="Print the same JSON as /stats")
+    args = parser.parse_args()
+
+    try:
+        first, last = rollups.period_range(args.period)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    # Builds the rollups on a database the kiosk has not upgraded yet
+    migrations.ensure_checkins_db(DB_PATH)
+    migrations.ensure_lartimmar_db(LARTIMMAR_DB_PATH)
+    conn = sqlite3.connect(DB_PATH)
+    lart_conn = sqlite3.connect(LARTIMMAR_DB_PATH)
+    try:
+        checkins = rollups.checkin_stats(conn, args.period, top=args.top)
+        lartimmar = rollups.lartimmar_stats(lart_conn, args.period)
+    finally:
+        conn.close()
+        lart_conn.close()
+
+    if args.json:
+        print(json.dumps({"period": args.period, "from": first, "to": last,
+                          "checkins": checkins, "lartimmar": lartimmar}, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Period {args.period} ({first} - {last})")
+    print(f"Check-ins: {checkins['total']}, unique members: {checkins['unique_members']}")
+    for checkin_type, visits in checkins["by_type"].items():
+        print(f"  {checkin_type:<15} {visits:>6}")
+
+    print("\nPer hour")
+    largest = max(checkins["by_hour"].values(), default=0)
+    for hour, visits in checkins["by_hour"].items():
+        print(f"  {hour}:00 {visits:>6} {bar(visits, largest)}")
+
+    print("\nPer day")
+    largest = max(checkins["by_day"].values(), default=0)
+    for day, visits in checkins["by_day"].items():
+        print(f"  {day} {visits:>6} {bar(visits, largest)}")
+
+    if checkins["top_members"]:
+        print("\nMost visits")
+        for member in checkins["top_members"]:
+            print(f"  {member['name'][:30]:<30} {member['visits']:>5}  last {member['last_visit']}")
+
+    print(f"\nLärtimmar: {lartimmar['entries']} registrations, {lartimmar['hours']:.1f} h")
+    for aktivitet, totals in lartimmar["by_aktivitet"].items():
+        print(f"  {aktivitet[:20]:<20} {totals['entries']:>5} st {totals['hours']:>8.1f} h"
+              f"  (ledare {totals['leader_entries']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,259 @@
-import sqlite3
-import os
+"""Browse check-ins (or Lärtimmar registrations) in the local database.
+
+Rows are read in keyset pages (`WHERE id < last id`) and printed as they
+arrive, so even `--all` over years of history runs in constant memory
+and never holds one long read transaction. The status summary at the end
+is a single GROUP BY over the same filters.
+
+    python tools/view_checkins.py                       # latest 50
+    python tools/view_checkins.py --from 2024-05-01 --to 2024-05-31 --name anna
+    python tools/view_checkins.py --status pending --all --format csv > pending.csv
+    python tools/view_checkins.py --lartimmar --type Kurs --format json
+    python tools/view_checkins.py --before-id 1200      # next page
+    python tools/view_checkins.py --archive --from 2023-01-01 --to 2023-12-31 --all
+
+--format json writes one JSON object per line (JSON Lines). The database
+is opened read-only; with --archive the monthly archive files
+(archive.py) are read too, skipped when outside the --from/--to range.
+"""
 import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+from datetime import date, timedelta
 
-# Determine DB path (same logic as app.py/sync_members.py)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(BASE_DIR, "checkins.db")
+sys.path.insert(0, BASE_DIR)
 
-def view_checkins(limit=50, show_all=False):
-    if not os.path.exists(DB_PATH):
-        print(f"Database not found at {DB_PATH}")
-        return
+import archive  # noqa: E402
+from member_names import normalize_name  # noqa: E402
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    try:
-        if show_all:
-            query = "SELECT * FROM checkins ORDER BY id DESC"
-            cursor.execute(query)
+# Same logic as app.py/sync_members.py
+DB_PATH = os.environ.get("APP_DB_PATH") or os.path.join(BASE_DIR, "checkins.db")
+LARTIMMAR_DB_PATH = os.environ.get("LARTIMMAR_DB_PATH") or os.path.join(BASE_DIR, "lartimmar.db")
+
+# Rows fetched per keyset page
+PAGE_SIZE = 1000
+
+STATUS_VALUES = {"pending": 0, "exported": 1, "in-progress": 2}
+STATUS_LABELS = {v: k for k, v in STATUS_VALUES.items()}
+
+CHECKIN_COLUMNS = ["id", "timestamp", "name", "checkin_type", "person_id", "exported"]
+LARTIMMAR_COLUMNS = ["id", "timestamp", "aktivitet", "namn", "personnummer", "antal_timmar", "ledare", "exported"]
+
+
+def build_filters(args):
+    """(SQL conditions, parameters) for the filter options."""
+    where, params = [], []
+    if args.date_from:
+        where.append("timestamp >= ?")
+        params.append(args.date_from)
+    if args.date_to:
+        # Inclusive: everything before the start of the next day
+        where.append("timestamp < ?")
+        params.append((date.fromisoformat(args.date_to) + timedelta(days=1)).isoformat())
+    if args.status:
+        where.append("exported = ?")
+        params.append(STATUS_VALUES[args.status])
+    if args.lartimmar:
+        if args.name:
+            # namn has no normalized key; LIKE is case-insensitive for ASCII
+            where.append("namn LIKE ? ESCAPE '\\'")
+            params.append(_like_prefix(args.name.strip()))
+        if args.type:
+            where.append("aktivitet = ?")
+            params.append(args.type)
+    else:
+        if args.name:
+            # Prefix range on the indexed name_key (member_names.normalize_name)
+            prefix = normalize_name(args.name)
+            where.append("name_key >= ? AND name_key < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        if args.type:
+            if args.type == "medlem":
+                where.append("checkin_type IS NULL")
+            else:
+                where.append("checkin_type = ?")
+                params.append(args.type)
+    return where, params
+
+
+def _like_prefix(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _where_sql(where):
+    return f"WHERE {' AND '.join(where)}" if where else ""
+
+
+def iter_rows(conn, table, columns, where, params, limit=None, ascending=False,
+              before_id=None, after_id=None, page_size=PAGE_SIZE):
+    """Yield matching rows page by page, newest first unless `ascending`."""
+    order = "ASC" if ascending else "DESC"
+    remaining = limit
+    last_id = None
+    while remaining is None or remaining > 0:
+        page_where, page_params = list(where), list(params)
+        if before_id is not None:
+            page_where.append("id < ?")
+            page_params.append(before_id)
+        if after_id is not None:
+            page_where.append("id > ?")
+            page_params.append(after_id)
+        if last_id is not None:
+            page_where.append("id > ?" if ascending else "id < ?")
+            page_params.append(last_id)
+        size = page_size if remaining is None else min(page_size, remaining)
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} {_where_sql(page_where)} ORDER BY id {order} LIMIT ?",
+            page_params + [size],
+        ).fetchall()
+        yield from rows
+        if len(rows) < size:
+            return
+        last_id = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def iter_sources(conns, table, columns, where, params, limit=None, **kwargs):
+    """iter_rows() over several databases in turn, sharing one `limit`."""
+    remaining = limit
+    for conn in conns:
+        if remaining == 0:
+            return
+        for row in iter_rows(conn, table, columns, where, params, limit=remaining, **kwargs):
+            yield row
+            if remaining is not None:
+                remaining -= 1
+
+
+def open_archives(table, args):
+    """Read-only connections to the archive months matching the date filters."""
+    conns = []
+    for month, path in archive.archive_files(table, newest_first=not args.oldest_first):
+        if args.date_from and month < args.date_from[:7]:
+            continue
+        if args.date_to and month > args.date_to[:7]:
+            continue
+        conns.append(archive.connect_readonly(path))
+    return conns
+
+
+def status_summary(conn, table, where, params):
+    """{exported value: count} for the filtered rows, in one query."""
+    return dict(conn.execute(
+        f"SELECT exported, COUNT(*) FROM {table} {_where_sql(where)} GROUP BY exported", params
+    ).fetchall())
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def print_table(rows, lartimmar, out):
+    if lartimmar:
+        header = f"{'ID':<6} | {'Timestamp':<19} | {'Aktivitet':<15} | {'Namn':<25} | {'Timmar':>6} | {'Ledare':<6} | {'Status':<11} | Personnummer"
+    else:
+        header = f"{'ID':<6} | {'Timestamp':<19} | {'Name':<30} | {'Type':<15} | {'Status':<11} | PersonID"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    last_id, count = None, 0
+    for row in rows:
+        last_id, count = row[0], count + 1
+        status = STATUS_LABELS.get(row[-1], _text(row[-1]))
+        if lartimmar:
+            id_val, ts, aktivitet, namn, pnr, timmar, ledare, _ = row
+            print(f"{id_val:<6} | {_text(ts):<19} | {_text(aktivitet)[:15]:<15} | {_text(namn)[:25]:<25} | "
+                  f"{_text(timmar):>6} | {'ja' if ledare else '':<6} | {status:<11} | {_text(pnr)}", file=out)
         else:
-            query = "SELECT * FROM checkins ORDER BY id DESC LIMIT ?"
-            cursor.execute(query, (limit,))
-            
-        rows = cursor.fetchall()
-        
-        print(f"{'ID':<5} | {'Name':<30} | {'Timestamp':<20} | {'Exported':<10} | {'Type':<15} | {'PersonID'}")
-        print("-" * 100)
-        
-        for row in rows:
-            # Handle schema differences (some rows might have None for new columns if they are old)
-            id_val = row[0]
-            name = row[1]
-            timestamp = row[2]
-            exported = row[3]
-            
-            # Check if we have the new columns (schema migration might have happened)
-            # Schema: id, name, timestamp, exported, person_id, checkin_type
-            person_id = row[4] if len(row) > 4 and row[4] is not None else ""
-            checkin_type = row[5] if len(row) > 5 and row[5] is not None else ""
-            
-            # Ensure other fields are strings (handle potential None in old data)
-            id_val = str(id_val) if id_val is not None else ""
-            name = str(name) if name is not None else ""
-            timestamp = str(timestamp) if timestamp is not None else ""
-            
-            # Translate exported status
-            status = {0: "NO", 1: "YES", 2: "PENDING"}.get(exported, str(exported))
-            
-            print(f"{id_val:<5} | {name:<30} | {timestamp:<20} | {status:<10} | {checkin_type:<15} | {person_id}")
-
-        print("\nSummary:")
-        cursor.execute("SELECT count(*) FROM checkins")
-        total = cursor.fetchone()[0]
-        cursor.execute("SELECT count(*) FROM checkins WHERE exported=0")
-        pending = cursor.fetchone()[0]
-        cursor.execute("SELECT count(*) FROM checkins WHERE exported=1")
-        exported_count = cursor.fetchone()[0]
-        cursor.execute("SELECT count(*) FROM checkins WHERE exported=2")
-        locked = cursor.fetchone()[0]
-        
-        print(f"Total: {total}, Pending: {pending}, Exported: {exported_count}, Locked (Processing): {locked}")
-        
-    except Exception as e:
-        print(f"Error reading database: {e}")
-    finally:
-        conn.close()
+            id_val, ts, name, checkin_type, person_id, _ = row
+            print(f"{id_val:<6} | {_text(ts):<19} | {_text(name)[:30]:<30} | {_text(checkin_type) or 'medlem':<15} | "
+                  f"{status:<11} | {_text(person_id)}", file=out)
+    return last_id, count
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="View checkins in local database")
-    parser.add_argument("--all", action="store_true", help="Show all rows, not just the last 50")
+
+def main():
+    parser = argparse.ArgumentParser(description="View check-ins in the local database")
+    parser.add_argument("--lartimmar", action="store_true", help="Show Lärtimmar registrations (lartimmar.db) instead")
+    parser.add_argument("--archive", action="store_true", help="Include rows moved to the monthly archives")
+    parser.add_argument("--from", dest="date_from", help="First day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="date_to", help="Last day (inclusive), YYYY-MM-DD")
+    parser.add_argument("--name", help="Name prefix (case and spacing do not matter)")
+    parser.add_argument("--status", choices=sorted(STATUS_VALUES), help="Export status")
+    parser.add_argument("--type", help="Check-in type (medlem, engångsavgift) or, with --lartimmar, aktivitet")
     parser.add_argument("--limit", type=int, default=50, help="Number of rows to show (default 50)")
+    parser.add_argument("--all", action="store_true", help="Show all matching rows")
+    parser.add_argument("--before-id", type=int, help="Only rows with a lower id (next page when paging newest first)")
+    parser.add_argument("--after-id", type=int, help="Only rows with a higher id")
+    parser.add_argument("--oldest-first", action="store_true", help="Oldest rows first")
+    parser.add_argument("--format", choices=["table", "csv", "json"], default="table",
+                        help="Output format (default table; json is one object per line)")
+    parser.add_argument("--no-summary", action="store_true", help="table format: skip the status summary")
     args = parser.parse_args()
-    
-    view_checkins(limit=args.limit, show_all=args.all)
+
+    for value in (args.date_from, args.date_to):
+        if value:
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise SystemExit(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+    if args.lartimmar:
+        path, table, columns = LARTIMMAR_DB_PATH, "lartimmar", LARTIMMAR_COLUMNS
+    else:
+        path, table, columns = DB_PATH, "checkins", CHECKIN_COLUMNS
+    if not os.path.exists(path):
+        raise SystemExit(f"Database not found at {path}")
+
+    where, params = build_filters(args)
+    conns = [archive.connect_readonly(path)]
+    if args.archive:
+        # Archived rows are older than the hot ones
+        archives = open_archives(table, args)
+        conns = archives + conns if args.oldest_first else conns + archives
+    try:
+        limit = None if args.all or args.limit <= 0 else args.limit
+        rows = iter_sources(conns, table, columns, where, params, limit=limit,
+                            ascending=args.oldest_first, before_id=args.before_id, after_id=args.after_id)
+        out = sys.stdout
+        if args.format == "csv":
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+            return
+        if args.format == "json":
+            for row in rows:
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            return
+
+        last_id, count = print_table(rows, args.lartimmar, out)
+        if limit is not None and count == limit:
+            flag = "--after-id" if args.oldest_first else "--before-id"
+            print(f"\nNext page: {flag} {last_id}")
+        if not args.no_summary:
+            counts = {}
+            for conn in conns:
+                for value, count in status_summary(conn, table, where, params).items():
+                    counts[value] = counts.get(value, 0) + count
+            parts = [f"{label.capitalize()}: {counts.get(value, 0)}" for label, value in STATUS_VALUES.items()]
+            print(f"\nSummary: Total: {sum(counts.values())}, " + ", ".join(parts))
+    except sqlite3.OperationalError as e:
+        # e.g. no name_key column: the kiosk has not upgraded this database yet
+        raise SystemExit(f"Cannot read {path}: {e}")
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        # Output piped into e.g. head, which has stopped reading; point
+        # stdout at devnull so the exit flush does not fail again.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)